@@ -5,6 +5,8 @@ gcloud run deploy crop-analysis-app \
   --region ENTER_REGION \
   --memory 8Gi \
   --cpu 4 \
+  --no-cpu-throttling \
+  --cpu-boost \
   --platform managed \
   --allow-unauthenticated
 cd ..
@@ -0,0 +1,342 @@
+"""Async serving mode for the gemini-service.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Model calls are awaited, blocking storage I/O runs on a thread pool and QA
+extraction runs on a small bounded executor, so a single instance can hold
+many slow Gemini requests without tying up a thread for each of them. Routes
+without an async implementation are served by the Flask app. Every route
+that changes a session's context (chat, analyze, clear, delete) is served
+here, under one asyncio lock per session.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import time as time_module
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import main
+from model_loader import ModelNotReady
+from model_scheduler import ANALYSIS, BATCH, INTERACTIVE, Overloaded
+from prompts import build_analysis_prompt
+from result_cache import normalize_key
+from singleflight import AsyncSingleFlight
+
+qa_executor = ThreadPoolExecutor(max_workers=int(os.getenv('QA_EXECUTOR_WORKERS', 16)), thread_name_prefix='qa')
+storage_executor = ThreadPoolExecutor(max_workers=int(os.getenv('STORAGE_EXECUTOR_WORKERS', 32)), thread_name_prefix='storage')
+# Requests queued for a model slot wait here rather than on the event loop
+admission_executor = ThreadPoolExecutor(max_workers=int(os.getenv('MODEL_ADMISSION_WORKERS', 64)), thread_name_prefix='admission')
+analysis_flight = AsyncSingleFlight()
+batch_slots = asyncio.Semaphore(int(os.getenv('ANALYZE_BATCH_CONCURRENCY', 8)))
+session_locks = weakref.WeakValueDictionary()
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+def session_lock(user_id: str, session_id: str) -> asyncio.Lock:
+    """Per-session lock so turns for the same session run one at a time."""
+    key = f"{user_id}_{session_id}"
+    lock = session_locks.get(key)
+    if lock is None:
+        lock = session_locks[key] = asyncio.Lock()
+    return lock
+
+
+async def run_in(executor: ThreadPoolExecutor, fn, *args):
+    # Carry the request's context along so spans recorded on the executor join its trace
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, fn, *args))
+
+
+async def read_json(request: Request, *fields: str):
+    """Return the request JSON if it has every field, otherwise None."""
+    try:
+        request_json = await request.json()
+    except ValueError:
+        return None
+    if not isinstance(request_json, dict) or any(field not in request_json for field in fields):
+        return None
+    return request_json
+
+
+async def get_chat_response(user_id: str, session_id: str, prompt: str) -> str:
+    async with session_lock(user_id, session_id):
+        context = await run_in(storage_executor, main.clean_context, user_id, session_id)
+        # Compaction may ask the model for a summary, so it runs off the event loop
+        history, usage = await run_in(storage_executor, main.prepare_history, context, prompt)
+        chat = main.model.start_chat(history=history)
+        with main.telemetry.span('model.chat'):
+            response = await main.model_scheduler.call_async(lambda: chat.send_message_async(prompt), INTERACTIVE, admission_executor)
+        main.log_turn_usage(user_id, session_id, usage, response)
+        await run_in(storage_executor, main.record_exchange, user_id, session_id, context, prompt, response.text)
+        return response.text
+
+
+async def generate_shared_analysis(prompt: str, cache_key: str, priority: int = ANALYSIS) -> str:
+    with main.telemetry.span('model.generate'):
+        response = await main.model_scheduler.call_async(lambda: main.model.generate_content_async(prompt), priority, admission_executor)
+    main.count_model_tokens(response)
+    await run_in(storage_executor, main.analysis_cache.put, cache_key, response.text)
+    return response.text
+
+
+async def get_analysis_response(user_id: str, session_id: str, prompt: str, cache_key: str, bypass_cache: bool = False) -> str:
+    async with session_lock(user_id, session_id):
+        context = await run_in(storage_executor, main.clean_context, user_id, session_id)
+        if not bypass_cache:
+            cached = await run_in(storage_executor, main.lookup_shared_analysis, cache_key)
+            if cached is not None:
+                await run_in(storage_executor, main.record_exchange, user_id, session_id, context, prompt, cached, True)
+                return cached
+
+        if context:
+            # Answers that depend on this session's chat history cannot be shared
+            history, usage = await run_in(storage_executor, main.prepare_history, context, prompt)
+            chat = main.model.start_chat(history=history)
+            with main.telemetry.span('model.chat'):
+                response = await main.model_scheduler.call_async(lambda: chat.send_message_async(prompt), ANALYSIS, admission_executor)
+            main.log_turn_usage(user_id, session_id, usage, response)
+            result = response.text
+        else:
+            result = await analysis_flight.do(cache_key, lambda: generate_shared_analysis(prompt, cache_key))
+        await run_in(storage_executor, main.record_exchange, user_id, session_id, context, prompt, result, True)
+        return result
+
+
+async def stream_chat_response(user_id: str, session_id: str, prompt: str, result_key: str, cache_key: str = None, bypass_cache: bool = False,
+                               summary=None):
+    async with session_lock(user_id, session_id):
+        context = await run_in(storage_executor, main.clean_context, user_id, session_id)
+        if cache_key is not None and not bypass_cache:
+            cached = await run_in(storage_executor, main.lookup_shared_analysis, cache_key)
+            if cached is not None:
+                await run_in(storage_executor, main.record_exchange, user_id, session_id, context, prompt, cached, True)
+                if summary is not None:
+                    await run_in(storage_executor, main.record_analysis_summary, user_id, session_id, *summary)
+                yield main.sse_event({"text": cached})
+                yield main.sse_event({result_key: cached}, event="done")
+                return
+
+        shareable = cache_key is not None and not context
+        history, usage = await run_in(storage_executor, main.prepare_history, context, prompt)
+        chat = main.model.start_chat(history=history)
+        chunks = []
+        chunk = None
+        started = time_module.perf_counter()
+        try:
+            priority = ANALYSIS if cache_key is not None else INTERACTIVE
+            async for chunk in main.model_scheduler.stream_async(lambda: chat.send_message_async(prompt, stream=True), priority, admission_executor):
+                try:
+                    text = chunk.text
+                except ValueError:
+                    continue
+                if not chunks:
+                    main.telemetry.record('model.stream.first_token', started)
+                chunks.append(text)
+                yield main.sse_event({"text": text})
+        except Exception as e:
+            main.telemetry.record('model.stream', started, error=True)
+            yield main.sse_event({"error": str(e), **({"retry_after": e.retry_after} if isinstance(e, Overloaded) else {})}, event="error")
+            return
+        main.telemetry.record('model.stream', started)
+
+        result = "".join(chunks)
+        main.log_turn_usage(user_id, session_id, usage, chunk)
+        await run_in(storage_executor, main.record_exchange, user_id, session_id, context, prompt, result, cache_key is not None)
+        if summary is not None:
+            # Only a completed analysis changes the session's summary
+            await run_in(storage_executor, main.record_analysis_summary, user_id, session_id, *summary)
+        if shareable:
+            await run_in(storage_executor, main.analysis_cache.put, cache_key, result)
+        yield main.sse_event({result_key: result}, event="done")
+
+
+async def extract_analysis_request(request: Request):
+    """Validate an analyze request and extract its prompt, or return an error response."""
+    request_json = await read_json(request, 'sentence', 'session_id', 'user_id')
+    if request_json is None:
+        return None, JSONResponse({"error": "Please provide a sentence, session_id, and user_id in the request"}, status_code=400)
+
+    crop, region, time = await run_in(qa_executor, main.extract_crop_region_and_time, request_json['sentence'])
+    if not crop or not region:
+        return None, JSONResponse({"error": "Could not extract crop and region from the sentence"}, status_code=400)
+
+    prompt = build_analysis_prompt(crop, region, time)
+    return (request_json, prompt, normalize_key(crop, region, time), (crop, region, time)), None
+
+
+async def analyze_crop_suitability(request: Request):
+    parsed, error = await extract_analysis_request(request)
+    if error is not None:
+        return error
+    request_json, prompt, cache_key, summary = parsed
+    result = await get_analysis_response(request_json['user_id'], request_json['session_id'], prompt, cache_key, bypass_cache=bool(request_json.get('bypass_cache')))
+    await run_in(storage_executor, main.record_analysis_summary, request_json['user_id'], request_json['session_id'], *summary)
+    return JSONResponse({"crop_analysis": result})
+
+
+async def analyze_crop_suitability_stream(request: Request):
+    parsed, error = await extract_analysis_request(request)
+    if error is not None:
+        return error
+    request_json, prompt, cache_key, summary = parsed
+    events = stream_chat_response(request_json['user_id'], request_json['session_id'], prompt, "crop_analysis", cache_key=cache_key,
+                                  bypass_cache=bool(request_json.get('bypass_cache')), summary=summary)
+    return StreamingResponse(events, media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def chat_with_ai(request: Request):
+    request_json = await read_json(request, 'message', 'session_id', 'user_id')
+    if request_json is None:
+        return JSONResponse({"error": "Please provide a message, session_id, and user_id in the request"}, status_code=400)
+    result = await get_chat_response(request_json['user_id'], request_json['session_id'], request_json['message'])
+    return JSONResponse({"response": result})
+
+
+async def chat_with_ai_stream(request: Request):
+    request_json = await read_json(request, 'message', 'session_id', 'user_id')
+    if request_json is None:
+        return JSONResponse({"error": "Please provide a message, session_id, and user_id in the request"}, status_code=400)
+    main.model_scheduler.check(INTERACTIVE)
+    events = stream_chat_response(request_json['user_id'], request_json['session_id'], request_json['message'], "response")
+    return StreamingResponse(events, media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def clear_context(request: Request):
+    request_json = await read_json(request, 'session_id', 'user_id')
+    if request_json is None:
+        return JSONResponse({"error": "Please provide a session_id and user_id in the request"}, status_code=400)
+    user_id, session_id = request_json['user_id'], request_json['session_id']
+    # The same lock as chat turns, so a turn awaiting the model cannot write the old context back afterwards
+    async with session_lock(user_id, session_id):
+        await run_in(storage_executor, main.clear_session_context, user_id, session_id)
+    return JSONResponse({"message": f"Context cleared for user {user_id}, session {session_id}"})
+
+
+async def delete_session(request: Request):
+    request_json = await read_json(request, 'session_id', 'user_id')
+    if request_json is None:
+        return JSONResponse({"error": "Please provide user_id and session_id in the request"}, status_code=400)
+    user_id, session_id = request_json['user_id'], request_json['session_id']
+    async with session_lock(user_id, session_id):
+        await run_in(storage_executor, main.delete_saved_session, user_id, session_id)
+    return JSONResponse({"message": f"Session deleted for user {user_id}, session {session_id}"})
+
+
+async def analyze_group(cache_key: str, prompt: str, records):
+    try:
+        async with batch_slots:
+            result = await analysis_flight.do(cache_key, lambda: generate_shared_analysis(prompt, cache_key, BATCH))
+        return main.ndjson_lines(records, crop_analysis=result, cached=False), 0
+    except Exception as e:
+        return main.ndjson_lines(records, error=str(e)), len(records)
+
+
+async def stream_batch_analyses(failed, groups, bypass_cache: bool = False):
+    yield main.ndjson_lines(failed)
+    cached_count, errors = 0, len(failed)
+    tasks = []
+    for cache_key, (prompt, records) in groups.items():
+        cached = None if bypass_cache else await run_in(storage_executor, main.lookup_shared_analysis, cache_key)
+        if cached is not None:
+            cached_count += 1
+            yield main.ndjson_lines(records, crop_analysis=cached, cached=True)
+        else:
+            tasks.append(asyncio.ensure_future(analyze_group(cache_key, prompt, records)))
+
+    try:
+        for task in asyncio.as_completed(tasks):
+            lines, failures = await task
+            errors += failures
+            yield lines
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    items = len(failed) + sum(len(records) for _, records in groups.values())
+    yield json.dumps({'done': True, 'items': items, 'analyses': len(groups), 'cached': cached_count, 'errors': errors}) + '\n'
+
+
+async def analyze_batch(request: Request):
+    request_json = await read_json(request, 'items')
+    if request_json is None or not isinstance(request_json['items'], list) or not request_json['items']:
+        return JSONResponse({"error": "Please provide a non-empty list of items in the request"}, status_code=400)
+    if len(request_json['items']) > main.ANALYZE_BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"A batch can have at most {main.ANALYZE_BATCH_MAX_ITEMS} items"}, status_code=400)
+
+    failed, groups = await run_in(qa_executor, main.plan_batch, request_json['items'])
+    events = stream_batch_analyses(failed, groups, bypass_cache=bool(request_json.get('bypass_cache')))
+    return StreamingResponse(events, media_type='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+
+async def cache_stats(request: Request):
+    return JSONResponse({**main.analysis_cache.stats(), 'coalescing': analysis_flight.stats(),
+                         'precomputed': main.precomputed.stats() if main.precomputed is not None else None})
+
+
+async def metrics(request: Request):
+    stats = main.service_stats(analysis_flight.stats())
+    if request.query_params.get('format') == 'prometheus':
+        return PlainTextResponse(main.telemetry.prometheus(stats), media_type='text/plain; version=0.0.4')
+    return JSONResponse({**main.telemetry.snapshot(), **stats})
+
+
+class RequestTelemetry:
+    """Trace the async routes; requests passed through to Flask are traced by its own hooks."""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.endpoints = {route.path: route.endpoint.__name__ for route in routes if isinstance(route, Route)}
+
+    async def __call__(self, scope, receive, send):
+        endpoint = self.endpoints.get(scope['path']) if scope['type'] == 'http' else None
+        if endpoint is None or not main.telemetry.enabled:
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        token = main.telemetry.begin_request(endpoint)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            main.telemetry.end_request(token, status)
+
+
+async def model_not_ready(request: Request, exc: ModelNotReady):
+    return JSONResponse({"error": str(exc)}, status_code=503, headers={'Retry-After': '10'})
+
+
+async def overloaded(request: Request, exc: Overloaded):
+    return JSONResponse({"error": str(exc)}, status_code=429, headers={'Retry-After': str(exc.retry_after)})
+
+
+routes = [
+    Route('/analyze', analyze_crop_suitability, methods=['POST']),
+    Route('/analyze_stream', analyze_crop_suitability_stream, methods=['POST']),
+    Route('/analyze_batch', analyze_batch, methods=['POST']),
+    Route('/chat', chat_with_ai, methods=['POST']),
+    Route('/chat_stream', chat_with_ai_stream, methods=['POST']),
+    # Served here rather than by Flask so they take the async per-session lock the chat turns hold
+    Route('/clear_context', clear_context, methods=['POST']),
+    Route('/delete_session', delete_session, methods=['POST']),
+    Route('/cache_stats', cache_stats, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+    Mount('/', app=WSGIMiddleware(main.app, workers=int(os.getenv('WSGI_WORKERS', 8)))),
+]
+app = Starlette(exception_handlers={ModelNotReady: model_not_ready, Overloaded: overloaded}, routes=routes, middleware=[Middleware(RequestTelemetry, routes=routes)])
@@ -0,0 +1,63 @@
+"""Compare per-turn latency of replaying stored messages against passing them as chat history.
+
+Usage: python benchmarks/bench_chat_history.py [--latency 0.05] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time as time_module
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_history import build_history  # noqa: E402
+from fakes import FakeGenerativeModel  # noqa: E402
+
+MAX_CONTEXT_LENGTH = 10
+
+
+def make_context(length: int):
+    now = time_module.time()
+    roles = ('human', 'ai')
+    return [{'role': roles[i % 2], 'content': f'message {i}', 'timestamp': now} for i in range(length)]
+
+
+def replay_turn(model, context, prompt):
+    """The previous behaviour: one round-trip for every stored human message, then the prompt."""
+    chat = model.start_chat()
+    for message in context:
+        if message['role'] == 'human':
+            chat.send_message(message['content'])
+    return chat.send_message(prompt)
+
+
+def history_turn(model, context, prompt):
+    chat = model.start_chat(history=build_history(context))
+    return chat.send_message(prompt)
+
+
+def measure(turn, model, context, repeat):
+    model.calls = 0
+    start = time_module.perf_counter()
+    for _ in range(repeat):
+        turn(model, context, 'What fertiliser should I use?')
+    elapsed = (time_module.perf_counter() - start) / repeat
+    return elapsed, model.calls / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.05, help='fake model round-trip latency in seconds')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    model = FakeGenerativeModel(latency=args.latency, response_tokens=1)
+    print(f"{'context':>8} {'replay ms':>10} {'calls':>6} {'history ms':>11} {'calls':>6}")
+    for length in range(0, MAX_CONTEXT_LENGTH + 1, 2):
+        context = make_context(length)
+        replay_time, replay_calls = measure(replay_turn, model, context, args.repeat)
+        history_time, history_calls = measure(history_turn, model, context, args.repeat)
+        print(f"{length:>8} {replay_time * 1000:>10.1f} {replay_calls:>6.0f} {history_time * 1000:>11.1f} {history_calls:>6.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Compare accuracy and throughput of model-only extraction against the gazetteer fast path.
+
+Usage: python benchmarks/bench_extraction.py [--corpus benchmarks/extraction_corpus.jsonl] [--repeat 5] [--batch-size 1]
+
+Uses the real QA model when transformers and torch can load it. Otherwise it
+falls back to FakeExtractor with --fake-model-latency seconds per batch. In
+that case model accuracy is not meaningful, but throughput still shows how
+much model time the fast path saves.
+"""
+import argparse
+import json
+import os
+import sys
+import time as time_module
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gazetteer import SLOTS, FastPathExtractor, Gazetteer  # noqa: E402
+from result_cache import normalize_key  # noqa: E402
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class GazetteerOnly:
+    def __init__(self, gazetteer):
+        self.gazetteer = gazetteer
+
+    def extract(self, sentences):
+        return [self.gazetteer.match(sentence) for sentence in sentences]
+
+
+def load_model(name: str, fake_latency: float):
+    try:
+        from transformers import pipeline
+
+        from extraction import BatchedQAExtractor
+
+        return BatchedQAExtractor(pipeline('question-answering', model=name)), name
+    except Exception as e:
+        from fakes import FakeExtractor
+
+        print(f"Could not load {name} ({type(e).__name__}: {e}); using FakeExtractor", file=sys.stderr)
+        return FakeExtractor(latency=fake_latency), 'fake model'
+
+
+def same_slot(slot: str, predicted: str, expected: str) -> bool:
+    """Compare two slot values the way the analysis cache does, ignoring plural crop names."""
+    position = SLOTS.index(slot)
+    keys = [normalize_key(*[value if i == position else '' for i in range(3)]).split('|')[position] for value in (predicted, expected)]
+    if slot == 'crop':
+        keys = [key.rstrip('s') for key in keys]
+    return keys[0] == keys[1]
+
+
+def measure(extractor, corpus, repeat: int, batch_size: int):
+    sentences = [row['sentence'] for row in corpus]
+    predictions = []
+    start = time_module.perf_counter()
+    for _ in range(repeat):
+        predictions = []
+        for i in range(0, len(sentences), batch_size):
+            predictions.extend(extractor.extract(sentences[i:i + batch_size]))
+    elapsed = time_module.perf_counter() - start
+
+    accuracy = {slot: sum(same_slot(slot, getattr(prediction, slot), row[slot]) for prediction, row in zip(predictions, corpus)) / len(corpus) for slot in SLOTS}
+    exact = sum(all(same_slot(slot, getattr(prediction, slot), row[slot]) for slot in SLOTS) for prediction, row in zip(predictions, corpus)) / len(corpus)
+    return accuracy, exact, len(sentences) * repeat / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--corpus', default=os.path.join(BENCHMARKS_DIR, 'extraction_corpus.jsonl'))
+    parser.add_argument('--model', default='deepset/roberta-base-squad2')
+    parser.add_argument('--fake-model-latency', type=float, default=0.05, help='seconds per batch when the real model is unavailable')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.corpus) as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    model, model_name = load_model(args.model, args.fake_model_latency)
+    gazetteer = Gazetteer.default()
+    fast_path = FastPathExtractor(gazetteer, model)
+
+    print(f"{len(corpus)} sentences x {args.repeat}, batch size {args.batch_size}, model: {model_name}")
+    print(f"{'path':>12} {'crop':>6} {'region':>7} {'time':>6} {'all':>6} {'sent/s':>10}")
+    for name, extractor in (('model', model), ('gazetteer', GazetteerOnly(gazetteer)), ('fast path', fast_path)):
+        accuracy, exact, throughput = measure(extractor, corpus, args.repeat, args.batch_size)
+        print(f"{name:>12} {accuracy['crop']:>6.0%} {accuracy['region']:>7.0%} {accuracy['time']:>6.0%} {exact:>6.0%} {throughput:>10.1f}")
+
+    stats = fast_path.stats()
+    print(f"fast path served {stats['fast_path_rate']:.0%} of sentences without the model; paths: {stats['paths']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Measure QA model startup time and per-inference latency for each model variant.
+
+Usage: python benchmarks/bench_model_startup.py [--variants fp32 int8 onnx] [--model-path models/qa] [--requests 50]
+
+Each variant is loaded in a fresh subprocess, so the startup numbers cover
+the torch import and a cold load, which is what a new instance pays. Run
+`python model_loader.py download` first to measure loading baked weights
+instead of downloading them.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time as time_module
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SENTENCES = [
+    "Can I grow rice in Punjab during the kharif season?",
+    "Is lavender suitable for Kashmir in spring?",
+    "I want to grow hops in Himachal Pradesh in March",
+    "Should I plant sugarcane in Uttar Pradesh this October?",
+    "grow kale in Ooty during winter",
+    "teff farming in Ethiopia during the kiremt season",
+    "Can chia be grown in Madhya Pradesh during rabi?",
+    "Is dragon fruit suitable for Gujarat in the hot months?",
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_variant(args):
+    """Runs inside the subprocess: load one variant and time it."""
+    started = time_module.perf_counter()
+    from model_loader import QAModelLoader
+
+    loader = QAModelLoader(model_name=args.model, model_path=args.model_path, variant=args.variant, num_threads=args.threads)
+    loader.start()
+    extractor = loader.get()
+    result = {'variant': args.variant, 'ready_seconds': time_module.perf_counter() - started, **loader.timings}
+
+    for batch_size in (1, 8):
+        latencies = []
+        for i in range(args.requests):
+            batch = [SENTENCES[(i + j) % len(SENTENCES)] for j in range(batch_size)]
+            start = time_module.perf_counter()
+            extractor.extract(batch)
+            latencies.append((time_module.perf_counter() - start) * 1000)
+        result[f'batch{batch_size}_p50_ms'] = statistics.median(latencies)
+        result[f'batch{batch_size}_p95_ms'] = percentile(latencies, 0.95)
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--variants', nargs='+', default=['fp32', 'int8'], choices=['fp32', 'int8', 'onnx'])
+    parser.add_argument('--variant', help=argparse.SUPPRESS)
+    parser.add_argument('--model', default='deepset/roberta-base-squad2')
+    parser.add_argument('--model-path', default=os.getenv('QA_MODEL_PATH'))
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args)
+        return
+
+    print(f"{'variant':>8} {'ready s':>8} {'load s':>7} {'warmup s':>9} {'b1 p50':>7} {'b1 p95':>7} {'b8 p50':>7} {'b8 p95':>7}")
+    for variant in args.variants:
+        command = [sys.executable, os.path.abspath(__file__), '--variant', variant, '--model', args.model,
+                   '--threads', str(args.threads), '--requests', str(args.requests)]
+        if args.model_path:
+            command += ['--model-path', args.model_path]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0 or not completed.stdout.strip():
+            print(f"{variant:>8} failed: {(completed.stderr.strip().splitlines() or ['no output'])[-1]}")
+            continue
+        r = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"{variant:>8} {r['ready_seconds']:>8.2f} {r['load_seconds']:>7.2f} {r.get('warmup_seconds', 0):>9.2f} "
+              f"{r['batch1_p50_ms']:>7.1f} {r['batch1_p95_ms']:>7.1f} {r['batch8_p50_ms']:>7.1f} {r['batch8_p95_ms']:>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
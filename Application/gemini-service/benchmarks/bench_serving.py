@@ -0,0 +1,111 @@
+"""Load-test the Flask (gunicorn) and async (uvicorn) serving modes against fake backends.
+
+Usage: python benchmarks/bench_serving.py [--concurrency 8 64 256] [--requests 512] [--model-latency 0.5]
+
+Each mode is started as a subprocess running benchmarks/fake_service.py, then
+hit with /chat requests from a pool of client threads.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time as time_module
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SERVERS = {
+    'flask': ['gunicorn', '--chdir', BENCHMARKS_DIR, '--workers', '1', '--threads', '8', '--timeout', '0', '-b', '127.0.0.1:{port}', 'fake_service:app'],
+    'asgi': ['uvicorn', '--app-dir', BENCHMARKS_DIR, '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning', 'fake_service:asgi_app'],
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(base_url: str, timeout: float = 120):
+    deadline = time_module.monotonic() + timeout
+    while time_module.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"{base_url}/cache_stats", timeout=1).read()
+            return
+        except OSError:
+            time_module.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start")
+
+
+def post(url: str, payload: dict) -> float:
+    request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'), headers={'Content-Type': 'application/json'})
+    start = time_module.perf_counter()
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+    return time_module.perf_counter() - start
+
+
+def run_load(base_url: str, concurrency: int, total: int) -> dict:
+    def one(i):
+        payload = {'message': 'Which fertiliser suits this crop?', 'user_id': 'bench', 'session_id': f'session-{i}'}
+        try:
+            return post(f"{base_url}/chat", payload)
+        except OSError:
+            return None
+
+    start = time_module.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time_module.perf_counter() - start
+
+    latencies = sorted(latency for latency in results if latency is not None)
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': total - len(latencies),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': quantiles[49] * 1000 if latencies else None,
+        'p95_ms': quantiles[94] * 1000 if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--modes', nargs='+', default=list(SERVERS), choices=list(SERVERS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[8, 64, 256])
+    parser.add_argument('--requests', type=int, default=512)
+    parser.add_argument('--model-latency', type=float, default=0.5)
+    parser.add_argument('--storage-latency', type=float, default=0.02)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    env = {**os.environ, 'FAKE_MODEL_LATENCY': str(args.model_latency), 'FAKE_STORAGE_LATENCY': str(args.storage_latency)}
+    results = []
+    for mode in args.modes:
+        port = free_port()
+        command = [part.format(port=port) for part in SERVERS[mode]]
+        server = subprocess.Popen(command, env=env, cwd=os.path.dirname(BENCHMARKS_DIR))
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            wait_until_ready(base_url)
+            for concurrency in args.concurrency:
+                results.append({'mode': mode, **run_load(base_url, concurrency, max(args.requests, concurrency))})
+        finally:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':>6} {'conc':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    for row in results:
+        print(f"{row['mode']:>6} {row['concurrency']:>5} {row['throughput_rps']:>8.1f} {row['p50_ms'] or 0:>8.0f} {row['p95_ms'] or 0:>8.0f} {row['errors']:>7}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
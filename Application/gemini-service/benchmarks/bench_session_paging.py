@@ -0,0 +1,64 @@
+"""Compare the response size and latency of loading a long session in full against loading a page of it.
+
+Usage: python benchmarks/bench_session_paging.py [--messages 500] [--limit 20] [--repeat 20]
+
+Runs against the in-process service with fake Gemini and storage (see fake_service).
+"""
+import argparse
+import os
+import statistics
+import sys
+import time as time_module
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('FAKE_STORAGE_LATENCY', '0.02')
+
+from fake_service import app  # noqa: E402
+
+
+def make_session(count: int):
+    messages = []
+    for i in range(count):
+        if i % 2 == 0:
+            messages.append({'role': 'user', 'content': f'Question {i}: how much water does the crop need in week {i // 2}?'})
+        else:
+            messages.append({'role': 'assistant', 'content': f'For week {i // 2}, give **{i % 7 + 3} cm** of water. '
+                                                             'Irrigate in the morning and apply 20 kg/acre of urea after weeding.'})
+    return {'timestamp': '2024-06-01T10:00:00', 'analysis_input': 'Can I grow rice in Punjab in kharif?',
+            'analysis_result': {'crop_analysis': 'Rice is well suited to Punjab in kharif. ' * 50}, 'chat_messages': messages}
+
+
+def measure(client, params, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time_module.perf_counter()
+        response = client.get('/load_session', query_string=params)
+        times.append(time_module.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(response.get_data(as_text=True))
+    return statistics.median(times), len(response.get_data()), response.get_json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    client = app.test_client()
+    user_id, session_id = 'bench-user', 'bench-paging'
+    response = client.post('/save_session', json={'user_id': user_id, 'session_id': session_id, 'session_data': make_session(args.messages)})
+    if response.status_code != 200:
+        raise RuntimeError(response.get_data(as_text=True))
+
+    base = {'user_id': user_id, 'session_id': session_id}
+    print(f"{'request':>14} {'messages':>9} {'median ms':>10} {'KB':>8}")
+    for name, params in (('full', base), ('newest page', {**base, 'limit': args.limit}),
+                         ('earlier page', {**base, 'limit': args.limit, 'before': args.messages - args.limit})):
+        elapsed, size, body = measure(client, params, args.repeat)
+        print(f"{name:>14} {len(body['chat_messages']):>9} {elapsed * 1000:>10.1f} {size / 1024:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
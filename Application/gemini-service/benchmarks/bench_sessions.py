@@ -0,0 +1,263 @@
+"""Replay analyze-plus-chat session traces against the in-process service with fake Gemini and storage.
+
+Usage: python benchmarks/bench_sessions.py [--sessions 200] [--concurrency 16] [--model-latency 0.2] [--output results.json]
+       python benchmarks/bench_sessions.py --trace traces.jsonl --compare baseline.json
+
+A trace is JSONL with one session per line:
+
+    {"user_id": "u1", "session_id": "s1", "steps": [
+        {"endpoint": "/analyze", "body": {"sentence": "Can I grow rice in Punjab in kharif?"}},
+        {"think": 0.5},
+        {"endpoint": "/chat", "body": {"message": "How much water does it need?"}}]}
+
+Without --trace, sessions are generated from the extraction corpus (use
+--write-trace to keep them). Each session's steps run in order, and
+--concurrency sessions run at once. Results include throughput and
+p50/p95/p99 latency per endpoint, plus how context_cache grew. They are
+written as JSON, and --compare reports regressions against an earlier run,
+exiting non-zero when p95 latency or throughput is more than
+--max-regression worse.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time as time_module
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FOLLOW_UPS = [
+    "How much water does it need each week?",
+    "Which fertiliser should I apply and when?",
+    "What pests should I watch out for?",
+    "When is the best time to harvest?",
+    "Can I intercrop it with pulses?",
+    "What yield can I expect per acre?",
+    "How should I prepare the soil before sowing?",
+    "Is drip irrigation worth it for this crop?",
+    "What seed variety do you recommend?",
+    "How do I protect it from heavy rain?",
+]
+
+
+def generate_traces(count: int, min_turns: int, max_turns: int, think: float, stream_ratio: float, seed: int):
+    with open(os.path.join(BENCHMARKS_DIR, 'extraction_corpus.jsonl')) as f:
+        sentences = [row['sentence'] for row in map(json.loads, filter(str.strip, f)) if row['crop'] and row['region']]
+    rng = random.Random(seed)
+    traces = []
+    for i in range(count):
+        stream = rng.random() < stream_ratio
+        steps = [{'endpoint': '/analyze_stream' if stream else '/analyze', 'body': {'sentence': rng.choice(sentences)}}]
+        for _ in range(rng.randint(min_turns, max_turns)):
+            if think:
+                steps.append({'think': rng.uniform(0, 2 * think)})
+            steps.append({'endpoint': '/chat_stream' if stream else '/chat', 'body': {'message': rng.choice(FOLLOW_UPS)}})
+        traces.append({'user_id': f'bench-user-{i % 50}', 'session_id': f'bench-session-{i}', 'steps': steps})
+    return traces
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {'p50_ms': quantiles[49] * 1000, 'p95_ms': quantiles[94] * 1000, 'p99_ms': quantiles[98] * 1000}
+
+
+class Replayer:
+    def __init__(self, app, context_cache):
+        self.app = app
+        self.context_cache = context_cache
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.memory_samples = []
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+    def replay(self, trace):
+        for step in trace['steps']:
+            if 'think' in step:
+                time_module.sleep(step['think'])
+                continue
+            body = {'user_id': trace['user_id'], 'session_id': trace['session_id'], **step['body']}
+            start = time_module.perf_counter()
+            response = self.client().post(step['endpoint'], json=body)
+            response.get_data()  # Streamed endpoints only finish once the body has been read
+            response.close()
+            elapsed = time_module.perf_counter() - start
+            with self.lock:
+                self.latencies[step['endpoint']].append(elapsed)
+                self.statuses[step['endpoint']][response.status_code] += 1
+
+    def sample_memory(self, started: float, stop: threading.Event, interval: float):
+        while not stop.wait(interval):
+            stats = self.context_cache.stats()
+            self.memory_samples.append({'elapsed_s': round(time_module.perf_counter() - started, 3), 'entries': stats['entries'], 'bytes': stats['bytes']})
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(traces, args):
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('TRACE_LOG_THRESHOLD_MS', '-1')
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import fake_service
+
+    fake_service.fake_model.latency = args.model_latency
+    fake_service.fake_model.tokens_per_second = args.tokens_per_second
+    fake_service.fake_model.response_tokens = args.response_tokens
+    fake_service.fake_bucket.latency = args.storage_latency
+    fake_service.main.qa_batcher.extractor.latency = args.qa_latency
+    main = fake_service.main
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    before = main.context_cache.stats()
+    replayer = Replayer(fake_service.app, main.context_cache)
+    stop = threading.Event()
+    started = time_module.perf_counter()
+    sampler = threading.Thread(target=replayer.sample_memory, args=(started, stop, args.sample_interval), daemon=True)
+    sampler.start()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(replayer.replay, traces))
+    elapsed = time_module.perf_counter() - started
+    stop.set()
+    sampler.join()
+    main.write_behind.flush()
+    after = main.context_cache.stats()
+
+    requests = sum(len(latencies) for latencies in replayer.latencies.values())
+    result = {
+        'commit': git_commit(),
+        'timestamp': time_module.strftime('%Y-%m-%dT%H:%M:%SZ', time_module.gmtime()),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'write_trace')},
+        'sessions': len(traces),
+        'requests': requests,
+        'elapsed_s': elapsed,
+        'throughput_rps': requests / elapsed,
+        'sessions_per_s': len(traces) / elapsed,
+        'endpoints': {
+            endpoint: {
+                'requests': len(latencies),
+                # A 400 for a sentence nothing could be extracted from is the service working as intended
+                'errors': sum(count for status, count in replayer.statuses[endpoint].items() if status >= 500 or status == 429),
+                'statuses': {str(status): count for status, count in sorted(replayer.statuses[endpoint].items())},
+                **percentiles(latencies),
+            }
+            for endpoint, latencies in sorted(replayer.latencies.items())
+        },
+        'context_cache': {
+            'entries_before': before['entries'],
+            'entries_after': after['entries'],
+            'bytes_before': before['bytes'],
+            'bytes_after': after['bytes'],
+            'bytes_per_session': (after['bytes'] - before['bytes']) / len(traces) if traces else 0.0,
+            'peak_bytes': max([sample['bytes'] for sample in replayer.memory_samples] + [after['bytes']]),
+            'evictions': after['evictions'] - before['evictions'],
+            'samples': replayer.memory_samples,
+        },
+        'model_calls': fake_service.fake_model.calls,
+        'model_scheduler': main.model_scheduler.stats(),
+    }
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['tracemalloc'] = {'current_bytes': current, 'peak_bytes': peak}
+    return result
+
+
+def compare(result, baseline, max_regression: float, out=sys.stdout):
+    """Print per-endpoint changes against a baseline run and return the regressions beyond max_regression."""
+    regressions = []
+    print(f"\nvs {baseline.get('commit') or 'baseline'}: throughput {baseline['throughput_rps']:.1f} -> {result['throughput_rps']:.1f} rps", file=out)
+    if result['throughput_rps'] < baseline['throughput_rps'] * (1 - max_regression):
+        regressions.append('throughput')
+    for endpoint, row in result['endpoints'].items():
+        old = baseline['endpoints'].get(endpoint)
+        if not old or not old['p95_ms'] or row['p95_ms'] is None:
+            continue
+        change = row['p95_ms'] / old['p95_ms'] - 1
+        print(f"{endpoint:>16} p95 {old['p95_ms']:>8.1f} -> {row['p95_ms']:>8.1f} ms ({change:+.0%})", file=out)
+        if change > max_regression:
+            regressions.append(f"{endpoint} p95")
+    old_bytes, new_bytes = baseline['context_cache']['bytes_per_session'], result['context_cache']['bytes_per_session']
+    print(f"{'context_cache':>16} {old_bytes:>8.0f} -> {new_bytes:>8.0f} bytes/session", file=out)
+    if old_bytes and new_bytes > old_bytes * (1 + max_regression):
+        regressions.append('context_cache bytes/session')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', help='JSONL session trace to replay instead of generated sessions')
+    parser.add_argument('--write-trace', help='save the generated sessions as a trace file')
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--min-turns', type=int, default=2)
+    parser.add_argument('--max-turns', type=int, default=6)
+    parser.add_argument('--think', type=float, default=0, help='mean seconds between a session\'s requests')
+    parser.add_argument('--stream-ratio', type=float, default=0.3, help='share of sessions using the streaming endpoints')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--model-latency', type=float, default=0.2)
+    parser.add_argument('--tokens-per-second', type=float, default=0)
+    parser.add_argument('--response-tokens', type=int, default=200)
+    parser.add_argument('--storage-latency', type=float, default=0.02)
+    parser.add_argument('--qa-latency', type=float, default=0.01)
+    parser.add_argument('--sample-interval', type=float, default=0.5, help='seconds between context_cache memory samples')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report Python heap usage (slows the run down)')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace) as f:
+            traces = [json.loads(line) for line in f if line.strip()]
+    else:
+        traces = generate_traces(args.sessions, args.min_turns, args.max_turns, args.think, args.stream_ratio, args.seed)
+    if args.write_trace:
+        with open(args.write_trace, 'w') as f:
+            f.writelines(json.dumps(trace) + '\n' for trace in traces)
+
+    result = run(traces, args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"{result['requests']} requests in {result['elapsed_s']:.1f}s ({result['throughput_rps']:.1f} rps)")
+        print(f"{'endpoint':>16} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for endpoint, row in result['endpoints'].items():
+            print(f"{endpoint:>16} {row['requests']:>6} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['errors']:>7}")
+        print(f"context_cache grew {result['context_cache']['bytes_after'] - result['context_cache']['bytes_before']} bytes "
+              f"({result['context_cache']['bytes_per_session']:.0f} per session)")
+    else:
+        print(json.dumps(result, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            # Keep stdout parseable when the results themselves go there
+            out = sys.stdout if args.output else sys.stderr
+            regressions = compare(result, json.load(f), args.max_regression, out)
+        if regressions:
+            print(f"Regressions beyond {args.max_regression:.0%}: {', '.join(regressions)}", file=out)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
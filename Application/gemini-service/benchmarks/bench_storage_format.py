@@ -0,0 +1,157 @@
+"""Compare bytes stored and load latency of legacy JSON against the v1 storage format.
+
+Usage: python benchmarks/bench_storage_format.py [--sessions 300] [--shared-analyses 40] [--storage-latency 0.02] [--json]
+
+Builds sessions shaped like the service's own: a context holding the pinned
+analysis plus chat turns, and a saved session repeating the analysis and the
+chat. Analyses are drawn from --shared-analyses distinct texts, because the
+analysis cache hands the same text to every user asking the same question.
+Each format writes every session into its own FakeBucket. The benchmark then
+reports the bytes stored, the CPU time to decode a session, and the time to
+load one from storage. Loads are measured both cold, with a fresh reader that
+must fetch shared texts, and warm, with texts already cached.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time as time_module
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_store import DocumentStore  # noqa: E402
+from fakes import FakeBucket  # noqa: E402
+from storage_backend import GCSStorage  # noqa: E402
+
+WORDS = ("soil rainfall monsoon irrigation yield sowing harvest variety nitrogen phosphorus potassium drainage loam clay "
+         "temperature humidity pest blight rust aphid fungicide mulch seedling germination kharif rabi zaid acre hectare "
+         "tonnes recommended suitable conditions region season crop water weekly fertiliser organic compost manure "
+         "rotation intercropping pulses market price storage moisture frost heat tolerant early late maturing days the "
+         "a of and to in for with during is are should can may be it this that these from at on by as or").split()
+
+
+def prose(rng: random.Random, words: int) -> str:
+    sentences, count = [], 0
+    while count < words:
+        length = rng.randint(8, 20)
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(length))
+        sentences.append(sentence[0].upper() + sentence[1:] + '.')
+        count += length
+    return ' '.join(sentences)
+
+
+def build_sessions(count: int, shared_analyses: int, turns: int, seed: int):
+    rng = random.Random(seed)
+    analyses = [prose(rng, rng.randint(450, 800)) for _ in range(shared_analyses)]
+    sessions = []
+    now = time_module.time()
+    for i in range(count):
+        analysis = rng.choice(analyses)
+        prompt = f"Analyze the suitability of growing crop {i % 17} in region {i % 29} during season {i % 3}. " + prose(rng, 90)
+        context = [
+            {'role': 'human', 'content': prompt, 'timestamp': now, 'pinned': True},
+            {'role': 'ai', 'content': analysis, 'timestamp': now, 'pinned': True},
+        ]
+        chat = []
+        for _ in range(rng.randint(0, turns)):
+            question, answer = prose(rng, rng.randint(8, 25)), prose(rng, rng.randint(80, 300))
+            context += [{'role': 'human', 'content': question, 'timestamp': now}, {'role': 'ai', 'content': answer, 'timestamp': now}]
+            chat += [{'role': 'user', 'content': question}, {'role': 'assistant', 'content': answer}]
+        session = {'analysis_input': f"Can I grow crop {i % 17} in region {i % 29}?", 'analysis_result': {'crop_analysis': analysis}, 'chat_messages': chat, 'version': 0}
+        sessions.append((f"user-{i % 50}", f"session-{i}", context, session))
+    return sessions
+
+
+def blob_names(user_id: str, session_id: str):
+    return f"users/{user_id}/contexts/{session_id}.json", f"users/{user_id}/sessions/{session_id}/data.json"
+
+
+def measure(name: str, sessions, storage_latency: float, loads: int, **store_options):
+    bucket = FakeBucket(latency=0)
+    writer = DocumentStore(GCSStorage(bucket), **store_options)
+    for user_id, session_id, context, session in sessions:
+        context_name, session_name = blob_names(user_id, session_id)
+        writer.write(context_name, context)
+        writer.write(session_name, session)
+
+    stored = sum(len(data) for data in bucket.data.values())
+    text_blobs = sum(1 for blob_name in bucket.data if blob_name.startswith(writer.prefix))
+
+    # Pure decode cost, with every text already cached
+    decode_times = []
+    for user_id, session_id, _, _ in sessions[:loads]:
+        payloads = [bucket.data[blob_name] for blob_name in blob_names(user_id, session_id)]
+        start = time_module.perf_counter()
+        for payload in payloads:
+            writer.decode(payload)
+        decode_times.append(time_module.perf_counter() - start)
+
+    bucket.latency = storage_latency
+    results = {}
+    for mode in ('cold', 'warm'):
+        reader = DocumentStore(GCSStorage(bucket), **store_options)
+        if mode == 'warm':
+            for user_id, session_id, _, _ in sessions[:loads]:
+                reader.read(blob_names(user_id, session_id)[0])
+        times, round_trips = [], bucket.round_trips
+        for user_id, session_id, context, session in sessions[:loads]:
+            start = time_module.perf_counter()
+            loaded = [reader.read(blob_name) for blob_name in blob_names(user_id, session_id)]
+            times.append(time_module.perf_counter() - start)
+            assert loaded == [context, session], f"{name} did not round-trip {session_id}"
+        results[mode] = (statistics.median(times) * 1000, (bucket.round_trips - round_trips) / len(times))
+
+    return {
+        'format': name,
+        'bytes_stored': stored,
+        'bytes_per_session': stored / len(sessions),
+        'text_blobs': text_blobs,
+        'decode_ms': statistics.median(decode_times) * 1000,
+        'cold_load_ms': results['cold'][0],
+        'cold_round_trips': results['cold'][1],
+        'warm_load_ms': results['warm'][0],
+        'warm_round_trips': results['warm'][1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=300)
+    parser.add_argument('--shared-analyses', type=int, default=40)
+    parser.add_argument('--turns', type=int, default=5, help='most chat turns per session')
+    parser.add_argument('--storage-latency', type=float, default=0.02, help='seconds per storage round trip while loading')
+    parser.add_argument('--loads', type=int, default=100, help='sessions to time loading')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    sessions = build_sessions(args.sessions, args.shared_analyses, args.turns, args.seed)
+    variants = [
+        ('json (legacy)', {'format': 'json'}),
+        ('v1 none', {'compression': 'none'}),
+        ('v1 gzip, no dedupe', {'compression': 'gzip', 'dedupe_min_chars': 0}),
+        ('v1 gzip', {'compression': 'gzip'}),
+    ]
+    try:
+        import zstandard  # noqa: F401
+        variants.append(('v1 zstd', {'compression': 'zstd'}))
+    except ImportError:
+        print("zstandard is not installed; skipping zstd", file=sys.stderr)
+
+    loads = min(args.loads, len(sessions))
+    results = [measure(name, sessions, args.storage_latency, loads, **options) for name, options in variants]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    baseline = results[0]['bytes_stored']
+    print(f"{len(sessions)} sessions, {args.shared_analyses} distinct analyses, {args.storage_latency * 1000:.0f} ms per round trip")
+    print(f"{'format':>20} {'bytes':>10} {'vs json':>8} {'B/session':>10} {'decode ms':>10} {'cold ms':>8} {'trips':>6} {'warm ms':>8} {'trips':>6}")
+    for row in results:
+        print(f"{row['format']:>20} {row['bytes_stored']:>10} {row['bytes_stored'] / baseline:>8.0%} {row['bytes_per_session']:>10.0f} "
+              f"{row['decode_ms']:>10.3f} {row['cold_load_ms']:>8.1f} {row['cold_round_trips']:>6.2f} {row['warm_load_ms']:>8.1f} {row['warm_round_trips']:>6.2f}")
+
+
+if __name__ == '__main__':
+    main()
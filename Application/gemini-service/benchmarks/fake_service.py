@@ -0,0 +1,41 @@
+"""The gemini-service wired to fake Gemini, storage and QA backends.
+
+    gunicorn --chdir benchmarks --workers 1 --threads 8 fake_service:app
+    uvicorn --app-dir benchmarks fake_service:asgi_app
+
+Latencies are configured with FAKE_MODEL_LATENCY, FAKE_TOKENS_PER_SECOND,
+FAKE_RESPONSE_TOKENS, FAKE_STORAGE_LATENCY and FAKE_QA_LATENCY (seconds). The real QA model is
+never loaded; FakeExtractor answers in its place.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vertexai  # noqa: E402
+import vertexai.preview.generative_models  # noqa: E402
+
+import storage_backend  # noqa: E402
+from fakes import FakeBucket, FakeExtractor, FakeGenerativeModel  # noqa: E402
+
+fake_model = FakeGenerativeModel(
+    latency=float(os.getenv('FAKE_MODEL_LATENCY', 0.5)),
+    tokens_per_second=float(os.getenv('FAKE_TOKENS_PER_SECOND', 0)),
+    response_tokens=int(os.getenv('FAKE_RESPONSE_TOKENS', 200)),
+)
+fake_bucket = FakeBucket(latency=float(os.getenv('FAKE_STORAGE_LATENCY', 0.02)))
+
+# Swap the Google and Hugging Face entry points before main creates its clients
+os.environ.setdefault('PROJECT_ID', 'fake-project')
+os.environ.setdefault('LOCATION', 'us-central1')
+os.environ['QA_EAGER_LOAD'] = 'false'
+vertexai.init = lambda **kwargs: None
+vertexai.preview.generative_models.GenerativeModel = lambda *args, **kwargs: fake_model
+storage_backend.create_storage_backend = lambda *args, **kwargs: storage_backend.GCSStorage(fake_bucket)
+
+import main  # noqa: E402
+
+main.qa_batcher.extractor = FakeExtractor(latency=float(os.getenv('FAKE_QA_LATENCY', 0.01)))
+app = main.app
+
+from asgi import app as asgi_app  # noqa: E402
@@ -0,0 +1,202 @@
+"""In-process stand-ins for Google services, used by the benchmark scripts."""
+import asyncio
+import datetime
+import re
+import threading
+import time as time_module
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream: bool = False):
+        return self.model.generate_content(content, stream=stream)
+
+    async def send_message_async(self, content, stream: bool = False):
+        return await self.model.generate_content_async(content, stream=stream)
+
+
+class FakeGenerativeModel:
+    """Mimics GenerativeModel with a fixed round-trip latency plus a token generation rate."""
+
+    def __init__(self, latency: float = 0.05, tokens_per_second: float = 0, response_tokens: int = 200, chunk_tokens: int = 20):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.chunk_tokens = chunk_tokens
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    def _chunk_sizes(self):
+        remaining = self.response_tokens
+        while remaining > 0:
+            size = min(self.chunk_tokens, remaining)
+            remaining -= size
+            yield size
+
+    def _generation_time(self, tokens: int) -> float:
+        return tokens / self.tokens_per_second if self.tokens_per_second else 0
+
+    def _count_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def generate_content(self, contents, stream: bool = False):
+        self._count_call()
+        time_module.sleep(self.latency)
+        if stream:
+            return self._stream()
+        time_module.sleep(self._generation_time(self.response_tokens))
+        return FakeResponse(' '.join(['token'] * self.response_tokens))
+
+    def _stream(self):
+        for size in self._chunk_sizes():
+            time_module.sleep(self._generation_time(size))
+            yield FakeResponse(' '.join(['token'] * size) + ' ')
+
+    async def generate_content_async(self, contents, stream: bool = False):
+        self._count_call()
+        await asyncio.sleep(self.latency)
+        if stream:
+            return self._stream_async()
+        await asyncio.sleep(self._generation_time(self.response_tokens))
+        return FakeResponse(' '.join(['token'] * self.response_tokens))
+
+    async def _stream_async(self):
+        for size in self._chunk_sizes():
+            await asyncio.sleep(self._generation_time(size))
+            yield FakeResponse(' '.join(['token'] * size) + ' ')
+
+
+class FakeBlob:
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    @property
+    def time_created(self):
+        return self.bucket.created[self.name]
+
+    @property
+    def updated(self):
+        return self.bucket.updated[self.name]
+
+    @property
+    def size(self):
+        return len(self.bucket.data[self.name])
+
+    def exists(self) -> bool:
+        self.bucket.round_trip()
+        return self.name in self.bucket.data
+
+    def download_as_bytes(self, if_generation_match=None) -> bytes:
+        self.bucket.round_trip()
+        with self.bucket.lock:
+            if self.name not in self.bucket.data:
+                raise NotFound(self.name)
+            if if_generation_match is not None and self.bucket.generations[self.name] != if_generation_match:
+                raise PreconditionFailed(self.name)
+            return self.bucket.data[self.name]
+
+    def download_as_text(self) -> str:
+        return self.download_as_bytes().decode('utf-8')
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self.bucket.round_trip()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self.bucket.lock:
+            if if_generation_match is not None and self.bucket.generations.get(self.name, 0) != if_generation_match:
+                raise PreconditionFailed(self.name)
+            self.bucket.data[self.name] = data
+            self.bucket.next_generation += 1
+            self.bucket.generations[self.name] = self.bucket.next_generation
+            self.bucket.created.setdefault(self.name, now)
+            self.bucket.updated[self.name] = now
+
+    def delete(self, if_generation_match=None):
+        self.bucket.round_trip()
+        with self.bucket.lock:
+            if self.name not in self.bucket.data:
+                raise NotFound(self.name)
+            if if_generation_match is not None and self.bucket.generations[self.name] != if_generation_match:
+                raise PreconditionFailed(self.name)
+            del self.bucket.data[self.name]
+            del self.bucket.generations[self.name]
+            del self.bucket.created[self.name]
+            del self.bucket.updated[self.name]
+
+
+class FakeBucket:
+    """In-memory bucket that charges a fixed latency for every round-trip."""
+
+    def __init__(self, name: str = 'fake-bucket', latency: float = 0.02):
+        self.name = name
+        self.latency = latency
+        self.data = {}
+        self.created = {}
+        self.updated = {}
+        self.generations = {}
+        self.next_generation = 0
+        self.lock = threading.Lock()
+        self.round_trips = 0
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        time_module.sleep(self.latency)
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str):
+        self.round_trip()
+        with self.lock:
+            if name not in self.data:
+                return None
+            blob = FakeBlob(self, name)
+            blob.generation = self.generations[name]
+            return blob
+
+    def list_blobs(self, prefix: str = ''):
+        self.round_trip()
+        with self.lock:
+            names = sorted(name for name in self.data if name.startswith(prefix))
+        return [FakeBlob(self, name) for name in names]
+
+
+SENTENCE_PATTERN = re.compile(r'grow (?P<crop>[\w ]+?) in (?P<region>[\w ]+?)(?: during| in) (?P<time>[\w ]+)', re.IGNORECASE)
+
+
+class FakeExtractor:
+    """Pulls crop, region and time out of 'grow <crop> in <region> during <time>' sentences."""
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+
+    def extract(self, sentences):
+        from extraction import Extraction
+
+        time_module.sleep(self.latency)
+        results = []
+        for sentence in sentences:
+            match = SENTENCE_PATTERN.search(sentence)
+            if match:
+                results.append(Extraction(match['crop'], match['region'], match['time'], (1.0, 1.0, 1.0)))
+            else:
+                results.append(Extraction('', '', '', (0.0, 0.0, 0.0)))
+        return results
@@ -0,0 +1,32 @@
+from typing import Dict, Iterable, List
+
+from vertexai.preview.generative_models import Content, Part
+
+# Stored context roles mapped to the roles Gemini expects in a chat history; the rolling
+# summary of compacted turns is given to the model as user-supplied background
+ROLE_MAP = {'human': 'user', 'ai': 'model', 'summary': 'user'}
+
+
+def build_history(messages: Iterable[Dict]) -> List[Content]:
+    """Turn stored context messages into a Gemini chat history.
+
+    Gemini requires the history to start with a user turn, alternate between
+    user and model turns and end with a model turn, so consecutive messages
+    from the same role are merged and unanswered turns at either end dropped.
+    """
+    turns = []
+    for message in messages:
+        role = ROLE_MAP.get(message['role'])
+        if role is None:
+            continue
+        if not turns and role == 'model':
+            continue
+        if turns and turns[-1][0] == role:
+            turns[-1][1].append(message['content'])
+        else:
+            turns.append((role, [message['content']]))
+
+    if turns and turns[-1][0] == 'user':
+        turns.pop()
+
+    return [Content(role=role, parts=[Part.from_text('\n\n'.join(texts))]) for role, texts in turns]
@@ -0,0 +1,156 @@
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+from session_store import Message, SessionContext
+
+logger = logging.getLogger(__name__)
+
+# Gemini averages about four characters of English per token
+CHARS_PER_TOKEN = 4
+SUMMARY_ROLE = 'summary'
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+SUMMARY_PROMPT = """Summarize this conversation between a farmer and an agricultural advisor in at most {words} words.
+Keep every concrete fact, number, recommendation, decision and open question. Write it as plain prose.
+
+{previous}{transcript}"""
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+
+
+def message_tokens(message: Message) -> int:
+    """Token count of a stored message, computed once and kept on the message."""
+    if message.tokens is None:
+        message.tokens = estimate_tokens(message.content)
+    return message.tokens
+
+
+def uncompacted_tokens(message: Message) -> int:
+    """Tokens the message would cost had nothing been summarised."""
+    return message.covers or message_tokens(message)
+
+
+def model_summarizer(generate: Callable[[str], str], max_summary_tokens: int) -> Callable[[Optional[str], List[Message]], str]:
+    """Summarize older turns with the chat model itself; generate(prompt) returns the model's text."""
+    def summarize(previous: Optional[str], messages: List[Message]) -> str:
+        transcript = '\n\n'.join(f"{'Farmer' if message.role == 'human' else 'Advisor'}: {message.content}" for message in messages)
+        prompt = SUMMARY_PROMPT.format(
+            words=max_summary_tokens * 3 // 4,
+            previous=f"Summary so far: {previous}\n\n" if previous else '',
+            transcript=transcript,
+        )
+        return generate(prompt).strip()
+    return summarize
+
+
+def truncating_summarizer(max_summary_tokens: int) -> Callable[[Optional[str], List[Message]], str]:
+    """Fallback that keeps the opening of each turn when the model cannot be asked for a summary."""
+    def summarize(previous: Optional[str], messages: List[Message]) -> str:
+        per_message = max(1, max_summary_tokens * CHARS_PER_TOKEN // (len(messages) + bool(previous)))
+        parts = [previous[:per_message]] if previous else []
+        parts += [f"{message.role}: {message.content[:per_message]}" for message in messages]
+        return ' | '.join(parts)
+    return summarize
+
+
+class ContextCompactor:
+    """Keeps a session's context under a token budget by folding older turns into a rolling summary.
+
+    The original analysis exchange is pinned and always sent in full, and so
+    are the most recent turns. Once the context goes over max_tokens, or would
+    overflow the deque's maxlen, the turns in between are summarised together
+    with any earlier summary. The context is brought down to
+    target_ratio * max_tokens, so compaction happens every few turns rather
+    than on every one.
+    """
+
+    def __init__(self, max_tokens: int = 4000, keep_recent: int = 4, target_ratio: float = 0.6, max_summary_tokens: int = 300,
+                 summarize: Optional[Callable] = None):
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+        self.target_tokens = int(max_tokens * target_ratio)
+        self.max_summary_tokens = max_summary_tokens
+        self.summarize = summarize
+        self.fallback = truncating_summarizer(max_summary_tokens)
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.compactions = 0
+        self.summary_failures = 0
+        self.history_tokens = 0
+        self.tokens_saved = 0
+
+    def tokens(self, messages) -> int:
+        return sum(message_tokens(message) for message in messages)
+
+    def compact(self, context: SessionContext, incoming: int = 2) -> Dict:
+        """Compact the context in place if needed, making room for `incoming` more messages."""
+        messages = list(context)
+        before = self.tokens(messages)
+        usage = {'history_tokens': before, 'uncompacted_tokens': sum(uncompacted_tokens(message) for message in messages), 'compacted': False}
+        overflowing = context.maxlen is not None and len(messages) + incoming > context.maxlen
+        if before <= self.max_tokens and not overflowing:
+            return usage
+
+        pinned = [message for message in messages if message.pinned]
+        summaries = [message for message in messages if message.role == SUMMARY_ROLE]
+        turns = [message for message in messages if not message.pinned and message.role != SUMMARY_ROLE]
+
+        # Keep as many recent messages as fit the target, never splitting a human/ai pair
+        room = self.target_tokens - self.tokens(pinned) - self.max_summary_tokens
+        limit = None if context.maxlen is None else context.maxlen - incoming - len(pinned) - 1
+        recent = []
+        for message in reversed(turns[-self.keep_recent:] if self.keep_recent else []):
+            if (limit is not None and len(recent) >= limit) or message_tokens(message) > room:
+                break
+            room -= message_tokens(message)
+            recent.insert(0, message)
+        while recent and recent[0].role != 'human':
+            recent.pop(0)
+        old = turns[:len(turns) - len(recent)]
+        if not old and len(summaries) <= 1:
+            return usage
+
+        previous = '\n'.join(message.content[len(SUMMARY_PREFIX):] if message.content.startswith(SUMMARY_PREFIX) else message.content for message in summaries) or None
+        summary_text = self._summarize(previous, old) if old else previous
+        timestamp = (old or summaries)[-1].timestamp
+        covers = sum(uncompacted_tokens(message) for message in summaries + old)
+        summary = Message(SUMMARY_ROLE, SUMMARY_PREFIX + summary_text, timestamp, covers=covers)
+        context.replace(pinned + [summary] + recent)
+
+        usage['history_tokens'] = self.tokens(context)
+        usage['compacted'] = True
+        with self._lock:
+            self.compactions += 1
+        logger.info("Compacted context from %d to %d tokens (%d messages summarised)", before, usage['history_tokens'], len(old))
+        return usage
+
+    def _summarize(self, previous: Optional[str], messages: List[Message]) -> str:
+        if self.summarize is not None:
+            try:
+                return self.summarize(previous, messages)
+            except Exception:
+                with self._lock:
+                    self.summary_failures += 1
+                logger.exception("Summarising older turns failed; truncating them instead")
+        return self.fallback(previous, messages)
+
+    def record_turn(self, usage: Dict):
+        with self._lock:
+            self.turns += 1
+            self.history_tokens += usage['history_tokens']
+            self.tokens_saved += usage['uncompacted_tokens'] - usage['history_tokens']
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'max_tokens': self.max_tokens,
+                'turns': self.turns,
+                'compactions': self.compactions,
+                'summary_failures': self.summary_failures,
+                'history_tokens': self.history_tokens,
+                'tokens_saved': self.tokens_saved,
+                'avg_history_tokens': self.history_tokens / self.turns if self.turns else 0.0,
+            }
@@ -0,0 +1,321 @@
+"""Versioned, compressed storage format for contexts and saved sessions.
+
+A stored document is
+
+    b'AGP' | format version (1 byte) | codec (1 byte) | payload
+
+where the payload is compact JSON {"doc": ..., "refs": [...]}, compressed
+with the codec. Strings of at least dedupe_min_chars characters, in practice
+analyses and long answers, are moved into content-addressed blobs under
+blobs/sha256/ and replaced by {"$ref": "<sha256>"}. An analysis that sits in
+a context, in its saved session and in other users' sessions is therefore
+stored once. Blobs without the magic prefix are read as the legacy JSON format.
+
+To convert existing JSON blobs in place:
+
+    python document_store.py migrate [--prefix users/] [--min-age 3600] [--dry-run]
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time as time_module
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'AGP'
+FORMAT_VERSION = 1
+HEADER_SIZE = len(MAGIC) + 2
+CODECS = {'none': b'n', 'gzip': b'g', 'zstd': b'z'}
+FORMATS = ('v1', 'json')
+# Documents smaller than this gain nothing from compression
+MIN_COMPRESS_BYTES = 256
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+
+
+class DocumentStore:
+    """Reads and writes JSON documents in the versioned format, through the write-behind queue when there is one.
+
+    Writes use format='v1' unless format='json', which keeps writing legacy
+    JSON, e.g. while older instances that cannot read v1 are still serving.
+    Reads accept both formats either way.
+
+    A text is only skipped on write if this store uploaded it within the last
+    reuse_window seconds; after that it is uploaded again. A text blob that
+    is still being referenced therefore never looks older than reuse_window,
+    which is what lets the retention sweeper delete unreferenced ones safely.
+    """
+
+    def __init__(self, storage, writer=None, format: str = 'v1', compression: str = 'gzip', level: Optional[int] = None,
+                 dedupe_min_chars: int = 1024, prefix: str = 'blobs/sha256', max_cached_texts: int = 1024, reuse_window: float = 3600):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown storage format {format!r}, expected one of {FORMATS}")
+        if compression not in CODECS:
+            raise ValueError(f"Unknown storage compression {compression!r}, expected one of {tuple(CODECS)}")
+        self.storage = storage
+        self.writer = writer
+        self.format = format
+        self.compression = compression
+        self.dedupe_min_chars = dedupe_min_chars
+        self.prefix = prefix
+        self.max_cached_texts = max_cached_texts
+        self.reuse_window = reuse_window
+        self._zstd_compressor = self._zstd_decompressor = None
+        if compression == 'zstd':
+            self._zstd_compressor, self._zstd_decompressor = _zstd_codecs(level or 3)
+        self.level = level if level is not None else 6
+        self._texts = OrderedDict()  # sha256 -> text, for texts known to be stored or queued
+        self._uploaded = OrderedDict()  # sha256 -> when this store last uploaded or queued it
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.reads = 0
+        self.legacy_reads = 0
+        self.texts_deduped = 0
+        self.texts_written = 0
+
+    def text_name(self, digest: str) -> str:
+        return f"{self.prefix}/{digest}"
+
+    def _compress(self, raw: bytes) -> bytes:
+        if len(raw) < MIN_COMPRESS_BYTES or self.compression == 'none':
+            return CODECS['none'] + raw
+        if self.compression == 'zstd':
+            return CODECS['zstd'] + self._zstd_compressor.compress(raw)
+        return CODECS['gzip'] + gzip.compress(raw, compresslevel=self.level, mtime=0)
+
+    def _decompress(self, codec: bytes, payload: bytes) -> bytes:
+        if codec == CODECS['none']:
+            return payload
+        if codec == CODECS['gzip']:
+            return gzip.decompress(payload)
+        if codec == CODECS['zstd']:
+            if self._zstd_decompressor is None:
+                self._zstd_compressor, self._zstd_decompressor = _zstd_codecs(3)
+            return self._zstd_decompressor.decompress(payload)
+        raise ValueError(f"Unknown codec {codec!r}")
+
+    def pack(self, raw: bytes) -> bytes:
+        return MAGIC + bytes([FORMAT_VERSION]) + self._compress(raw)
+
+    def unpack(self, data: bytes) -> bytes:
+        version = data[len(MAGIC)]
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported storage format version {version}")
+        return self._decompress(data[len(MAGIC) + 1:HEADER_SIZE], data[HEADER_SIZE:])
+
+    @staticmethod
+    def is_packed(data: Union[str, bytes]) -> bool:
+        return isinstance(data, bytes) and data.startswith(MAGIC)
+
+    def _extract_texts(self, value: Any, texts: Dict[str, str]) -> Any:
+        if isinstance(value, str):
+            if self.dedupe_min_chars and len(value) >= self.dedupe_min_chars:
+                digest = hashlib.sha256(value.encode('utf-8')).hexdigest()
+                texts[digest] = value
+                return {'$ref': digest}
+            return value
+        if isinstance(value, dict):
+            return {key: self._extract_texts(item, texts) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._extract_texts(item, texts) for item in value]
+        return value
+
+    def _insert_texts(self, value: Any, texts: Dict[str, str]) -> Any:
+        if isinstance(value, dict):
+            if len(value) == 1 and value.get('$ref') in texts:
+                return texts[value['$ref']]
+            return {key: self._insert_texts(item, texts) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._insert_texts(item, texts) for item in value]
+        return value
+
+    def encode(self, document: Any) -> Tuple[bytes, Dict[str, str]]:
+        """Return the stored bytes for a document and the {sha256: text} blobs it references."""
+        texts = {}
+        doc = self._extract_texts(document, texts)
+        raw = json.dumps({'doc': doc, 'refs': sorted(texts)}, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        return self.pack(raw), texts
+
+    def _remember_texts(self, texts: Dict[str, str], uploaded: Optional[float] = None):
+        with self._lock:
+            for digest, text in texts.items():
+                self._texts[digest] = text
+                self._texts.move_to_end(digest)
+                if uploaded is not None:
+                    self._uploaded[digest] = uploaded
+                    self._uploaded.move_to_end(digest)
+            while len(self._texts) > self.max_cached_texts:
+                self._texts.popitem(last=False)
+            while len(self._uploaded) > self.max_cached_texts:
+                self._uploaded.popitem(last=False)
+
+    def references(self, data: Union[str, bytes]) -> List[str]:
+        """Digests of the text blobs a stored document points at, without fetching them."""
+        return json.loads(self.unpack(data))['refs'] if self.is_packed(data) else []
+
+    def write(self, name: str, document: Any, if_absent: bool = False) -> bool:
+        """Store a document. Without if_absent it goes through the write-behind queue, if any.
+
+        Referenced text blobs are written first: queued ahead of the document,
+        or uploaded before it when the document is written directly.
+        """
+        if self.format == 'json':
+            data, texts, content_type = json.dumps(document), {}, 'application/json'
+        else:
+            data, texts, content_type = *self.encode(document), BINARY_CONTENT_TYPE
+        now = time_module.time()
+        with self._lock:
+            new_texts = {digest: text for digest, text in texts.items() if now - self._uploaded.get(digest, float('-inf')) > self.reuse_window}
+            self.writes += 1
+            self.texts_deduped += len(texts) - len(new_texts)
+            self.texts_written += len(new_texts)
+        text_blobs = [(self.text_name(digest), self.pack(text.encode('utf-8')), BINARY_CONTENT_TYPE) for digest, text in new_texts.items()]
+
+        if self.writer is None or if_absent:
+            self.storage.put_many(text_blobs)
+            written = self.storage.put(name, data, content_type=content_type, if_absent=if_absent)
+        else:
+            # Queued ahead, so the texts reach storage before the document that points at them
+            for text_name, text_data, text_type in text_blobs:
+                self.writer.put(text_name, text_data, content_type=text_type, ahead=True)
+            self.writer.put(name, data, content_type=content_type)
+            written = True
+        self._remember_texts(new_texts, uploaded=now)
+        self._remember_texts(texts)
+        return written
+
+    def read(self, name: str) -> Optional[Any]:
+        """Load a document, seeing writes still waiting in the write-behind queue."""
+        pending, data = self.writer.pending(name) if self.writer is not None else (False, None)
+        if not pending:
+            data = self.storage.get(name)
+        return None if data is None else self.decode(data, name)
+
+    def decode(self, data: Union[str, bytes], name: str = '') -> Any:
+        with self._lock:
+            self.reads += 1
+        if not self.is_packed(data):
+            with self._lock:
+                self.legacy_reads += 1
+            return json.loads(data)
+        envelope = json.loads(self.unpack(data))
+        if not envelope['refs']:
+            return envelope['doc']
+        return self._insert_texts(envelope['doc'], self._load_texts(envelope['refs'], name))
+
+    def _load_texts(self, digests: List[str], name: str) -> Dict[str, str]:
+        with self._lock:
+            texts = {digest: self._texts[digest] for digest in digests if digest in self._texts}
+        missing = [digest for digest in digests if digest not in texts]
+        if self.writer is not None:
+            for digest in list(missing):
+                pending, data = self.writer.pending(self.text_name(digest))
+                if pending and data is not None:
+                    texts[digest] = self.unpack(data).decode('utf-8')
+                    missing.remove(digest)
+        if missing:
+            fetched = self.storage.get_many(self.text_name(digest) for digest in missing)
+            for digest in missing:
+                data = fetched[self.text_name(digest)]
+                if data is None:
+                    raise LookupError(f"{name or 'Document'} references text blob {digest}, which does not exist")
+                texts[digest] = self.unpack(data).decode('utf-8')
+        self._remember_texts(texts)
+        return texts
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'format': self.format,
+                'compression': self.compression,
+                'writes': self.writes,
+                'reads': self.reads,
+                'legacy_reads': self.legacy_reads,
+                'texts_deduped': self.texts_deduped,
+                'texts_written': self.texts_written,
+                'cached_texts': len(self._texts),
+            }
+
+
+def _zstd_codecs(level: int):
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd compression needs the zstandard package installed") from None
+    return zstandard.ZstdCompressor(level=level), zstandard.ZstdDecompressor()
+
+
+def should_migrate(name: str) -> bool:
+    """Contexts, session snapshots and session log entries; the per-user session index stays JSON."""
+    return '/contexts/' in name or '/log/' in name or name.endswith('/data.json')
+
+
+def migrate(documents: DocumentStore, prefix: str = 'users/', min_age: float = 3600, dry_run: bool = False) -> Dict:
+    """Rewrite legacy JSON contexts and sessions under prefix in the v1 format.
+
+    Blobs updated within the last min_age seconds are skipped: a live
+    instance may still be writing them, and rewriting could undo its write.
+    Run it again later to pick them up.
+    """
+    counts = {'scanned': 0, 'migrated': 0, 'already_migrated': 0, 'skipped_recent': 0, 'failed': 0, 'bytes_before': 0, 'bytes_after': 0}
+    cutoff = time_module.time() - min_age
+    written_texts = set()
+    for blob in documents.storage.list(prefix):
+        if not should_migrate(blob.name):
+            continue
+        counts['scanned'] += 1
+        if blob.updated.timestamp() > cutoff:
+            counts['skipped_recent'] += 1
+            continue
+        data = documents.storage.get(blob.name)
+        if data is None:
+            continue
+        if documents.is_packed(data):
+            counts['already_migrated'] += 1
+            continue
+        try:
+            document = json.loads(data)
+            encoded, texts = documents.encode(document)
+            text_blobs = [(documents.text_name(digest), documents.pack(text.encode('utf-8')), BINARY_CONTENT_TYPE)
+                          for digest, text in texts.items() if digest not in written_texts]
+            counts['bytes_before'] += len(data)
+            counts['bytes_after'] += len(encoded) + sum(len(text_data) for _, text_data, _ in text_blobs)
+            if not dry_run:
+                documents.storage.put_many(text_blobs)
+                documents.storage.put(blob.name, encoded, content_type=BINARY_CONTENT_TYPE)
+            written_texts.update(texts)
+            counts['migrated'] += 1
+        except Exception:
+            counts['failed'] += 1
+            logger.exception("Migrating %s failed", blob.name)
+    return counts
+
+
+def main():
+    from storage_backend import add_storage_arguments, storage_from_args
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='rewrite legacy JSON contexts and sessions in the v1 format')
+    add_storage_arguments(migrate_parser)
+    migrate_parser.add_argument('--prefix', default='users/')
+    migrate_parser.add_argument('--min-age', type=float, default=3600, help='skip blobs updated more recently than this many seconds')
+    migrate_parser.add_argument('--compression', default=os.getenv('STORAGE_COMPRESSION', 'gzip'), choices=tuple(CODECS))
+    migrate_parser.add_argument('--dedupe-min-chars', type=int, default=int(os.getenv('STORAGE_DEDUPE_MIN_CHARS', 1024)))
+    migrate_parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'migrate':
+        storage = storage_from_args(migrate_parser, args)
+        documents = DocumentStore(storage, compression=args.compression, dedupe_min_chars=args.dedupe_min_chars)
+        print(json.dumps(migrate(documents, args.prefix, args.min_age, args.dry_run), indent=2))
+
+
+if __name__ == '__main__':
+    main()
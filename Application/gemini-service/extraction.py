@@ -0,0 +1,142 @@
+import threading
+import time as time_module
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+CROP_QUESTION = "What crop is mentioned in the sentence? Just return the crop name, not a sentence, return nothing if answer cannot be found"
+REGION_QUESTION = "Which region is mentioned in the sentence? Just return the region name, not a sentence, return nothing if answer cannot be found"
+TIME_QUESTION = "What season or month is mentioned in the sentence? Just return the season or month name, not a sentence, nothing"
+QUESTIONS = (CROP_QUESTION, REGION_QUESTION, TIME_QUESTION)
+
+
+class Extraction(NamedTuple):
+    crop: str
+    region: str
+    time: str
+    scores: Tuple[float, float, float]
+
+    def as_tuple(self) -> Tuple[str, str, str]:
+        return self.crop, self.region, self.time
+
+
+def _best_span(start_logits: np.ndarray, end_logits: np.ndarray, p_mask: np.ndarray, max_answer_len: int) -> Tuple[int, int, float]:
+    """Pick the highest scoring (start, end) span, scored the same way the QA pipeline scores it."""
+    start_logits = np.where(p_mask, -10000.0, start_logits)
+    end_logits = np.where(p_mask, -10000.0, end_logits)
+    start_probs = np.exp(start_logits - start_logits.max())
+    start_probs /= start_probs.sum()
+    end_probs = np.exp(end_logits - end_logits.max())
+    end_probs /= end_probs.sum()
+
+    # Only spans with start <= end < start + max_answer_len are candidates
+    candidates = np.tril(np.triu(np.outer(start_probs, end_probs)), max_answer_len - 1)
+    start, end = np.unravel_index(np.argmax(candidates), candidates.shape)
+    return int(start), int(end), float(candidates[start, end])
+
+
+class BatchedQAExtractor:
+    """Answers the crop, region and time questions for many sentences in a single forward pass."""
+
+    def __init__(self, qa_pipeline, max_answer_len: int = 15, max_seq_len: int = 384):
+        self.tokenizer = qa_pipeline.tokenizer
+        self.model = qa_pipeline.model
+        self.device = getattr(qa_pipeline, 'device', 'cpu')
+        self.max_answer_len = max_answer_len
+        self.max_seq_len = max_seq_len
+
+    def extract(self, sentences: List[str]) -> List[Extraction]:
+        # Imported here so importing this module (and the gazetteer) does not pull in torch
+        import torch
+
+        if not sentences:
+            return []
+
+        # One row per (sentence, question) pair, tokenized in a single call
+        questions = [question for _ in sentences for question in QUESTIONS]
+        contexts = [sentence for sentence in sentences for _ in QUESTIONS]
+        encoded = self.tokenizer(
+            questions,
+            contexts,
+            padding=True,
+            truncation='only_second',
+            max_length=self.max_seq_len,
+            return_offsets_mapping=True,
+            return_tensors='pt',
+        )
+        offsets = encoded['offset_mapping'].tolist()
+        inputs = {name: encoded[name].to(self.device) for name in self.tokenizer.model_input_names if name in encoded}
+
+        with torch.inference_mode():
+            outputs = self.model(**inputs)
+        start_logits = outputs.start_logits.float().cpu().numpy()
+        end_logits = outputs.end_logits.float().cpu().numpy()
+
+        answers = []
+        for row, context in enumerate(contexts):
+            # Only tokens belonging to the sentence itself may be part of an answer
+            p_mask = np.array([sequence_id != 1 for sequence_id in encoded.sequence_ids(row)])
+            start, end, score = _best_span(start_logits[row], end_logits[row], p_mask, self.max_answer_len)
+            answer = context[offsets[row][start][0]:offsets[row][end][1]].strip()
+            answers.append((answer, score))
+
+        extractions = []
+        for i in range(0, len(answers), len(QUESTIONS)):
+            (crop, crop_score), (region, region_score), (time, time_score) = answers[i:i + len(QUESTIONS)]
+            extractions.append(Extraction(crop, region, time, (crop_score, region_score, time_score)))
+        return extractions
+
+
+class MicroBatcher:
+    """Collects sentences from concurrent requests and runs them through the extractor together."""
+
+    def __init__(self, extractor: BatchedQAExtractor, max_batch_size: int = 16, max_wait_ms: float = 5):
+        self.extractor = extractor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, sentence: str) -> Extraction:
+        return self.extract([sentence])[0]
+
+    def extract(self, sentences: List[str]) -> List[Extraction]:
+        """Queue the sentences alongside other requests' and wait for all of their results."""
+        futures = []
+        for sentence in sentences:
+            future = Future()
+            self._queue.put((sentence, future))
+            futures.append(future)
+        self._ensure_worker()
+        return [future.result() for future in futures]
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='qa-micro-batcher', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time_module.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time_module.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            try:
+                results = self.extractor.extract([sentence for sentence, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
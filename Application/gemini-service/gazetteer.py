@@ -0,0 +1,371 @@
+import re
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from extraction import Extraction
+from result_cache import CROP_SYNONYMS, SEASON_SYNONYMS
+
+CROPS = (
+    # Cereals and millets
+    'rice', 'paddy', 'basmati', 'wheat', 'durum wheat', 'maize', 'corn', 'sweet corn', 'baby corn', 'barley', 'oats',
+    'sorghum', 'jowar', 'pearl millet', 'bajra', 'finger millet', 'ragi', 'foxtail millet', 'kodo millet',
+    'little millet', 'proso millet', 'barnyard millet', 'millet', 'millets', 'quinoa', 'buckwheat', 'amaranth',
+    # Pulses
+    'chickpea', 'chana', 'bengal gram', 'pigeon pea', 'arhar', 'tur', 'toor', 'red gram', 'green gram', 'moong',
+    'mung bean', 'black gram', 'urad', 'lentil', 'masoor', 'field pea', 'cowpea', 'lobia', 'horse gram', 'kulthi',
+    'moth bean', 'rajma', 'kidney bean', 'soybean', 'soyabean', 'lathyrus', 'khesari',
+    # Oilseeds
+    'groundnut', 'peanut', 'mustard', 'sarson', 'rapeseed', 'canola', 'sunflower', 'sesame', 'safflower',
+    'linseed', 'flax', 'castor', 'niger', 'oil palm', 'coconut',
+    # Fibres and cash crops
+    'cotton', 'jute', 'mesta', 'sunn hemp', 'sugarcane', 'sugar beet', 'tobacco', 'rubber', 'tea', 'coffee',
+    'cocoa', 'arecanut', 'areca nut', 'cashew', 'cashew nut', 'betel vine',
+    # Vegetables
+    'potato', 'tomato', 'onion', 'garlic', 'brinjal', 'eggplant', 'cabbage', 'cauliflower', 'broccoli', 'okra',
+    'bhindi', 'lady finger', 'chilli', 'chili', 'capsicum', 'bell pepper', 'carrot', 'radish', 'beetroot', 'turnip',
+    'spinach', 'palak', 'fenugreek', 'methi', 'coriander', 'cucumber', 'pumpkin', 'bottle gourd', 'bitter gourd',
+    'ridge gourd', 'sponge gourd', 'snake gourd', 'ash gourd', 'pointed gourd', 'tinda', 'watermelon', 'muskmelon',
+    'sweet potato', 'tapioca', 'cassava', 'yam', 'elephant foot yam', 'colocasia', 'arbi', 'french bean', 'peas',
+    'green peas', 'cluster bean', 'guar', 'drumstick', 'moringa', 'lettuce', 'knol khol', 'mushroom', 'leek',
+    'celery', 'asparagus', 'zucchini',
+    # Fruits
+    'mango', 'banana', 'plantain', 'guava', 'papaya', 'pineapple', 'orange', 'mandarin', 'sweet orange', 'mosambi',
+    'kinnow', 'lemon', 'lime', 'grapes', 'grape', 'pomegranate', 'apple', 'pear', 'peach', 'plum', 'apricot',
+    'cherry', 'strawberry', 'litchi', 'lychee', 'jackfruit', 'sapota', 'chikoo', 'custard apple', 'aonla', 'amla',
+    'ber', 'jamun', 'fig', 'dragon fruit', 'kiwi', 'avocado', 'walnut', 'almond', 'date palm',
+    # Spices and plantation crops
+    'turmeric', 'ginger', 'black pepper', 'cardamom', 'large cardamom', 'clove', 'cinnamon', 'nutmeg', 'cumin',
+    'jeera', 'fennel', 'saunf', 'ajwain', 'vanilla', 'saffron', 'isabgol', 'psyllium', 'stevia', 'aloe vera',
+    'mentha', 'mint', 'lemongrass', 'ashwagandha', 'tulsi',
+    # Fodder and flowers
+    'berseem', 'lucerne', 'alfalfa', 'napier grass', 'fodder maize', 'oat fodder', 'marigold',
+    'jasmine', 'tuberose', 'gladiolus', 'chrysanthemum', 'gerbera', 'orchid', 'mulberry',
+)
+
+STATES = (
+    'Andhra Pradesh', 'Arunachal Pradesh', 'Assam', 'Bihar', 'Chhattisgarh', 'Goa', 'Gujarat', 'Haryana',
+    'Himachal Pradesh', 'Jharkhand', 'Karnataka', 'Kerala', 'Madhya Pradesh', 'Maharashtra', 'Manipur',
+    'Meghalaya', 'Mizoram', 'Nagaland', 'Odisha', 'Punjab', 'Rajasthan', 'Sikkim', 'Tamil Nadu', 'Telangana',
+    'Tripura', 'Uttar Pradesh', 'Uttarakhand', 'West Bengal',
+    # Union territories
+    'Andaman and Nicobar Islands', 'Chandigarh', 'Dadra and Nagar Haveli', 'Daman and Diu', 'Delhi',
+    'Jammu and Kashmir', 'Ladakh', 'Lakshadweep', 'Puducherry',
+)
+
+REGION_ALIASES = {
+    'orissa': 'Odisha', 'uttaranchal': 'Uttarakhand', 'pondicherry': 'Puducherry', 'new delhi': 'Delhi',
+    'kashmir': 'Jammu and Kashmir', 'jammu': 'Jammu and Kashmir', 'bengal': 'West Bengal',
+    'tamilnadu': 'Tamil Nadu',
+}
+
+# Abbreviations are only recognised when written in capitals, so "grow up" is not Uttar Pradesh
+REGION_ABBREVIATIONS = {
+    'AP': 'Andhra Pradesh', 'UP': 'Uttar Pradesh', 'MP': 'Madhya Pradesh', 'HP': 'Himachal Pradesh',
+    'TN': 'Tamil Nadu', 'WB': 'West Bengal', 'J&K': 'Jammu and Kashmir', 'JK': 'Jammu and Kashmir',
+}
+
+DISTRICTS = (
+    # Major agricultural districts and regions
+    'Ludhiana', 'Amritsar', 'Bathinda', 'Patiala', 'Jalandhar', 'Sangrur', 'Ferozepur', 'Moga', 'Karnal',
+    'Kurukshetra', 'Hisar', 'Sirsa', 'Panipat', 'Ambala', 'Meerut', 'Muzaffarnagar', 'Saharanpur', 'Bareilly',
+    'Lucknow', 'Kanpur', 'Agra', 'Aligarh', 'Varanasi', 'Gorakhpur', 'Allahabad', 'Prayagraj', 'Jhansi',
+    'Shahjahanpur', 'Lakhimpur Kheri', 'Indore', 'Bhopal', 'Ujjain', 'Jabalpur', 'Gwalior', 'Hoshangabad',
+    'Vidisha', 'Sehore', 'Dewas', 'Malwa', 'Jaipur', 'Jodhpur', 'Bikaner', 'Kota', 'Udaipur', 'Ajmer',
+    'Sri Ganganagar', 'Alwar', 'Bharatpur', 'Nagaur', 'Ahmedabad', 'Rajkot', 'Junagadh', 'Amreli', 'Bhavnagar',
+    'Anand', 'Surat', 'Vadodara', 'Banaskantha', 'Mehsana', 'Kutch', 'Saurashtra', 'Nashik', 'Pune', 'Nagpur',
+    'Aurangabad', 'Jalgaon', 'Ahmednagar', 'Solapur', 'Kolhapur', 'Sangli', 'Satara', 'Latur', 'Amravati',
+    'Akola', 'Yavatmal', 'Vidarbha', 'Marathwada', 'Konkan', 'Ratnagiri', 'Belgaum', 'Belagavi', 'Dharwad',
+    'Mysore', 'Mysuru', 'Mandya', 'Hassan', 'Shimoga', 'Shivamogga', 'Davangere', 'Raichur', 'Bellary',
+    'Ballari', 'Gulbarga', 'Kalaburagi', 'Bijapur', 'Vijayapura', 'Chikmagalur', 'Kodagu', 'Coorg', 'Bangalore',
+    'Bengaluru', 'Coimbatore', 'Erode', 'Salem', 'Madurai', 'Thanjavur', 'Tiruchirappalli', 'Trichy',
+    'Tirunelveli', 'Dindigul', 'Theni', 'Nilgiris', 'Ooty', 'Chennai', 'Cauvery Delta', 'Guntur', 'Krishna',
+    'East Godavari', 'West Godavari', 'Godavari', 'Kurnool', 'Anantapur', 'Chittoor', 'Nellore', 'Prakasam',
+    'Visakhapatnam', 'Warangal', 'Karimnagar', 'Nizamabad', 'Khammam', 'Nalgonda', 'Hyderabad', 'Thrissur',
+    'Palakkad', 'Wayanad', 'Idukki', 'Kottayam', 'Alappuzha', 'Kuttanad', 'Malappuram', 'Kozhikode',
+    'Ernakulam', 'Cuttack', 'Sambalpur', 'Koraput', 'Ganjam', 'Balasore', 'Bargarh', 'Bardhaman', 'Burdwan',
+    'Hooghly', 'Nadia', 'Murshidabad', 'Darjeeling', 'Jalpaiguri', 'Malda', 'Purnia', 'Bhagalpur', 'Muzaffarpur',
+    'Patna', 'Gaya', 'Darbhanga', 'Ranchi', 'Hazaribagh', 'Raipur', 'Durg', 'Bilaspur', 'Bastar', 'Dehradun',
+    'Haridwar', 'Nainital', 'Udham Singh Nagar', 'Shimla', 'Kullu', 'Kangra', 'Solan', 'Srinagar', 'Anantnag',
+    'Baramulla', 'Leh', 'Guwahati', 'Jorhat', 'Dibrugarh', 'Nagaon', 'Imphal', 'Shillong', 'Agartala', 'Gangtok',
+    'Kohima', 'Aizawl', 'Itanagar', 'Indo-Gangetic Plains', 'Deccan', 'Terai', 'Bundelkhand', 'Western Ghats',
+)
+
+TIME_TERMS = (
+    'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november',
+    'december', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+    'kharif', 'rabi', 'zaid', 'khareef', 'rabbi', 'zayed', 'monsoon', 'pre-monsoon', 'post-monsoon', 'winter',
+    'summer', 'spring', 'autumn', 'rainy', 'dry season', 'wet season', 'rainy season',
+)
+
+# Time terms that are also ordinary words only count after a word that introduces a time ("in may")
+AMBIGUOUS_TIME_TERMS = {'may', 'mar', 'jan', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec', 'spring'}
+TIME_CUES = {
+    'in', 'during', 'by', 'from', 'to', 'until', 'till', 'through', 'of', 'early', 'late', 'mid', 'before',
+    'after', 'around', 'this', 'next', 'last', 'and', 'or', 'between', 'since', 'end', 'start', 'beginning',
+}
+
+# Words close enough to a vocabulary entry to be "corrected" into it, but which mean something else
+NEVER_CORRECT = {
+    'planting', 'planted', 'plants', 'growing', 'grower', 'season', 'seasons', 'sowing', 'harvest', 'harvesting',
+    'crops', 'region', 'regions', 'state', 'states', 'district', 'which', 'where', 'there', 'these', 'those',
+    'their', 'should', 'would', 'could', 'about', 'water', 'yield', 'yields', 'better', 'suitable', 'weather',
+    'months', 'month', 'grains', 'plain', 'plains', 'price', 'prices',
+}
+
+# Only a region name may separate two region mentions for them to be read as one place ("Ludhiana, Punjab")
+REGION_JOINERS = {'in', 'district', 'of', 'state', 'region', 'near', 'area'}
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z][A-Za-z&'-]*")
+SLOTS = ('crop', 'region', 'time')
+
+
+class Term(NamedTuple):
+    slot: str
+    value: str
+
+
+class Match(NamedTuple):
+    slot: str
+    value: str
+    start: int  # token index
+    end: int  # token index, exclusive
+    fuzzy: bool
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Damerau-Levenshtein distance (adjacent transpositions count as one edit), capped at limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_previous, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def _deletes(word: str, distance: int) -> Set[str]:
+    """Every string reachable from word by deleting up to distance characters."""
+    results = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {candidate[:i] + candidate[i + 1:] for candidate in frontier for i in range(len(candidate))}
+        results |= frontier
+    return results
+
+
+class Gazetteer:
+    """Finds known crops, regions and times in a sentence without running a model.
+
+    Vocabulary entries are stored in a trie keyed by lower-cased tokens, so a
+    single left-to-right pass finds the longest entry starting at each token,
+    including multi-word names such as "Tamil Nadu" or "bengal gram".
+    Misspelt words are corrected into vocabulary tokens first, using a
+    deletion index (the SymSpell approach), so "Punjb", "Maharastra" and
+    "tomatoes" still match.
+    """
+
+    def __init__(self, terms: Iterable[Tuple[str, str, str]], case_sensitive: Dict[str, Term] = None):
+        self._trie = {}
+        self._vocabulary = set()
+        for slot, surface, value in terms:
+            node = self._trie
+            for token in self._tokens(surface):
+                node = node.setdefault(token, {})
+                self._vocabulary.add(token)
+            node[None] = Term(slot, value)
+        self._case_sensitive = case_sensitive or {}
+
+        self._deletion_index = {}
+        for token in self._vocabulary:
+            if len(token) >= 5:
+                for deleted in _deletes(token, self._max_distance(token)):
+                    self._deletion_index.setdefault(deleted, set()).add(token)
+        self._corrections = {}
+        self._corrections_lock = threading.Lock()
+
+    @classmethod
+    def default(cls) -> 'Gazetteer':
+        terms = [('crop', crop, crop) for crop in CROPS]
+        terms += [('crop', alias, alias) for alias in CROP_SYNONYMS]
+        terms += [('region', name, name) for name in STATES + DISTRICTS]
+        terms += [('region', alias, name) for alias, name in REGION_ALIASES.items()]
+        terms += [('time', term, term) for term in TIME_TERMS]
+        terms += [('time', term, term) for term in SEASON_SYNONYMS]
+        case_sensitive = {abbreviation: Term('region', name) for abbreviation, name in REGION_ABBREVIATIONS.items()}
+        return cls(terms, case_sensitive)
+
+    @staticmethod
+    def _tokens(text: str) -> List[str]:
+        return [token.lower().strip("'") for token in TOKEN_PATTERN.findall(text)]
+
+    @staticmethod
+    def _max_distance(token: str) -> int:
+        return 1 if len(token) < 9 else 2
+
+    def _correct(self, token: str) -> Optional[str]:
+        """Return the single closest vocabulary token for a misspelt word, if there is one."""
+        if token in self._vocabulary or len(token) < 4 or token in NEVER_CORRECT:
+            return None
+        for suffix in ('es', 's'):
+            if token.endswith(suffix) and token[:-len(suffix)] in self._vocabulary:
+                return token[:-len(suffix)]
+        if len(token) < 5:
+            return None
+        with self._corrections_lock:
+            if token in self._corrections:
+                return self._corrections[token]
+
+        limit = self._max_distance(token)
+        candidates = set()
+        for deleted in _deletes(token, limit):
+            candidates |= self._deletion_index.get(deleted, set())
+        scored = sorted((_edit_distance(token, candidate, limit), candidate) for candidate in candidates)
+        scored = [(distance, candidate) for distance, candidate in scored if distance <= limit]
+        # Two equally close vocabulary words means we cannot tell which one was meant
+        best = None
+        if scored and (len(scored) == 1 or scored[0][0] < scored[1][0]):
+            best = scored[0][1]
+
+        with self._corrections_lock:
+            if len(self._corrections) < 100000:
+                self._corrections[token] = best
+        return best
+
+    def find(self, sentence: str) -> List[Match]:
+        """Return every vocabulary entry in the sentence, longest match first at each position."""
+        originals = [token.strip("'") for token in TOKEN_PATTERN.findall(sentence)]
+        tokens = [token.lower() for token in originals]
+        corrected = [self._correct(token) for token in tokens]
+
+        matches = []
+        i = 0
+        while i < len(tokens):
+            if originals[i] in self._case_sensitive:
+                term = self._case_sensitive[originals[i]]
+                matches.append(Match(term.slot, term.value, i, i + 1, False))
+                i += 1
+                continue
+
+            node, best, fuzzy = self._trie, None, False
+            for j in range(i, len(tokens)):
+                token = tokens[j] if tokens[j] in node else corrected[j]
+                if token is None or token not in node:
+                    break
+                fuzzy = fuzzy or token != tokens[j]
+                node = node[token]
+                if None in node:
+                    best = (node[None], j + 1, fuzzy)
+
+            if best is None:
+                i += 1
+                continue
+            term, end, fuzzy = best
+            if term.slot == 'time' and end - i == 1 and tokens[i] in AMBIGUOUS_TIME_TERMS and (i == 0 or tokens[i - 1] not in TIME_CUES):
+                i += 1
+                continue
+            matches.append(Match(term.slot, term.value, i, end, fuzzy))
+            i = end
+        return matches
+
+    def match(self, sentence: str) -> Extraction:
+        """Fill whichever of crop, region and time the sentence names unambiguously.
+
+        Unfilled slots are left empty with a score of 0. Matched crops and
+        regions are returned in their canonical spelling. Time keeps the words
+        the user wrote, from the first time mention to the last, so "June to
+        August" stays a range.
+        """
+        by_slot = {slot: [match for match in self.find(sentence) if match.slot == slot] for slot in SLOTS}
+        values, scores = [], []
+        for slot in SLOTS:
+            value = self._resolve(slot, by_slot[slot], sentence)
+            fuzzy = any(match.fuzzy for match in by_slot[slot])
+            values.append(value)
+            scores.append(0.0 if not value else 0.9 if fuzzy else 1.0)
+        return Extraction(values[0], values[1], values[2], tuple(scores))
+
+    def _resolve(self, slot: str, matches: List[Match], sentence: str) -> str:
+        if not matches:
+            return ''
+        if slot == 'crop':
+            # "rice after wheat" names two crops; leave it to the model to decide which is meant
+            return matches[0].value if len({match.value for match in matches}) == 1 else ''
+        if slot == 'region':
+            distinct = list(dict.fromkeys(match.value for match in matches))
+            if len(distinct) == 1:
+                return distinct[0]
+            tokens = self._tokens(sentence)
+            gaps = [tokens[a.end:b.start] for a, b in zip(matches, matches[1:])]
+            if all(all(token in REGION_JOINERS for token in gap) for gap in gaps):
+                return ', '.join(distinct)
+            return ''
+
+        # Time: the original text from the first mention to the last, as long as it is a short span
+        if len(matches) == 1 and matches[0].fuzzy:
+            return matches[0].value
+        if matches[-1].end - matches[0].start > 6:
+            return ''
+        spans = [match.span() for match in TOKEN_PATTERN.finditer(sentence)]
+        return sentence[spans[matches[0].start][0]:spans[matches[-1].end - 1][1]].strip("'")
+
+
+class FastPathExtractor:
+    """Runs the gazetteer first and only asks the QA model about slots it could not fill."""
+
+    def __init__(self, gazetteer: Gazetteer, fallback, enabled: bool = True):
+        self.gazetteer = gazetteer
+        self.fallback = fallback
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.paths = {'gazetteer': 0, 'mixed': 0, 'model': 0}
+        self.slots = {slot: {'gazetteer': 0, 'fuzzy': 0, 'model': 0} for slot in SLOTS}
+
+    def extract(self, sentences: List[str]) -> List[Extraction]:
+        if not self.enabled:
+            extractions = self.fallback.extract(sentences)
+            self._record([Extraction('', '', '', (0.0, 0.0, 0.0))] * len(sentences))
+            return extractions
+
+        matched = [self.gazetteer.match(sentence) for sentence in sentences]
+        incomplete = [i for i, extraction in enumerate(matched) if not all(extraction.as_tuple())]
+        answers = dict(zip(incomplete, self.fallback.extract([sentences[i] for i in incomplete]))) if incomplete else {}
+        self._record(matched)
+
+        results = []
+        for i, extraction in enumerate(matched):
+            if i not in answers:
+                results.append(extraction)
+                continue
+            answer = answers[i]
+            slots = [(mine, score) if mine else (theirs, their_score)
+                     for mine, score, theirs, their_score in zip(extraction.as_tuple(), extraction.scores, answer.as_tuple(), answer.scores)]
+            (crop, crop_score), (region, region_score), (time, time_score) = slots
+            results.append(Extraction(crop, region, time, (crop_score, region_score, time_score)))
+        return results
+
+    def _record(self, matched: List[Extraction]):
+        with self._lock:
+            for extraction in matched:
+                filled = [bool(value) for value in extraction.as_tuple()]
+                path = 'gazetteer' if all(filled) else 'mixed' if any(filled) else 'model'
+                self.paths[path] += 1
+                for slot, value, score in zip(SLOTS, extraction.as_tuple(), extraction.scores):
+                    self.slots[slot]['model' if not value else 'fuzzy' if score < 1 else 'gazetteer'] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = sum(self.paths.values())
+            return {
+                'enabled': self.enabled,
+                'sentences': total,
+                'paths': dict(self.paths),
+                'slots': {slot: dict(counts) for slot, counts in self.slots.items()},
+                'fast_path_rate': self.paths['gazetteer'] / total if total else 0.0,
+            }
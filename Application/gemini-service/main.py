@@ -1,109 +1,330 @@
 import flask
-from flask import request, jsonify
+from flask import request, jsonify, Response, stream_with_context
 import vertexai
 from vertexai.preview.generative_models import GenerativeModel, ChatSession
 import os
-from transformers import pipeline
-from collections import deque
 from typing import List, Tuple, Dict
 import time as time_module
-from google.cloud import storage
 import json
+import atexit
+import zlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from extraction import MicroBatcher, Extraction
+from model_loader import QAModelLoader, ModelNotReady
+from model_scheduler import ModelScheduler, Overloaded, INTERACTIVE, ANALYSIS, BATCH
+from gazetteer import Gazetteer, FastPathExtractor
+from prompts import ANALYSIS_MODEL_NAME, build_analysis_prompt
+from precompute import PrecomputedAnalyses
+from chat_history import build_history
+from context_budget import ContextCompactor, estimate_tokens, model_summarizer
+from result_cache import AnalysisCache, normalize_key
+from singleflight import SingleFlight
+from session_store import SessionStore, SessionContext
+from write_behind import WriteBehindQueue
+from storage_backend import create_storage_backend
+from session_index import SessionIndex
+from session_log import SessionLog
+from document_store import DocumentStore
+from retention import RetentionSweeper
+from session_archive import SessionArchive, ndjson, gzip_stream, read_records
+from telemetry import Telemetry
 from dotenv import load_dotenv
 load_dotenv()
 
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
 app = flask.Flask(__name__)
 
+# Per-stage latency histograms and request traces; span() is a shared no-op when disabled
+telemetry = Telemetry(
+    enabled=os.getenv('TELEMETRY_ENABLED', 'true').lower() == 'true',
+    trace_threshold_ms=float(os.getenv('TRACE_LOG_THRESHOLD_MS', 1000)),
+)
+
 project_id = os.getenv('PROJECT_ID')
 location = os.getenv('LOCATION')
 vertexai.init(project=project_id, location=location)
 
-model = GenerativeModel("gemini-1.5-flash-002")
+model = GenerativeModel(ANALYSIS_MODEL_NAME)
+# Every Gemini call goes through the scheduler: interactive chat first, bulk work last, overload shed with a 429
+model_scheduler = ModelScheduler(
+    max_concurrency=int(os.getenv('MODEL_MAX_CONCURRENCY', 16)),
+    rate=float(os.getenv('MODEL_RATE_LIMIT', 0)),
+    burst=float(os.getenv('MODEL_RATE_BURST')) if os.getenv('MODEL_RATE_BURST') else None,
+    max_queue_wait=float(os.getenv('MODEL_QUEUE_TIMEOUT', 10)),
+    max_retries=int(os.getenv('MODEL_MAX_RETRIES', 3)),
+    base_delay=float(os.getenv('MODEL_RETRY_BASE_DELAY', 0.5)),
+    max_delay=float(os.getenv('MODEL_RETRY_MAX_DELAY', 8)),
+    telemetry=telemetry,
+)
 
 HF_TOKEN = os.getenv('HF_TOKEN')
-nlp = pipeline("question-answering", model="deepset/roberta-base-squad2")
+# The QA model loads in the background so the instance starts serving (and answers gazetteer hits) right away
+qa_model = QAModelLoader(
+    model_name=os.getenv('QA_MODEL_NAME', 'deepset/roberta-base-squad2'),
+    model_path=os.getenv('QA_MODEL_PATH'),
+    cache_dir=os.getenv('QA_MODEL_CACHE_DIR'),
+    variant=os.getenv('QA_MODEL_VARIANT', 'fp32'),
+    # Per worker process; raise it only when each worker has CPUs to itself
+    num_threads=int(os.getenv('QA_TORCH_THREADS', 1)),
+    interop_threads=int(os.getenv('QA_TORCH_INTEROP_THREADS', 1)),
+    token=HF_TOKEN,
+)
+QA_EAGER_LOAD = os.getenv('QA_EAGER_LOAD', 'true').lower() == 'true'
+if QA_EAGER_LOAD:
+    qa_model.start()
+qa_batcher = MicroBatcher(
+    qa_model,
+    max_batch_size=int(os.getenv('QA_MAX_BATCH_SIZE', 16)),
+    max_wait_ms=float(os.getenv('QA_MAX_WAIT_MS', 5)),
+)
+# Known crops, regions and seasons are matched directly; the QA model only fills the slots left over
+extractor = FastPathExtractor(
+    Gazetteer.default(),
+    qa_batcher,
+    enabled=os.getenv('EXTRACTION_FAST_PATH', 'true').lower() == 'true',
+)
 
 MAX_CONTEXT_LENGTH = 10
 CONTEXT_EXPIRY_TIME = 3600  # 1 hour in seconds
-context_cache = {}  # In-memory context for active sessions
-
-BUCKET_NAME = 'CLOUD_STORAGE_BUCKET_NAME'  # Your Google Cloud Storage bucket name
-storage_client = storage.Client()
-
-def load_context_from_bucket(user_id: str, session_id: str):
+# Older turns are folded into a rolling summary once a session's history exceeds the token budget
+CONTEXT_SUMMARY_TOKENS = int(os.getenv('CONTEXT_SUMMARY_TOKENS', 300))
+context_compactor = ContextCompactor(
+    max_tokens=int(os.getenv('CONTEXT_TOKEN_BUDGET', 4000)),
+    keep_recent=int(os.getenv('CONTEXT_KEEP_RECENT_MESSAGES', 4)),
+    max_summary_tokens=CONTEXT_SUMMARY_TOKENS,
+    summarize=model_summarizer(lambda prompt: model_scheduler.call(lambda: model.generate_content(prompt), INTERACTIVE).text, CONTEXT_SUMMARY_TOKENS),
+)
+
+# In-memory context for active sessions, evicted when idle or when the store grows too large
+context_cache = SessionStore(
+    maxlen=MAX_CONTEXT_LENGTH,
+    max_entries=int(os.getenv('SESSION_STORE_MAX_ENTRIES', 10000)),
+    idle_ttl=float(os.getenv('SESSION_STORE_IDLE_TTL', CONTEXT_EXPIRY_TIME)),
+    max_bytes=int(os.getenv('SESSION_STORE_MAX_BYTES', 256 * 1024 * 1024)),
+)
+
+# 'gcs' (in STORAGE_BUCKET) in production; 'local' keeps blobs under LOCAL_STORAGE_ROOT for benchmarks and development
+storage_backend = create_storage_backend(
+    os.getenv('STORAGE_BACKEND', 'gcs'),
+    root=os.getenv('LOCAL_STORAGE_ROOT'),
+    pool_size=int(os.getenv('STORAGE_POOL_SIZE', 32)),
+)
+
+# Context and session blobs are uploaded in the background so requests never wait on GCS writes
+write_behind = WriteBehindQueue(
+    storage_backend,
+    flush_interval=float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 2.0)),
+    max_pending=int(os.getenv('WRITE_BEHIND_MAX_PENDING', 100)),
+)
+atexit.register(write_behind.close)
+
+# Per-user manifest of saved sessions so listing them never scans the bucket
+session_index = SessionIndex(storage_backend, cache_ttl=float(os.getenv('SESSION_INDEX_CACHE_TTL', 10)))
+
+# Contexts and sessions are stored compressed, with long texts such as analyses stored once and shared
+documents = DocumentStore(
+    storage_backend,
+    write_behind,
+    format=os.getenv('STORAGE_FORMAT', 'v1'),
+    compression=os.getenv('STORAGE_COMPRESSION', 'gzip'),
+    dedupe_min_chars=int(os.getenv('STORAGE_DEDUPE_MIN_CHARS', 1024)),
+    reuse_window=float(os.getenv('STORAGE_TEXT_REUSE_WINDOW', 3600)),
+)
+
+# Chat turns are appended to saved sessions as small log blobs instead of re-uploading the whole session
+session_log = SessionLog(storage_backend, write_behind, compact_every=int(os.getenv('SESSION_LOG_COMPACT_EVERY', 20)), documents=documents)
+
+# Analysis results only depend on (crop, region, time), so they are shared across users
+analysis_cache = AnalysisCache(
+    ttl=float(os.getenv('ANALYSIS_CACHE_TTL', 86400)),
+    max_entries=int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', 1024)),
+    storage=storage_backend if os.getenv('ANALYSIS_CACHE_PERSIST', 'false').lower() == 'true' else None,
+)
+analysis_flight = SingleFlight()  # Coalesces identical in-flight analyses across worker threads
+
+# Analyses for the most asked-about crops, regions and seasons, generated ahead of time by precompute.py
+precomputed = PrecomputedAnalyses(
+    storage_backend,
+    documents,
+    max_age=float(os.getenv('PRECOMPUTED_MAX_AGE_DAYS', 30)) * 86400,
+    refresh_interval=float(os.getenv('PRECOMPUTED_REFRESH_INTERVAL', 300)),
+) if os.getenv('PRECOMPUTED_ANALYSES', 'true').lower() == 'true' else None
+
+# Deletes contexts and sessions past their retention period; off unless RETENTION_SWEEP_INTERVAL is set
+retention_sweeper = RetentionSweeper(
+    storage_backend,
+    documents,
+    session_index=session_index,
+    context_cache=context_cache,
+    session_log=session_log,
+    writer=write_behind,
+    context_max_age=float(os.getenv('RETENTION_CONTEXT_MAX_AGE_DAYS', 7)) * 86400,
+    session_max_age=float(os.getenv('RETENTION_SESSION_MAX_AGE_DAYS', 90)) * 86400,
+    text_grace=float(os.getenv('RETENTION_TEXT_GRACE', 86400)),
+    delete_rate=float(os.getenv('RETENTION_DELETE_RATE', 50)),
+    list_rate=float(os.getenv('RETENTION_LIST_RATE', 20)),
+)
+if float(os.getenv('RETENTION_SWEEP_INTERVAL', 0)) > 0:
+    retention_sweeper.start(float(os.getenv('RETENTION_SWEEP_INTERVAL')), texts=os.getenv('RETENTION_SWEEP_TEXTS', 'false').lower() == 'true')
+    atexit.register(retention_sweeper.stop)
+
+# Bulk export and import of a user's sessions and contexts, streamed so memory does not grow with the history
+session_archive = SessionArchive(
+    storage_backend,
+    documents,
+    session_log,
+    session_index,
+    writer=write_behind,
+    context_cache=context_cache,
+    max_workers=int(os.getenv('ARCHIVE_CONCURRENCY', 8)),
+)
+
+ANALYZE_BATCH_MAX_ITEMS = int(os.getenv('ANALYZE_BATCH_MAX_ITEMS', 500))
+# Shared by every /analyze_batch request, so bulk jobs together never hold more than this many model calls
+batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ANALYZE_BATCH_CONCURRENCY', 8)), thread_name_prefix='analyze-batch')
+
+@telemetry.traced('context.load')
+def load_context_from_bucket(user_id: str, session_id: str) -> SessionContext:
     """Load context from Google Cloud Storage for a given user_id and session_id."""
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f'users/{user_id}/contexts/{session_id}.json')
-    
-    if blob.exists():
-        data = blob.download_as_text()
-        context_cache[f"{user_id}_{session_id}"] = deque(json.loads(data), maxlen=MAX_CONTEXT_LENGTH)
+    data = documents.read(f'users/{user_id}/contexts/{session_id}.json')
+    if data is not None:
+        return context_cache.put(f"{user_id}_{session_id}", data)
     else:
-        context_cache[f"{user_id}_{session_id}"] = deque(maxlen=MAX_CONTEXT_LENGTH)
+        return context_cache.put(f"{user_id}_{session_id}")
 
-def save_context_to_bucket(user_id: str, session_id: str):
-    """Save context to Google Cloud Storage for a given user_id and session_id."""
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f'users/{user_id}/contexts/{session_id}.json')
-    
-    # Serialize the context to a JSON-compatible format
-    data = json.dumps([{'role': item['role'], 'content': item['content'], 'timestamp': item['timestamp']} for item in context_cache[f"{user_id}_{session_id}"]])
-    blob.upload_from_string(data)
+@telemetry.traced('context.save')
+def save_context_to_bucket(user_id: str, session_id: str, context: SessionContext):
+    """Queue the context for upload to Google Cloud Storage for a given user_id and session_id."""
+    documents.write(f'users/{user_id}/contexts/{session_id}.json', [item.to_dict() for item in context])
 
 def clear_context_in_bucket(user_id: str, session_id: str):
     """Clear context in Google Cloud Storage for a given user_id and session_id."""
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f'users/{user_id}/contexts/{session_id}.json')
-    
-    if blob.exists():
-        blob.delete()
+    write_behind.delete(f'users/{user_id}/contexts/{session_id}.json')
 
+@telemetry.traced('extract')
 def extract_crop_region_and_time(sentence: str) -> Tuple[str, str, str]:
-    # Crop, region, and time extraction logic remains the same
-    crop_question = "What crop is mentioned in the sentence? Just return the crop name, not a sentence, return nothing if answer cannot be found"
-    region_question = "Which region is mentioned in the sentence? Just return the region name, not a sentence, return nothing if answer cannot be found"
-    time_question = "What season or month is mentioned in the sentence? Just return the season or month name, not a sentence, nothing"
-
-    crop_result = nlp(question=crop_question, context=sentence)
-    region_result = nlp(question=region_question, context=sentence)
-    time_result = nlp(question=time_question, context=sentence)
+    """Extract crop, region and time, sharing any forward pass with concurrent requests."""
+    return extractor.extract([sentence])[0].as_tuple()
 
-    crop = crop_result['answer']
-    region = region_result['answer']
-    time = time_result['answer']
+@telemetry.traced('extract.batch')
+def extract_crop_region_and_time_batch(sentences: List[str]) -> List[Extraction]:
+    """Extract crop, region and time with confidence scores for many sentences at once."""
+    return extractor.extract(sentences)
 
-    return crop, region, time
-
-def clean_context(user_id: str, session_id: str):
+@telemetry.traced('context.clean')
+def clean_context(user_id: str, session_id: str) -> SessionContext:
     """Ensure the context is fresh and remove expired items."""
     cache_key = f"{user_id}_{session_id}"
-    if cache_key not in context_cache:
-        load_context_from_bucket(user_id, session_id)
-    
-    current_time = time_module.time()
-    while context_cache[cache_key] and current_time - context_cache[cache_key][0]['timestamp'] > CONTEXT_EXPIRY_TIME:
-        context_cache[cache_key].popleft()
-
-def get_chat_response(user_id: str, session_id: str, prompt: str) -> str:
+    with context_cache.lock(cache_key):
+        context = context_cache.get(cache_key)
+        if context is None:
+            context = load_context_from_bucket(user_id, session_id)
+        
+        current_time = time_module.time()
+        # The pinned analysis outlives expiry; everything else goes once it is too old
+        if any(not message['pinned'] and current_time - message['timestamp'] > CONTEXT_EXPIRY_TIME for message in context):
+            context.replace(message for message in context if message['pinned'] or current_time - message['timestamp'] <= CONTEXT_EXPIRY_TIME)
+        return context
+
+def prepare_history(context: SessionContext, prompt: str):
+    """Compact the context to the token budget and build the model history from it."""
+    with telemetry.span('context.compact'):
+        usage = context_compactor.compact(context)
+    usage['prompt_tokens'] = estimate_tokens(prompt)
+    return build_history(context), usage
+
+def log_turn_usage(user_id: str, session_id: str, usage: Dict, response=None):
+    """Log the tokens a turn sent, alongside what the model reports when it reports it."""
+    context_compactor.record_turn(usage)
+    telemetry.count('tokens.history', usage['history_tokens'])
+    telemetry.count('tokens.prompt', usage['prompt_tokens'])
+    metadata = count_model_tokens(response)
+    logger.info(
+        "Turn %s/%s: history %d tokens (%d uncompacted%s), prompt %d tokens, model-reported prompt %s, response %s",
+        user_id, session_id, usage['history_tokens'], usage['uncompacted_tokens'], ', compacted' if usage['compacted'] else '',
+        usage['prompt_tokens'], getattr(metadata, 'prompt_token_count', None), getattr(metadata, 'candidates_token_count', None),
+    )
+
+def count_model_tokens(response):
+    """Add the token counts the model reported for a response to the telemetry counters."""
+    metadata = getattr(response, 'usage_metadata', None)
+    telemetry.count('tokens.model_prompt', getattr(metadata, 'prompt_token_count', 0) or 0)
+    telemetry.count('tokens.model_response', getattr(metadata, 'candidates_token_count', 0) or 0)
+    return metadata
+
+def get_chat_response(user_id: str, session_id: str, prompt: str, analysis: bool = False) -> str:
     """Generate a chat response using the AI model."""
-    clean_context(user_id, session_id)
-    cache_key = f"{user_id}_{session_id}"
-    chat = model.start_chat()
-    
-    # Add all previous human messages to the context
-    for message in context_cache[cache_key]:
-        if message['role'] == 'human':
-            chat.send_message(message['content'])
-    
-    response = chat.send_message(prompt)
-    
-    # Update the in-memory context and save it to GCS
-    context_cache[cache_key].append({'role': 'human', 'content': prompt, 'timestamp': time_module.time()})
-    context_cache[cache_key].append({'role': 'ai', 'content': response.text, 'timestamp': time_module.time()})
-    save_context_to_bucket(user_id, session_id)  # Save updated context
-    
+    # Turns for the same session run one at a time so their appends never interleave
+    with context_cache.lock(f"{user_id}_{session_id}"):
+        context = clean_context(user_id, session_id)
+        # Pass the stored turns as history so the model is called exactly once per turn
+        history, usage = prepare_history(context, prompt)
+        chat = model.start_chat(history=history)
+        with telemetry.span('model.chat'):
+            response = model_scheduler.call(lambda: chat.send_message(prompt), ANALYSIS if analysis else INTERACTIVE)
+        log_turn_usage(user_id, session_id, usage, response)
+        record_exchange(user_id, session_id, context, prompt, response.text, analysis=analysis)
+        return response.text
+
+def record_exchange(user_id: str, session_id: str, context: SessionContext, prompt: str, response_text: str, analysis: bool = False):
+    """Append a prompt and its response to the session context and save it to GCS.
+
+    The session's first analysis is pinned so compaction and expiry never drop it.
+    """
+    with context_cache.lock(f"{user_id}_{session_id}"):
+        if context.maxlen is not None and len(context) + 2 > context.maxlen:
+            # Summarise rather than let the deque silently push out its oldest (pinned) messages
+            context_compactor.compact(context)
+        pinned = analysis and not any(message['pinned'] for message in context)
+        context.append({'role': 'human', 'content': prompt, 'timestamp': time_module.time(), 'pinned': pinned})
+        context.append({'role': 'ai', 'content': response_text, 'timestamp': time_module.time(), 'pinned': pinned})
+        save_context_to_bucket(user_id, session_id, context)  # Save updated context
+
+def lookup_shared_analysis(cache_key: str):
+    """Find an analysis in the result cache or among the precomputed ones, without calling the model."""
+    cached = analysis_cache.get(cache_key)
+    if cached is None and precomputed is not None:
+        cached = precomputed.get(cache_key)
+        if cached is not None:
+            # Already stored durably as a precomputed entry
+            analysis_cache.put(cache_key, cached, persist=False)
+    return cached
+
+def get_analysis_response(user_id: str, session_id: str, prompt: str, cache_key: str, bypass_cache: bool = False) -> str:
+    """Answer an analysis prompt from the result cache or precomputed analyses, falling back to the AI model."""
+    with context_cache.lock(f"{user_id}_{session_id}"):
+        context = clean_context(user_id, session_id)
+        if not bypass_cache:
+            cached = lookup_shared_analysis(cache_key)
+            if cached is not None:
+                # The session still needs the analysis in its context for follow-up chat
+                record_exchange(user_id, session_id, context, prompt, cached, analysis=True)
+                return cached
+
+        if context:
+            # Answers that depend on this session's chat history cannot be shared
+            return get_chat_response(user_id, session_id, prompt, analysis=True)
+
+        # Identical analyses already in flight share a single model call
+        result = analysis_flight.do(cache_key, lambda: generate_shared_analysis(prompt, cache_key))
+        record_exchange(user_id, session_id, context, prompt, result, analysis=True)
+        return result
+
+def generate_shared_analysis(prompt: str, cache_key: str, priority: int = ANALYSIS) -> str:
+    """Generate an analysis without session history and store it in the result cache."""
+    with telemetry.span('model.generate'):
+        response = model_scheduler.call(lambda: model.generate_content(prompt), priority)
+    count_model_tokens(response)
+    analysis_cache.put(cache_key, response.text)
     return response.text
 
+def record_analysis_summary(user_id: str, session_id: str, crop: str, region: str, time: str):
+    """Keep the crop summary in the session manifest in step with the latest analysis."""
+    session_index.update(user_id, session_id, crop=crop, region=region, time=time)
+
 @app.route('/analyze', methods=['POST'])
 def analyze_crop_suitability():
     request_json = request.get_json(silent=True)
@@ -119,24 +340,24 @@ def analyze_crop_suitability():
     if not crop or not region:
         return jsonify({"error": "Could not extract crop and region from the sentence"}), 400
 
-    prompt = f"""
-    Analyze the suitability of growing {crop} in {region} during {time}. Consider the following factors:
-    1. Climatic conditions of {region} during {time} in the near future
-    2. Soil conditions of {region}
-    3. {crop}'s requirements for successful growth, particularly during {time}
-    4. Best time period for growing {crop} in {region}, and how {time} aligns with this
-    5. Any potential challenges or considerations specific to {time}
+    prompt = build_analysis_prompt(crop, region, time)
 
-    Provide a detailed analysis and recommend whether {crop} is suitable for {region} during {time}. 
-    If not entirely suitable, suggest alternative crops that would be more appropriate for the region and time period.
-    Also, provide any adjustments in farming practices that might be necessary for {time}.
+    cache_key = normalize_key(crop, region, time)
+    result = get_analysis_response(user_id, session_id, prompt, cache_key, bypass_cache=bool(request_json.get('bypass_cache')))
+    record_analysis_summary(user_id, session_id, crop, region, time)
+    return jsonify({"crop_analysis": result})
 
-    Make sure to explicitly mention the typical weather conditions expected in {region} during {time} in your response.
-    Ignore and don't mention if there's any repeated nonsensical phrase present.
-    """
+@app.route('/analyze_batch', methods=['POST'])
+def analyze_batch():
+    request_json = request.get_json(silent=True)
+    if not request_json or not isinstance(request_json.get('items'), list) or not request_json['items']:
+        return jsonify({"error": "Please provide a non-empty list of items in the request"}), 400
+    if len(request_json['items']) > ANALYZE_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"A batch can have at most {ANALYZE_BATCH_MAX_ITEMS} items"}), 400
 
-    result = get_chat_response(user_id, session_id, prompt)
-    return jsonify({"crop_analysis": result})
+    failed, groups = plan_batch(request_json['items'])
+    events = stream_batch_analyses(failed, groups, bypass_cache=bool(request_json.get('bypass_cache')))
+    return Response(stream_with_context(events), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
 
 @app.route('/chat', methods=['POST'])
 def chat_with_ai():
@@ -151,6 +372,244 @@ def chat_with_ai():
     result = get_chat_response(user_id, session_id, message)
     return jsonify({"response": result})
 
+def plan_batch(items: List) -> Tuple[List[Dict], Dict[str, Tuple[str, List[Dict]]]]:
+    """Resolve batch items to analyses, returning (failed items, {cache_key: (prompt, items)}).
+
+    Items are sentences, {"sentence": ...} or explicit {"crop", "region", "time"}.
+    Sentences are extracted together and items that normalise to the same
+    cache key share one analysis.
+    """
+    records = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'sentence': item}
+        if not isinstance(item, dict):
+            records.append({'index': index, 'error': "Each item must be a sentence or an object"})
+        elif item.get('sentence'):
+            records.append({'index': index, 'sentence': item['sentence']})
+        else:
+            records.append({'index': index, 'crop': item.get('crop') or '', 'region': item.get('region') or '', 'time': item.get('time') or ''})
+
+    to_extract = [record for record in records if 'sentence' in record]
+    for record, extraction in zip(to_extract, extract_crop_region_and_time_batch([record.pop('sentence') for record in to_extract])):
+        record['crop'], record['region'], record['time'] = extraction.as_tuple()
+
+    failed, groups = [], {}
+    for record in records:
+        if 'error' not in record and (not record['crop'] or not record['region']):
+            record['error'] = "Could not extract crop and region"
+        if 'error' in record:
+            failed.append(record)
+            continue
+        cache_key = normalize_key(record['crop'], record['region'], record['time'])
+        prompt = build_analysis_prompt(record['crop'], record['region'], record['time'])
+        groups.setdefault(cache_key, (prompt, []))[1].append(record)
+    return failed, groups
+
+def ndjson_lines(records: List[Dict], **fields) -> str:
+    return ''.join(json.dumps({**record, **fields}) + '\n' for record in records)
+
+def stream_batch_analyses(failed: List[Dict], groups: Dict[str, Tuple[str, List[Dict]]], bypass_cache: bool = False):
+    """Yield one NDJSON line per batch item as its analysis completes, then a summary line.
+
+    Batch analyses never touch a session's context; they only read and fill
+    the shared analysis cache.
+    """
+    yield ndjson_lines(failed)
+    cached_count, errors = 0, len(failed)
+    pending = {}
+    for cache_key, (prompt, records) in groups.items():
+        cached = None if bypass_cache else lookup_shared_analysis(cache_key)
+        if cached is not None:
+            cached_count += 1
+            yield ndjson_lines(records, crop_analysis=cached, cached=True)
+            continue
+        future = batch_executor.submit(analysis_flight.do, cache_key, lambda prompt=prompt, cache_key=cache_key: generate_shared_analysis(prompt, cache_key, BATCH))
+        pending[future] = records
+
+    try:
+        for future in as_completed(pending):
+            try:
+                yield ndjson_lines(pending[future], crop_analysis=future.result(), cached=False)
+            except Exception as e:
+                errors += len(pending[future])
+                yield ndjson_lines(pending[future], error=str(e))
+    finally:
+        # The client went away; drop analyses that have not started yet
+        for future in pending:
+            future.cancel()
+
+    items = len(failed) + sum(len(records) for _, records in groups.values())
+    yield json.dumps({'done': True, 'items': items, 'analyses': len(groups), 'cached': cached_count, 'errors': errors}) + '\n'
+
+def sse_event(data: Dict, event: str = None) -> str:
+    """Format a server-sent event carrying a JSON payload."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def stream_chat_response(user_id: str, session_id: str, prompt: str, result_key: str, cache_key: str = None, bypass_cache: bool = False,
+                         summary: Tuple[str, str, str] = None):
+    """Stream a chat response as server-sent events and persist the context once it completes.
+
+    summary is the (crop, region, time) of an analysis, recorded in the
+    session manifest only once the response has completed.
+    """
+    with context_cache.lock(f"{user_id}_{session_id}"):
+        context = clean_context(user_id, session_id)
+        if cache_key is not None and not bypass_cache:
+            cached = lookup_shared_analysis(cache_key)
+            if cached is not None:
+                record_exchange(user_id, session_id, context, prompt, cached, analysis=True)
+                if summary is not None:
+                    record_analysis_summary(user_id, session_id, *summary)
+                yield sse_event({"text": cached})
+                yield sse_event({result_key: cached}, event="done")
+                return
+
+        shareable = cache_key is not None and not context
+        history, usage = prepare_history(context, prompt)
+        chat = model.start_chat(history=history)
+        chunks = []
+        chunk = None
+        started = time_module.perf_counter()
+        try:
+            # The slot is held until the whole response has been streamed
+            for chunk in model_scheduler.stream(lambda: chat.send_message(prompt, stream=True), ANALYSIS if cache_key is not None else INTERACTIVE):
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunks without text (e.g. only safety metadata) have nothing to show
+                    continue
+                if not chunks:
+                    telemetry.record('model.stream.first_token', started)
+                chunks.append(text)
+                yield sse_event({"text": text})
+        except Exception as e:
+            telemetry.record('model.stream', started, error=True)
+            yield sse_event({"error": str(e), **({"retry_after": e.retry_after} if isinstance(e, Overloaded) else {})}, event="error")
+            return
+        # Includes the time the client took to read the stream
+        telemetry.record('model.stream', started)
+
+        result = "".join(chunks)
+        # The final chunk carries the usage counts for the whole response
+        log_turn_usage(user_id, session_id, usage, chunk)
+        record_exchange(user_id, session_id, context, prompt, result, analysis=cache_key is not None)
+        if summary is not None:
+            record_analysis_summary(user_id, session_id, *summary)
+        if shareable:
+            analysis_cache.put(cache_key, result)
+        yield sse_event({result_key: result}, event="done")
+
+@app.route('/analyze_stream', methods=['POST'])
+def analyze_crop_suitability_stream():
+    request_json = request.get_json(silent=True)
+    
+    if not request_json or 'sentence' not in request_json or 'session_id' not in request_json or 'user_id' not in request_json:
+        return jsonify({"error": "Please provide a sentence, session_id, and user_id in the request"}), 400
+
+    sentence = request_json['sentence']
+    session_id = request_json['session_id']
+    user_id = request_json['user_id']
+    crop, region, time = extract_crop_region_and_time(sentence)
+    
+    if not crop or not region:
+        return jsonify({"error": "Could not extract crop and region from the sentence"}), 400
+
+    prompt = build_analysis_prompt(crop, region, time)
+    cache_key = normalize_key(crop, region, time)
+    events = stream_chat_response(user_id, session_id, prompt, "crop_analysis", cache_key=cache_key, bypass_cache=bool(request_json.get('bypass_cache')),
+                                  summary=(crop, region, time))
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/chat_stream', methods=['POST'])
+def chat_with_ai_stream():
+    request_json = request.get_json(silent=True)
+    
+    if not request_json or 'message' not in request_json or 'session_id' not in request_json or 'user_id' not in request_json:
+        return jsonify({"error": "Please provide a message, session_id, and user_id in the request"}), 400
+
+    message = request_json['message']
+    session_id = request_json['session_id']
+    user_id = request_json['user_id']
+    # Shed before the stream starts, while a 429 can still be sent
+    model_scheduler.check(INTERACTIVE)
+    events = stream_chat_response(user_id, session_id, message, "response")
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.before_request
+def begin_request_trace():
+    flask.g.trace = telemetry.begin_request(request.endpoint or 'unmatched')
+
+@app.after_request
+def record_response_status(response):
+    flask.g.status = response.status_code
+    trace = flask.g.get('trace')
+    if response.is_streamed and trace is not None:
+        # The body is produced after teardown; end the trace once the stream has been sent
+        flask.g.trace = None
+        response.call_on_close(lambda: telemetry.end_request(trace, response.status_code))
+    return response
+
+@app.teardown_request
+def end_request_trace(error=None):
+    telemetry.end_request(flask.g.pop('trace', None), 500 if error is not None else flask.g.pop('status', None))
+
+def service_stats(coalescing: Dict) -> Dict:
+    """Cache, session, extraction and token stats reported alongside the latency metrics."""
+    return {
+        'analysis_cache': {**analysis_cache.stats(), 'coalescing': coalescing},
+        'precomputed': precomputed.stats() if precomputed is not None else None,
+        'sessions': context_cache.stats(),
+        'write_behind': write_behind.stats(),
+        'documents': documents.stats(),
+        'retention': retention_sweeper.stats(),
+        'extraction': extractor.stats(),
+        'context_budget': context_compactor.stats(),
+        'model_scheduler': model_scheduler.stats(),
+    }
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latency histograms, in-flight requests, cache stats and token usage; ?format=prometheus for the text format."""
+    stats = service_stats(analysis_flight.stats())
+    if request.args.get('format') == 'prometheus':
+        return Response(telemetry.prometheus(stats), mimetype='text/plain; version=0.0.4')
+    return jsonify({**telemetry.snapshot(), **stats})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({**analysis_cache.stats(), 'coalescing': analysis_flight.stats(), 'precomputed': precomputed.stats() if precomputed is not None else None})
+
+@app.errorhandler(ModelNotReady)
+def model_not_ready(error):
+    return jsonify({"error": str(error)}), 503, {'Retry-After': '10'}
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    return jsonify({"error": str(error)}), 429, {'Retry-After': str(error.retry_after)}
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe: 200 once the QA model is loaded and warmed up, 503 before that.
+
+    With QA_EAGER_LOAD=false the model loads on first use instead, so the
+    instance is ready unless that load failed.
+    """
+    status = qa_model.status()
+    if not QA_EAGER_LOAD:
+        status['load'] = 'lazy'
+    ready = qa_model.ready or (not QA_EAGER_LOAD and status['state'] != 'failed')
+    return jsonify(status), 200 if ready else 503
+
+@app.route('/extraction_stats', methods=['GET'])
+def extraction_stats():
+    return jsonify(extractor.stats())
+
+@app.route('/session_stats', methods=['GET'])
+def session_stats():
+    return jsonify({**context_cache.stats(), 'write_behind': write_behind.stats(), 'session_log': session_log.stats(), 'documents': documents.stats(), 'retention': retention_sweeper.stats(), 'context_budget': context_compactor.stats()})
+
 @app.route('/context', methods=['GET'])
 def get_context():
     user_id = request.args.get('user_id')
@@ -158,12 +617,15 @@ def get_context():
     if not user_id or not session_id:
         return jsonify({"error": "Please provide user_id and session_id"}), 400
     
+    context = clean_context(user_id, session_id)
+    return jsonify({"context": [{'role': item['role'], 'content': item['content']} for item in context]})
+
+def clear_session_context(user_id: str, session_id: str):
     cache_key = f"{user_id}_{session_id}"
-    if cache_key not in context_cache:
-        load_context_from_bucket(user_id, session_id)
-    
-    clean_context(user_id, session_id)
-    return jsonify({"context": [{'role': item['role'], 'content': item['content']} for item in context_cache[cache_key]]})
+    with context_cache.lock(cache_key):
+        context_cache.put(cache_key)
+        clear_context_in_bucket(user_id, session_id)
+    session_index.touch(user_id, session_id)
 
 @app.route('/clear_context', methods=['POST'])
 def clear_context():
@@ -173,9 +635,7 @@ def clear_context():
 
     session_id = request_json['session_id']
     user_id = request_json['user_id']
-    cache_key = f"{user_id}_{session_id}"
-    context_cache[cache_key] = deque(maxlen=MAX_CONTEXT_LENGTH)
-    clear_context_in_bucket(user_id, session_id)
+    clear_session_context(user_id, session_id)
     return jsonify({"message": f"Context cleared for user {user_id}, session {session_id}"})
 
 @app.route('/save_session', methods=['POST'])
@@ -188,25 +648,76 @@ def save_session():
     session_id = request_json['session_id']
     session_data = request_json['session_data']
 
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"users/{user_id}/sessions/{session_id}/data.json")
-    blob.upload_from_string(json.dumps(session_data), content_type='application/json')
+    version = session_log.save_snapshot(user_id, session_id, session_data)
+    session_index.record_save(user_id, session_id, session_data)
+
+    return jsonify({"message": f"Session saved for user {user_id}, session {session_id}", "version": version})
+
+@app.route('/append_session', methods=['POST'])
+def append_session():
+    request_json = request.get_json(silent=True)
+    if not request_json or 'user_id' not in request_json or 'session_id' not in request_json or 'messages' not in request_json:
+        return jsonify({"error": "Please provide user_id, session_id, and messages in the request"}), 400
+
+    user_id = request_json['user_id']
+    session_id = request_json['session_id']
+    messages = request_json['messages']
+    fields = request_json.get('fields') or {}
+    if not isinstance(messages, list) or not isinstance(fields, dict):
+        return jsonify({"error": "messages must be a list and fields an object"}), 400
+
+    version = session_log.append(user_id, session_id, messages, fields)
+    # Only the first append of a session changes the manifest; later turns leave it alone
+    session_index.mark_saved(user_id, session_id)
+
+    return jsonify({"message": f"Session updated for user {user_id}, session {session_id}", "version": version})
+
+def delete_saved_session(user_id: str, session_id: str):
+    cache_key = f"{user_id}_{session_id}"
+    with context_cache.lock(cache_key):
+        context_cache.pop(cache_key)
+        clear_context_in_bucket(user_id, session_id)
+    session_log.delete(user_id, session_id)
+    session_index.remove(user_id, session_id)
+
+@app.route('/delete_session', methods=['POST'])
+def delete_session():
+    request_json = request.get_json(silent=True)
+    if not request_json or 'user_id' not in request_json or 'session_id' not in request_json:
+        return jsonify({"error": "Please provide user_id and session_id in the request"}), 400
+
+    user_id = request_json['user_id']
+    session_id = request_json['session_id']
+    delete_saved_session(user_id, session_id)
+    return jsonify({"message": f"Session deleted for user {user_id}, session {session_id}"})
+
+def page_chat_messages(session_data: Dict, limit: int, before: int = None) -> Dict:
+    """Cut a session down to the limit chat messages ending just before index before (default: the newest).
 
-    return jsonify({"message": f"Session saved for user {user_id}, session {session_id}"})
+    Pages of older messages (before given) only carry the messages, since
+    the client already has the rest of the session.
+    """
+    messages = session_data.get('chat_messages') or []
+    end = len(messages) if before is None else max(0, min(before, len(messages)))
+    start = max(0, end - limit)
+    page = {'chat_messages': messages[start:end], 'messages_total': len(messages), 'messages_offset': start, 'version': session_data.get('version', 0)}
+    return page if before is not None else {**session_data, **page}
 
 @app.route('/load_session', methods=['GET'])
 def load_session():
+    """Load a saved session; with limit, only a page of its chat messages (the newest, or those before `before`)."""
     user_id = request.args.get('user_id')
     session_id = request.args.get('session_id')
     if not user_id or not session_id:
         return jsonify({"error": "Please provide user_id and session_id"}), 400
-
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"users/{user_id}/sessions/{session_id}/data.json")
-    
-    if blob.exists():
-        session_data = json.loads(blob.download_as_text())
-        return jsonify(session_data)
+    limit = request.args.get('limit', type=int)
+    before = request.args.get('before', type=int)
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit must be a positive number"}), 400
+
+    session_data = session_log.load(user_id, session_id)
+    if session_data is not None:
+        return jsonify(session_data if limit is None else page_chat_messages(session_data, limit, before))
     else:
         return jsonify({"error": "Session not found"}), 404
 
@@ -216,14 +727,64 @@ def list_sessions():
     if not user_id:
         return jsonify({"error": "Please provide user_id"}), 400
 
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blobs = bucket.list_blobs(prefix=f"users/{user_id}/sessions/")
-    sessions = {}
-    for blob in blobs:
-        if blob.name.endswith('/data.json'):
-            session_id = blob.name.split('/')[-2]
-            sessions[session_id] = blob.time_created.isoformat()
-    return jsonify(sessions)
+    paginated = 'limit' in request.args or 'page_token' in request.args
+    limit = request.args.get('limit')
+    page_token = request.args.get('page_token')
+    if limit is not None and not limit.isdigit():
+        return jsonify({"error": "limit must be a whole number"}), 400
+    if page_token and not page_token.isdigit():
+        return jsonify({"error": "Invalid page_token"}), 400
+    # A page of at least one entry, so next_page_token always moves forward
+    limit = max(1, int(limit)) if limit is not None else None
+    entries, next_page_token, etag = session_index.page(user_id, limit=limit, page_token=page_token)
+
+    # The manifest's hash plus the page being asked for identifies the response
+    etag = f"{etag}-{limit}-{page_token}" if paginated else etag
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    if paginated:
+        response = jsonify({"sessions": entries, "next_page_token": next_page_token})
+    else:
+        # Without paging parameters keep the original {session_id: created} shape
+        response = jsonify({entry['id']: entry['created'] for entry in entries})
+    response.set_etag(etag)
+    return response
+
+@app.route('/export_sessions', methods=['GET'])
+def export_sessions():
+    """Stream all of a user's saved sessions and contexts as NDJSON, or as a gzipped NDJSON file with format=gzip."""
+    user_id = request.args.get('user_id')
+    export_format = request.args.get('format', 'ndjson')
+    if not user_id:
+        return jsonify({"error": "Please provide user_id"}), 400
+    if export_format not in ('ndjson', 'gzip'):
+        return jsonify({"error": "format must be ndjson or gzip"}), 400
+
+    lines = ndjson(session_archive.export(user_id))
+    if export_format == 'gzip':
+        filename = f"agropredict-{user_id}-{time_module.strftime('%Y%m%d')}.ndjson.gz"
+        return Response(stream_with_context(gzip_stream(lines)), mimetype='application/gzip',
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'})
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/import_sessions', methods=['POST'])
+def import_sessions():
+    """Import an export (NDJSON, gzipped or not) into user_id; mode=overwrite replaces sessions that already exist."""
+    user_id = request.args.get('user_id')
+    mode = request.args.get('mode', 'skip')
+    if not user_id:
+        return jsonify({"error": "Please provide user_id"}), 400
+    if mode not in ('skip', 'overwrite'):
+        return jsonify({"error": "mode must be skip or overwrite"}), 400
+
+    compressed = request.content_encoding == 'gzip' or request.mimetype in ('application/gzip', 'application/x-gzip')
+    try:
+        result = session_archive.import_records(user_id, read_records(request.stream, compressed), overwrite=mode == 'overwrite')
+    except (ValueError, OSError, EOFError, zlib.error) as e:
+        # Malformed JSON, an unsupported archive, or a corrupt or truncated gzip stream
+        return jsonify({"error": f"Could not import the archive: {e}"}), 400
+    return jsonify(result)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
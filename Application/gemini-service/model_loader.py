@@ -0,0 +1,192 @@
+"""Loads the extractive QA model in the background so the service can start before the model is ready.
+
+To bake the weights into the image instead of downloading them on every cold start:
+
+    python model_loader.py download --output models/qa [--variant onnx]
+"""
+import argparse
+import logging
+import os
+import threading
+import time as time_module
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_NAME = 'deepset/roberta-base-squad2'
+VARIANTS = ('fp32', 'int8', 'onnx')
+WARMUP_SENTENCE = "Can I grow rice in Punjab during the kharif season?"
+
+
+class ModelNotReady(Exception):
+    pass
+
+
+def configure_torch_threads(num_threads: Optional[int], interop_threads: Optional[int]):
+    """Pin torch's intra-op and inter-op thread pools instead of letting it guess from the host's CPUs."""
+    import torch
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Only allowed before torch has started any parallel work
+            logger.warning("torch inter-op threads were already initialised; keeping %d", torch.get_num_interop_threads())
+
+
+class QAModelLoader:
+    """Owns the QA model's lifecycle: locate, load, optionally quantize, warm up.
+
+    The loader can be used wherever an extractor is expected, because
+    extract() waits for the model and then delegates to it. Requests that
+    the gazetteer answers on its own never wait for the model. The model is
+    read from model_path when that directory exists, for example weights
+    baked into the image. Otherwise it is downloaded into cache_dir.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, model_path: Optional[str] = None, cache_dir: Optional[str] = None,
+                 variant: str = 'fp32', num_threads: Optional[int] = None, interop_threads: Optional[int] = 1,
+                 warmup: bool = True, token: Optional[str] = None, load_timeout: float = 300):
+        if variant not in VARIANTS:
+            raise ValueError(f"Unknown QA model variant {variant!r}, expected one of {VARIANTS}")
+        self.model_name = model_name
+        self.model_path = model_path
+        self.cache_dir = cache_dir
+        self.variant = variant
+        self.num_threads = num_threads
+        self.interop_threads = interop_threads
+        self.warmup = warmup
+        self.token = token
+        self.load_timeout = load_timeout
+        self._extractor = None
+        self._error = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self.timings = {}
+
+    @property
+    def source(self) -> str:
+        return self.model_path if self.model_path and os.path.isdir(self.model_path) else self.model_name
+
+    @property
+    def ready(self) -> bool:
+        return self._extractor is not None
+
+    def start(self):
+        """Begin loading in a background thread; calling it again is a no-op."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._load, name='qa-model-loader', daemon=True)
+                self._thread.start()
+
+    def get(self, timeout: Optional[float] = None):
+        """Return the loaded extractor, loading it first if nobody has started to."""
+        self.start()
+        if not self._loaded.wait(self.load_timeout if timeout is None else timeout):
+            raise ModelNotReady(f"QA model {self.source} is still loading")
+        if self._error is not None:
+            raise ModelNotReady(f"QA model {self.source} failed to load: {self._error}")
+        return self._extractor
+
+    def extract(self, sentences: List[str]):
+        return self.get().extract(sentences)
+
+    def _load(self):
+        try:
+            started = time_module.perf_counter()
+            configure_torch_threads(self.num_threads, self.interop_threads)
+            qa_pipeline = self._build_pipeline()
+            self.timings['load_seconds'] = time_module.perf_counter() - started
+
+            if self.variant == 'int8':
+                started = time_module.perf_counter()
+                qa_pipeline.model = self._quantize(qa_pipeline.model)
+                self.timings['quantize_seconds'] = time_module.perf_counter() - started
+
+            from extraction import BatchedQAExtractor
+
+            extractor = BatchedQAExtractor(qa_pipeline)
+            if self.warmup:
+                # The first forward pass allocates buffers and picks kernels; pay for it before real traffic
+                started = time_module.perf_counter()
+                extractor.extract([WARMUP_SENTENCE])
+                self.timings['warmup_seconds'] = time_module.perf_counter() - started
+            self._extractor = extractor
+            logger.info("QA model %s (%s) ready: %s", self.source, self.variant, self.timings)
+        except Exception as e:
+            self._error = e
+            logger.exception("Loading QA model %s failed", self.source)
+        finally:
+            self._loaded.set()
+
+    def _build_pipeline(self):
+        from transformers import AutoModelForQuestionAnswering, AutoTokenizer, pipeline
+
+        kwargs = {'cache_dir': self.cache_dir, 'token': self.token}
+        tokenizer = AutoTokenizer.from_pretrained(self.source, **kwargs)
+        if self.variant != 'onnx':
+            model = AutoModelForQuestionAnswering.from_pretrained(self.source, **kwargs)
+            return pipeline('question-answering', model=model, tokenizer=tokenizer)
+
+        try:
+            from optimum.onnxruntime import ORTModelForQuestionAnswering
+        except ImportError:
+            raise RuntimeError("The onnx variant needs optimum[onnxruntime] installed") from None
+        # Baked ONNX weights load as they are; a plain checkpoint is exported on the fly
+        exported = os.path.exists(os.path.join(self.source, 'model.onnx'))
+        model = ORTModelForQuestionAnswering.from_pretrained(self.source, export=not exported, **kwargs)
+        return pipeline('question-answering', model=model, tokenizer=tokenizer)
+
+    @staticmethod
+    def _quantize(model):
+        import torch
+
+        # Dynamic int8 quantization of the Linear layers, where nearly all of roberta's CPU time goes
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def status(self) -> Dict:
+        if self.ready:
+            state = 'ready'
+        elif self._error is not None:
+            state = 'failed'
+        else:
+            state = 'loading' if self._thread is not None else 'not_started'
+        status = {'state': state, 'model': self.source, 'variant': self.variant, **self.timings}
+        if self._error is not None:
+            status['error'] = str(self._error)
+        return status
+
+
+def download(model_name: str, output: str, variant: str = 'fp32', token: Optional[str] = None):
+    """Save the model and tokenizer to a local directory, exported to ONNX when asked."""
+    from transformers import AutoModelForQuestionAnswering, AutoTokenizer
+
+    if variant == 'onnx':
+        from optimum.onnxruntime import ORTModelForQuestionAnswering
+
+        model = ORTModelForQuestionAnswering.from_pretrained(model_name, export=True, token=token)
+    else:
+        # int8 is quantized at load time, so it starts from the regular weights
+        model = AutoModelForQuestionAnswering.from_pretrained(model_name, token=token)
+    model.save_pretrained(output)
+    AutoTokenizer.from_pretrained(model_name, token=token).save_pretrained(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    download_parser = subparsers.add_parser('download', help='save the QA model to a local directory')
+    download_parser.add_argument('--model', default=os.getenv('QA_MODEL_NAME', DEFAULT_MODEL_NAME))
+    download_parser.add_argument('--output', default=os.getenv('QA_MODEL_PATH', 'models/qa'))
+    download_parser.add_argument('--variant', choices=VARIANTS, default=os.getenv('QA_MODEL_VARIANT', 'fp32'))
+    args = parser.parse_args()
+
+    if args.command == 'download':
+        download(args.model, args.output, args.variant, token=os.getenv('HF_TOKEN'))
+
+
+if __name__ == '__main__':
+    main()
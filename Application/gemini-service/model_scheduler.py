@@ -0,0 +1,272 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import math
+import random
+import threading
+import time as time_module
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Lower values are admitted first
+INTERACTIVE = 0
+ANALYSIS = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', ANALYSIS: 'analysis', BATCH: 'batch'}
+
+# HTTP statuses Vertex AI errors carry when a retry can succeed
+RETRYABLE_CODES = (429, 500, 503, 504)
+QUOTA_CODES = (429,)
+
+
+class Overloaded(Exception):
+    """The model call was shed rather than queued past its deadline; retry after retry_after seconds."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def error_code(error: Exception) -> Optional[int]:
+    code = getattr(error, 'code', None)
+    try:
+        return int(code)
+    except (TypeError, ValueError):
+        return None
+
+
+class ModelScheduler:
+    """Admission control for Vertex AI calls: a concurrency limit, a token bucket and a priority queue.
+
+    Callers wait in priority order (INTERACTIVE before ANALYSIS before
+    BATCH, first come first served within a priority). A call that would
+    wait longer than max_queue_wait is shed straight away with Overloaded,
+    judged from the queue ahead of it and the recent average call time. A
+    call still queued at the deadline is shed as well. Retryable errors
+    (quota, unavailable, timeout) are retried with full-jitter exponential
+    backoff, and the slot is released while the call backs off.
+    """
+
+    def __init__(self, max_concurrency: int = 16, rate: float = 0, burst: Optional[float] = None, max_queue_wait: float = 10,
+                 max_retries: int = 3, base_delay: float = 0.5, max_delay: float = 8, telemetry=None):
+        self.max_concurrency = max_concurrency
+        self.rate = rate  # Calls per second; 0 disables the token bucket
+        self.burst = burst if burst is not None else max(1, max_concurrency)
+        self.max_queue_wait = max_queue_wait
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.telemetry = telemetry
+        self._cond = threading.Condition()
+        self._waiters = []  # heap of [priority, seq]
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._tokens = self.burst
+        self._refilled = time_module.monotonic()
+        self._avg_call_seconds = 1.0
+        self.admitted = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.shed = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.retries = 0
+        self.failures = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _refill(self, now: float):
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _estimate_wait(self, priority: int) -> float:
+        """Seconds a new call at this priority can expect to queue, given who is ahead of it."""
+        ahead = sum(1 for waiter in self._waiters if waiter[0] <= priority)
+        busy = self._in_flight + ahead - self.max_concurrency + 1
+        slot_wait = max(0, busy) * self._avg_call_seconds / self.max_concurrency
+        token_wait = max(0.0, (ahead + 1 - self._tokens) / self.rate) if self.rate else 0.0
+        return max(slot_wait, token_wait)
+
+    def _shed(self, priority: int, retry_after: float, reason: str):
+        self.shed[PRIORITY_NAMES[priority]] += 1
+        raise Overloaded(f"Model capacity exhausted ({reason}); retry later", retry_after)
+
+    def check(self, priority: int):
+        """Raise Overloaded now if a call at this priority would be shed, e.g. before a streamed response starts."""
+        with self._cond:
+            self._refill(time_module.monotonic())
+            wait = self._estimate_wait(priority)
+            if wait > self.max_queue_wait:
+                self._shed(priority, wait, 'queue full')
+
+    def acquire(self, priority: int = INTERACTIVE) -> float:
+        """Wait for a slot and a token; returns the admission time to pass to release()."""
+        started = time_module.monotonic()
+        with self._cond:
+            self._refill(started)
+            wait = self._estimate_wait(priority)
+            if wait > self.max_queue_wait:
+                self._shed(priority, wait, 'queue full')
+            ticket = [priority, next(self._seq)]
+            heapq.heappush(self._waiters, ticket)
+            deadline = started + self.max_queue_wait
+            try:
+                while True:
+                    now = time_module.monotonic()
+                    self._refill(now)
+                    timeout = deadline - now
+                    if self._waiters[0] is ticket and self._in_flight < self.max_concurrency:
+                        if not self.rate or self._tokens >= 1:
+                            break
+                        # Head of the queue with a free slot; sleep until the next token
+                        timeout = min(timeout, (1 - self._tokens) / self.rate)
+                    if deadline <= now:
+                        self._shed(priority, self._estimate_wait(priority), 'queue deadline')
+                    self._cond.wait(timeout)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+            if self.rate:
+                self._tokens -= 1
+            self._in_flight += 1
+            waited = now - started
+            self.admitted[PRIORITY_NAMES[priority]] += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        if self.telemetry is not None and self.telemetry.enabled:
+            self.telemetry.observe(f"model.queue.{PRIORITY_NAMES[priority]}", waited * 1000)
+        return now
+
+    def release(self, admitted: float):
+        with self._cond:
+            self._in_flight -= 1
+            # Moving average of how long a call holds its slot, used to predict queue waits
+            self._avg_call_seconds += 0.1 * (time_module.monotonic() - admitted - self._avg_call_seconds)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority: int = INTERACTIVE):
+        """Hold a slot for the duration of the block, e.g. while a streamed response is read."""
+        admitted = self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(admitted)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def retry_delay(self, error: Exception, attempt: int, priority: int) -> float:
+        """Return how long to back off before retrying, or raise if the call should not be retried."""
+        code = error_code(error)
+        if code not in RETRYABLE_CODES:
+            raise error
+        if attempt >= self.max_retries:
+            with self._cond:
+                self.failures += 1
+            if code in QUOTA_CODES:
+                # Out of quota even after backing off: shed it rather than fail with a 500
+                raise Overloaded(f"Model quota exhausted: {error}", self.max_delay) from error
+            raise error
+        delay = self.backoff(attempt)
+        with self._cond:
+            self.retries += 1
+        logger.warning("Model call failed with %s (attempt %d, %s); retrying in %.2fs", code, attempt + 1, PRIORITY_NAMES[priority], delay)
+        return delay
+
+    def call(self, fn: Callable[[], Any], priority: int = INTERACTIVE) -> Any:
+        for attempt in itertools.count():
+            try:
+                with self.slot(priority):
+                    return fn()
+            except Overloaded:
+                raise
+            except Exception as e:
+                delay = self.retry_delay(e, attempt, priority)
+            time_module.sleep(delay)
+
+    def stream(self, fn: Callable[[], Any], priority: int = INTERACTIVE):
+        """Yield from the iterable fn() returns while holding a slot, retrying failures that happen before the first item."""
+        for attempt in itertools.count():
+            started = False
+            try:
+                with self.slot(priority):
+                    for item in fn():
+                        started = True
+                        yield item
+                return
+            except Overloaded:
+                raise
+            except Exception as e:
+                if started:
+                    raise
+                delay = self.retry_delay(e, attempt, priority)
+            time_module.sleep(delay)
+
+    async def acquire_async(self, priority: int = INTERACTIVE, executor=None) -> float:
+        """acquire() for coroutines; the wait happens on the executor so the event loop keeps running."""
+        future = asyncio.get_running_loop().run_in_executor(executor, self.acquire, priority)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The caller gave up while queued; hand back the slot once the acquire completes
+            future.add_done_callback(lambda done: done.cancelled() or done.exception() or self.release(done.result()))
+            raise
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self, priority: int = INTERACTIVE, executor=None):
+        admitted = await self.acquire_async(priority, executor)
+        try:
+            yield
+        finally:
+            self.release(admitted)
+
+    async def call_async(self, fn: Callable[[], Awaitable[Any]], priority: int = INTERACTIVE, executor=None) -> Any:
+        for attempt in itertools.count():
+            try:
+                async with self.slot_async(priority, executor):
+                    return await fn()
+            except Overloaded:
+                raise
+            except Exception as e:
+                delay = self.retry_delay(e, attempt, priority)
+            await asyncio.sleep(delay)
+
+    async def stream_async(self, fn: Callable[[], Awaitable[Any]], priority: int = INTERACTIVE, executor=None):
+        """stream() for an awaitable that resolves to an async iterable, such as send_message_async(stream=True)."""
+        for attempt in itertools.count():
+            started = False
+            try:
+                async with self.slot_async(priority, executor):
+                    async for item in await fn():
+                        started = True
+                        yield item
+                return
+            except Overloaded:
+                raise
+            except Exception as e:
+                if started:
+                    raise
+                delay = self.retry_delay(e, attempt, priority)
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            self._refill(time_module.monotonic())
+            admitted = sum(self.admitted.values())
+            return {
+                'max_concurrency': self.max_concurrency,
+                'rate': self.rate,
+                'in_flight': self._in_flight,
+                'queued': {name: sum(1 for waiter in self._waiters if waiter[0] == priority) for priority, name in PRIORITY_NAMES.items()},
+                'tokens': round(self._tokens, 2) if self.rate else None,
+                'admitted': dict(self.admitted),
+                'shed': dict(self.shed),
+                'retries': self.retries,
+                'failures': self.failures,
+                'avg_wait_ms': self.wait_seconds / admitted * 1000 if admitted else 0.0,
+                'max_wait_ms': self.max_wait_seconds * 1000,
+                'avg_call_ms': self._avg_call_seconds * 1000,
+            }
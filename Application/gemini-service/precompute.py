@@ -0,0 +1,260 @@
+"""Precomputed crop suitability analyses for the crop x region x season grid most users ask about.
+
+The job generates an analysis for every grid cell with the same prompt as
+/analyze and stores it at precomputed/analyses/<sha1(key)>, keyed by the
+normalized (crop, region, time) cache key. An index at precomputed/index.json
+lists every entry with the prompt fingerprint it was generated from and when.
+The service loads the index and answers /analyze from it before calling
+Gemini, so a miss costs no storage round trip.
+
+An entry is stale once it is older than --max-age-days, or when the prompt
+template or model has changed since it was generated. A rerun regenerates
+only entries that are missing or stale. The index is saved every
+--checkpoint-every entries and on Ctrl-C. An entry written after the last
+checkpoint is picked up from storage on the next run rather than generated again.
+
+    python precompute.py run [--crops rice,wheat] [--regions Punjab] [--times kharif,rabi] [--grid grid.json]
+                             [--concurrency 8] [--rate 2] [--max-age-days 30] [--force] [--dry-run]
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from prompts import ANALYSIS_MODEL_NAME, build_analysis_prompt, prompt_fingerprint
+from result_cache import normalize_key
+
+logger = logging.getLogger(__name__)
+
+# Crops that account for most analyses; every state and union territory is covered by default
+DEFAULT_CROPS = (
+    'rice', 'wheat', 'maize', 'cotton', 'sugarcane', 'soybean', 'chickpea', 'pigeon pea', 'mustard', 'peanut',
+    'pearl millet', 'sorghum', 'potato', 'onion', 'tomato',
+)
+DEFAULT_TIMES = ('kharif', 'rabi', 'zaid')
+INDEX_VERSION = 1
+
+
+class PrecomputedAnalyses:
+    """Read side of the precomputed analysis store, consulted by /analyze before the model.
+
+    The index is held in memory and reloaded at most every refresh_interval
+    seconds, by one request while the others keep using the copy they have.
+    Only fresh entries are served: generated from the current prompt
+    fingerprint and no older than max_age seconds.
+    """
+
+    def __init__(self, storage, documents, max_age: float = 30 * 86400, refresh_interval: float = 300, prefix: str = 'precomputed'):
+        self.storage = storage
+        self.documents = documents
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self.prefix = prefix
+        self.fingerprint = prompt_fingerprint()
+        self._entries = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.reloads = 0
+
+    @property
+    def index_name(self) -> str:
+        return f"{self.prefix}/index.json"
+
+    def entry_name(self, key: str) -> str:
+        return f"{self.prefix}/analyses/{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    def is_fresh(self, entry: Dict, now: Optional[float] = None) -> bool:
+        now = time_module.time() if now is None else now
+        return entry.get('prompt') == self.fingerprint and now - entry.get('generated_at', 0) <= self.max_age
+
+    def read_index(self) -> Dict[str, Dict]:
+        data = self.storage.get_text(self.index_name)
+        if data is None:
+            return {}
+        index = json.loads(data)
+        return index['entries'] if index.get('version') == INDEX_VERSION else {}
+
+    def write_index(self, entries: Dict[str, Dict]):
+        self.storage.put(self.index_name, json.dumps({'version': INDEX_VERSION, 'updated_at': time_module.time(), 'entries': entries}),
+                         content_type='application/json')
+
+    def _index(self) -> Dict[str, Dict]:
+        now = time_module.monotonic()
+        with self._lock:
+            due = self._loaded_at is None or now - self._loaded_at >= self.refresh_interval
+            if due:
+                # Claim the reload so concurrent requests keep using the current index meanwhile
+                self._loaded_at = now
+        if due:
+            try:
+                entries = self.read_index()
+            except Exception:
+                logger.exception("Loading the precomputed analysis index failed; keeping the previous one")
+            else:
+                with self._lock:
+                    self._entries = entries
+                    self.reloads += 1
+        return self._entries
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._index().get(key)
+        if entry is None or not self.is_fresh(entry):
+            with self._lock:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.stale += 1
+            return None
+        document = self.documents.read(entry['blob'])
+        with self._lock:
+            if document is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return document['analysis']
+
+    def stats(self) -> Dict:
+        with self._lock:
+            now = time_module.time()
+            return {
+                'entries': len(self._entries),
+                'fresh_entries': sum(1 for entry in self._entries.values() if self.is_fresh(entry, now)),
+                'max_age': self.max_age,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'reloads': self.reloads,
+            }
+
+
+def build_grid(crops: Iterable[str], regions: Iterable[str], times: Iterable[str]) -> Dict[str, Tuple[str, str, str]]:
+    """Map each cache key in the grid to the (crop, region, time) its prompt is built from, dropping equivalent cells."""
+    grid = {}
+    for crop, region, time in itertools.product(crops, regions, times):
+        grid.setdefault(normalize_key(crop, region, time), (crop, region, time))
+    return grid
+
+
+def run_job(store: PrecomputedAnalyses, generate: Callable[[str], str], grid: Dict[str, Tuple[str, str, str]], concurrency: int = 8,
+            force: bool = False, dry_run: bool = False, checkpoint_every: int = 50) -> Dict:
+    """Generate the grid cells that are missing or stale in the index and record them in it."""
+    entries = store.read_index()
+    now = time_module.time()
+    todo = [key for key in grid if force or key not in entries or not store.is_fresh(entries[key], now)]
+    counts = {'grid': len(grid), 'fresh': len(grid) - len(todo), 'todo': len(todo), 'generated': 0, 'recovered': 0, 'failed': 0}
+    if dry_run or not todo:
+        return counts
+
+    def precompute(key: str) -> Tuple[Dict, bool]:
+        crop, region, time = grid[key]
+        name = store.entry_name(key)
+        if not force:
+            # Written by a run that stopped before its next checkpoint
+            document = store.documents.read(name)
+            if document is not None and store.is_fresh(document['entry']):
+                return document['entry'], False
+        entry = {'crop': crop, 'region': region, 'time': time, 'blob': name, 'prompt': store.fingerprint,
+                 'model': ANALYSIS_MODEL_NAME, 'generated_at': time_module.time()}
+        analysis = generate(build_analysis_prompt(crop, region, time))
+        # The entry is stored before the index points at it
+        store.documents.write(name, {'key': key, 'entry': entry, 'analysis': analysis})
+        return entry, True
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='precompute')
+    futures = {executor.submit(precompute, key): key for key in todo}
+    done_since_checkpoint = 0
+    try:
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                entry, generated = future.result()
+            except Exception:
+                counts['failed'] += 1
+                logger.exception("Precomputing %s failed", key)
+                continue
+            entries[key] = entry
+            counts['generated' if generated else 'recovered'] += 1
+            done_since_checkpoint += 1
+            if done_since_checkpoint >= checkpoint_every:
+                store.write_index(entries)
+                done_since_checkpoint = 0
+                logger.info("Checkpoint: %d of %d done", counts['generated'] + counts['recovered'] + counts['failed'], len(todo))
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; saving the index so the next run resumes from here")
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        store.write_index(entries)
+    return counts
+
+
+def load_grid(args) -> Dict[str, Tuple[str, str, str]]:
+    from gazetteer import STATES
+
+    spec = {}
+    if args.grid:
+        with open(args.grid) as f:
+            spec = json.load(f)
+
+    def values(option: Optional[str], field: str, default: Iterable[str]) -> List[str]:
+        if option:
+            return [value.strip() for value in option.split(',') if value.strip()]
+        return list(spec.get(field, default))
+
+    return build_grid(values(args.crops, 'crops', DEFAULT_CROPS), values(args.regions, 'regions', STATES), values(args.times, 'times', DEFAULT_TIMES))
+
+
+def main():
+    from storage_backend import add_storage_arguments, storage_from_args
+    from document_store import DocumentStore, CODECS
+    from model_scheduler import ModelScheduler, BATCH
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='generate the grid cells that are missing or stale')
+    add_storage_arguments(run_parser)
+    run_parser.add_argument('--grid', help='JSON file with "crops", "regions" and "times" lists')
+    run_parser.add_argument('--crops', help='comma-separated crops, overriding the grid file')
+    run_parser.add_argument('--regions', help='comma-separated regions, overriding the grid file')
+    run_parser.add_argument('--times', help='comma-separated seasons or months, overriding the grid file')
+    run_parser.add_argument('--concurrency', type=int, default=8, help='model calls in flight at once')
+    run_parser.add_argument('--rate', type=float, default=0, help='most model calls per second; 0 for no limit')
+    run_parser.add_argument('--max-age-days', type=float, default=float(os.getenv('PRECOMPUTED_MAX_AGE_DAYS', 30)))
+    run_parser.add_argument('--checkpoint-every', type=int, default=50, help='save the index after this many entries')
+    run_parser.add_argument('--compression', default=os.getenv('STORAGE_COMPRESSION', 'gzip'), choices=tuple(CODECS))
+    run_parser.add_argument('--force', action='store_true', help='regenerate every entry, fresh or not')
+    run_parser.add_argument('--dry-run', action='store_true', help='only report how many entries are missing or stale')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'run':
+        storage = storage_from_args(run_parser, args)
+        documents = DocumentStore(storage, compression=args.compression)
+        store = PrecomputedAnalyses(storage, documents, max_age=args.max_age_days * 86400)
+        grid = load_grid(args)
+        generate = None
+        if not args.dry_run:
+            import vertexai
+            from vertexai.preview.generative_models import GenerativeModel
+
+            vertexai.init(project=os.getenv('PROJECT_ID'), location=os.getenv('LOCATION'))
+            model = GenerativeModel(ANALYSIS_MODEL_NAME)
+            # Bulk work never needs shedding, only pacing and retries
+            scheduler = ModelScheduler(max_concurrency=args.concurrency, rate=args.rate, max_queue_wait=86400)
+            generate = lambda prompt: scheduler.call(lambda: model.generate_content(prompt), BATCH).text  # noqa: E731
+        print(json.dumps(run_job(store, generate, grid, args.concurrency, args.force, args.dry_run, args.checkpoint_every), indent=2))
+
+
+if __name__ == '__main__':
+    main()
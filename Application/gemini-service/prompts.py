@@ -0,0 +1,30 @@
+"""The crop suitability prompt, shared by the service and the offline precompute job."""
+import hashlib
+
+# The model the analysis prompt is written for; it is part of the prompt fingerprint, so changing it makes precomputed analyses stale
+ANALYSIS_MODEL_NAME = "gemini-1.5-flash-002"
+
+
+def build_analysis_prompt(crop: str, region: str, time: str) -> str:
+    """Build the suitability analysis prompt for an extracted crop, region and time."""
+    return f"""
+    Analyze the suitability of growing {crop} in {region} during {time}. Consider the following factors:
+    1. Climatic conditions of {region} during {time} in the near future
+    2. Soil conditions of {region}
+    3. {crop}'s requirements for successful growth, particularly during {time}
+    4. Best time period for growing {crop} in {region}, and how {time} aligns with this
+    5. Any potential challenges or considerations specific to {time}
+
+    Provide a detailed analysis and recommend whether {crop} is suitable for {region} during {time}. 
+    If not entirely suitable, suggest alternative crops that would be more appropriate for the region and time period.
+    Also, provide any adjustments in farming practices that might be necessary for {time}.
+
+    Make sure to explicitly mention the typical weather conditions expected in {region} during {time} in your response.
+    Ignore and don't mention if there's any repeated nonsensical phrase present.
+    """
+
+
+def prompt_fingerprint() -> str:
+    """Identify the prompt template, so analyses generated from an older wording can be told apart."""
+    template = build_analysis_prompt('{crop}', '{region}', '{time}')
+    return hashlib.sha256(f"{ANALYSIS_MODEL_NAME}\n{template}".encode('utf-8')).hexdigest()[:16]
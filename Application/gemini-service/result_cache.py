@@ -0,0 +1,149 @@
+import hashlib
+import json
+import re
+import threading
+import time as time_module
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Months map onto the Indian cropping season they fall in
+SEASON_SYNONYMS = {
+    'january': 'rabi', 'jan': 'rabi',
+    'february': 'rabi', 'feb': 'rabi',
+    'march': 'zaid', 'mar': 'zaid',
+    'april': 'zaid', 'apr': 'zaid',
+    'may': 'zaid',
+    'june': 'kharif', 'jun': 'kharif',
+    'july': 'kharif', 'jul': 'kharif',
+    'august': 'kharif', 'aug': 'kharif',
+    'september': 'kharif', 'sep': 'kharif', 'sept': 'kharif',
+    'october': 'rabi', 'oct': 'rabi',
+    'november': 'rabi', 'nov': 'rabi',
+    'december': 'rabi', 'dec': 'rabi',
+    'monsoon': 'kharif', 'rainy': 'kharif', 'khareef': 'kharif', 'kharif': 'kharif',
+    'winter': 'rabi', 'rabbi': 'rabi', 'rabi': 'rabi',
+    'summer': 'zaid', 'zayed': 'zaid', 'zaib': 'zaid', 'zaid': 'zaid',
+}
+
+CROP_SYNONYMS = {
+    'paddy': 'rice',
+    'corn': 'maize',
+    'groundnut': 'peanut',
+    'arhar': 'pigeon pea', 'tur': 'pigeon pea', 'toor': 'pigeon pea',
+    'chana': 'chickpea', 'gram': 'chickpea',
+    'bajra': 'pearl millet',
+    'jowar': 'sorghum',
+    'ragi': 'finger millet',
+    'sarson': 'mustard',
+}
+
+# Filler words that do not change what is being asked about
+FILLER_WORDS = {'the', 'season', 'crop', 'crops', 'state', 'district', 'region', 'of', 'in', 'during'}
+
+
+def _words(value: str):
+    return [word for word in re.sub(r'[^\w\s]', ' ', value.lower()).split() if word not in FILLER_WORDS]
+
+
+def _normalize_crop(crop: str) -> str:
+    text = ' '.join(_words(crop))
+    return CROP_SYNONYMS.get(text, text)
+
+
+def _normalize_time(time: str) -> str:
+    words = _words(time)
+    # "end of june" or "june-july" both collapse to the season the months share
+    seasons = {SEASON_SYNONYMS[word] for word in words if word in SEASON_SYNONYMS}
+    if len(seasons) == 1:
+        return seasons.pop()
+    return ' '.join(words)
+
+
+def normalize_key(crop: str, region: str, time: str) -> str:
+    """Build a cache key that treats differently phrased but equivalent analyses as the same."""
+    return '|'.join((
+        _normalize_crop(crop),
+        ' '.join(_words(region)),
+        _normalize_time(time),
+    ))
+
+
+class AnalysisCache:
+    """TTL and LRU bounded cache of analysis results, optionally backed by a storage backend."""
+
+    def __init__(self, ttl: float = 86400, max_entries: int = 1024, storage=None, prefix: str = 'cache/analysis'):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.storage = storage
+        self.prefix = prefix
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bucket_hits = 0
+
+    def _blob_name(self, key: str) -> str:
+        return f"{self.prefix}/{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        now = time_module.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+        entry = self._load_from_bucket(key)
+        with self._lock:
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._store(key, entry)
+                self.hits += 1
+                self.bucket_hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: str, persist: bool = True):
+        """Cache a result; persist=False keeps it in memory only, e.g. when it was just read from another store."""
+        entry = (time_module.time(), value)
+        with self._lock:
+            self._store(key, entry)
+        if persist:
+            self._save_to_bucket(key, entry)
+
+    def _store(self, key: str, entry: Tuple[float, str]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load_from_bucket(self, key: str) -> Optional[Tuple[float, str]]:
+        if self.storage is None:
+            return None
+        data = self.storage.get_text(self._blob_name(key))
+        if data is None:
+            return None
+        data = json.loads(data)
+        return data['stored_at'], data['value']
+
+    def _save_to_bucket(self, key: str, entry: Tuple[float, str]):
+        if self.storage is None:
+            return
+        self.storage.put(self._blob_name(key), json.dumps({'key': key, 'stored_at': entry[0], 'value': entry[1]}), content_type='application/json')
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bucket_hits': self.bucket_hits,
+                'evictions': self.evictions,
+            }
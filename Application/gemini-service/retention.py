@@ -0,0 +1,358 @@
+"""Retention sweeper for expired contexts and abandoned sessions.
+
+clean_context only drops expired messages when a session is read again, so
+context and session blobs would otherwise pile up forever. The sweeper
+walks users/ one user prefix at a time, with several users listed in
+parallel, and applies the retention policy:
+
+    users/<user>/contexts/<session>.json    deleted once not updated for context_max_age
+    users/<user>/sessions/<session>/...     snapshot and log deleted once none of them
+                                            was updated for session_max_age
+    users/<user>/sessions/index.json        loses the entries of deleted sessions, and of
+                                            never-saved sessions idle for session_max_age
+
+Deletes go out in batches of batch_size, paced by delete_rate. Progress is
+checkpointed after every users_per_checkpoint users, so an interrupted sweep
+resumes where it stopped with the same cutoffs. A lease blob keeps two
+instances from sweeping at the same time; it is only renewed or released
+while it still names this instance as owner, and only at the generation
+that was checked, so a sweep that overran its lease cannot remove the lease
+of the instance that took over. With texts=True the sweeper also
+deletes text blobs under blobs/sha256/ that no stored document references
+any more. Texts uploaded within text_grace seconds are kept, because a
+document pointing at them may still be on its way.
+
+    python retention.py sweep [--dry-run] [--context-max-age-days 7] [--session-max-age-days 90] [--texts] [--restart]
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time as time_module
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('list', 'contexts', 'sessions', 'index', 'texts')
+
+
+class RateLimiter:
+    """Spaces operations out to at most rate per second across threads; rate=0 disables it."""
+
+    def __init__(self, rate: float = 0):
+        self.rate = rate
+        self._next = time_module.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, count: int = 1):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time_module.monotonic()
+            start = max(now, self._next)
+            self._next = start + count / self.rate
+        if start > now:
+            time_module.sleep(start - now)
+
+
+def _empty_report() -> Dict:
+    return {phase: {'seconds': 0.0, 'deleted': 0, 'bytes': 0} for phase in PHASES}
+
+
+def _merge(report: Dict, other: Dict):
+    for phase, values in other.items():
+        for key, value in values.items():
+            report[phase][key] = report[phase].get(key, 0) + value
+
+
+class RetentionSweeper:
+    """Deletes expired contexts and abandoned sessions, and keeps caches and manifests in step.
+
+    context_cache, session_log, session_index and writer are optional. In
+    the service they are the live instances: swept contexts are evicted from
+    context_cache, and blobs with writes still waiting in writer are left
+    alone. Phase timings in a report are summed across worker threads.
+    """
+
+    def __init__(self, storage, documents=None, session_index=None, context_cache=None, session_log=None, writer=None,
+                 context_max_age: float = 7 * 86400, session_max_age: float = 90 * 86400, text_grace: float = 86400,
+                 workers: int = 8, batch_size: int = 100, delete_rate: float = 0, list_rate: float = 0,
+                 users_per_checkpoint: int = 100, prefix: str = 'users/', state_prefix: str = 'retention', lease_ttl: float = 3600):
+        if documents is not None and text_grace <= documents.reuse_window:
+            raise ValueError("text_grace must be longer than the document store's reuse_window, or live texts could be deleted")
+        self.storage = storage
+        self.documents = documents
+        self.session_index = session_index
+        self.context_cache = context_cache
+        self.session_log = session_log
+        self.writer = writer
+        self.context_max_age = context_max_age
+        self.session_max_age = session_max_age
+        self.text_grace = text_grace
+        self.workers = workers
+        self.batch_size = batch_size
+        self.delete_limiter = RateLimiter(delete_rate)
+        self.list_limiter = RateLimiter(list_rate)
+        self.users_per_checkpoint = users_per_checkpoint
+        self.prefix = prefix
+        self.state_prefix = state_prefix
+        self.lease_ttl = lease_ttl
+        self.owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.last_report = None
+
+    @property
+    def checkpoint_name(self) -> str:
+        return f"{self.state_prefix}/checkpoint.json"
+
+    @property
+    def lease_name(self) -> str:
+        return f"{self.state_prefix}/lease.json"
+
+    def _pending(self, name: str) -> bool:
+        return self.writer is not None and self.writer.pending(name)[0]
+
+    def _owned_lease_generation(self) -> int:
+        """Return the lease's generation if this instance holds it, else 0."""
+        data, generation = self.storage.get_versioned(self.lease_name)
+        if data is None or json.loads(data)['owner'] != self.owner:
+            return 0
+        return generation
+
+    def _acquire_lease(self) -> bool:
+        data, generation = self.storage.get_versioned(self.lease_name)
+        if data is not None and json.loads(data)['expires'] > time_module.time():
+            return False
+        # Either no lease, or the previous holder died without releasing it; only one taker wins
+        lease = json.dumps({'owner': self.owner, 'expires': time_module.time() + self.lease_ttl})
+        return self.storage.put_if_generation(self.lease_name, lease, generation, content_type='application/json')
+
+    def _renew_lease(self) -> bool:
+        """Extend the lease; returns False if another instance took it over."""
+        generation = self._owned_lease_generation()
+        lease = json.dumps({'owner': self.owner, 'expires': time_module.time() + self.lease_ttl})
+        return generation != 0 and self.storage.put_if_generation(self.lease_name, lease, generation, content_type='application/json')
+
+    def _release_lease(self):
+        generation = self._owned_lease_generation()
+        if generation != 0:
+            self.storage.delete_if_generation(self.lease_name, generation)
+
+    def _delete(self, names: List[str], dry_run: bool) -> int:
+        """Delete blobs in paced batches; returns how many were deleted."""
+        if dry_run:
+            return len(names)
+        deleted = 0
+        for start in range(0, len(names), self.batch_size):
+            batch = names[start:start + self.batch_size]
+            self.delete_limiter.wait(len(batch))
+            deleted += sum(self.storage.delete_many(batch))
+        return deleted
+
+    def sweep_user(self, user_prefix: str, now: float, dry_run: bool = False) -> Dict:
+        """Apply the retention policy to one user's blobs."""
+        report = _empty_report()
+        user_id = user_prefix[len(self.prefix):].rstrip('/')
+        started = time_module.perf_counter()
+        self.list_limiter.wait()
+        contexts, sessions, index_blob = [], defaultdict(list), None
+        for blob in self.storage.list(user_prefix):
+            rest = blob.name[len(user_prefix):]
+            if rest.startswith('contexts/') and rest.endswith('.json'):
+                contexts.append(blob)
+            elif rest == 'sessions/index.json':
+                index_blob = blob
+            elif rest.startswith('sessions/') and rest.count('/') >= 2:
+                sessions[rest.split('/')[1]].append(blob)
+        report['list']['seconds'] += time_module.perf_counter() - started
+
+        started = time_module.perf_counter()
+        expired = [blob for blob in contexts if blob.updated.timestamp() < now - self.context_max_age and not self._pending(blob.name)]
+        report['contexts']['deleted'] += self._delete([blob.name for blob in expired], dry_run)
+        report['contexts']['bytes'] += sum(blob.size or 0 for blob in expired)
+        if self.context_cache is not None and not dry_run:
+            for blob in expired:
+                session_id = blob.name[len(user_prefix) + len('contexts/'):-len('.json')]
+                self.context_cache.pop(f"{user_id}_{session_id}")
+        report['contexts']['seconds'] += time_module.perf_counter() - started
+
+        started = time_module.perf_counter()
+        abandoned = [session_id for session_id, blobs in sessions.items()
+                     if max(blob.updated.timestamp() for blob in blobs) < now - self.session_max_age
+                     and not any(self._pending(blob.name) for blob in blobs)]
+        names = [blob.name for session_id in abandoned for blob in sessions[session_id]]
+        report['sessions']['blobs'] = self._delete(names, dry_run)  # Snapshots and log entries together
+        report['sessions']['deleted'] += len(abandoned)
+        report['sessions']['bytes'] += sum(blob.size or 0 for session_id in abandoned for blob in sessions[session_id])
+        if self.session_log is not None and not dry_run:
+            for session_id in abandoned:
+                self.session_log.forget(user_id, session_id)
+        report['sessions']['seconds'] += time_module.perf_counter() - started
+
+        if index_blob is not None and self.session_index is not None:
+            started = time_module.perf_counter()
+            entries = self.session_index.load(user_id)['sessions']
+            stale = set(abandoned) & entries.keys()
+            live_contexts = {blob.name[len(user_prefix) + len('contexts/'):-len('.json')] for blob in contexts if blob not in expired}
+            for session_id, entry in entries.items():
+                # Sessions that were analysed but never saved have no session blobs of their own
+                idle = datetime.fromisoformat(entry['updated']).timestamp() < now - self.session_max_age
+                if idle and session_id not in sessions and session_id not in live_contexts:
+                    stale.add(session_id)
+            if stale:
+                report['index']['deleted'] += len(stale) if dry_run else self.session_index.remove_many(user_id, stale)
+            report['index']['seconds'] += time_module.perf_counter() - started
+        return report
+
+    def sweep_texts(self, now: float, dry_run: bool = False) -> Dict:
+        """Delete text blobs that no document under users/ or precomputed/ references and that are past the grace period."""
+        report = _empty_report()
+        started = time_module.perf_counter()
+        referenced = set()
+        for prefix in (self.prefix, 'precomputed/'):
+            names = [blob.name for blob in self.storage.list(prefix)]
+            for start in range(0, len(names), self.batch_size):
+                self.list_limiter.wait()
+                for data in self.storage.get_many(names[start:start + self.batch_size]).values():
+                    if data is not None:
+                        referenced.update(self.documents.references(data))
+        orphans = [blob for blob in self.storage.list(self.documents.prefix + '/')
+                   if blob.name.rsplit('/', 1)[-1] not in referenced and blob.updated.timestamp() < now - self.text_grace]
+        report['texts']['deleted'] += self._delete([blob.name for blob in orphans], dry_run)
+        report['texts']['bytes'] += sum(blob.size or 0 for blob in orphans)
+        report['texts']['referenced'] = len(referenced)
+        report['texts']['seconds'] += time_module.perf_counter() - started
+        return report
+
+    def sweep(self, dry_run: bool = False, resume: bool = True, texts: bool = False) -> Dict:
+        """Sweep every user, resuming an interrupted sweep unless resume=False; returns what was deleted."""
+        started = time_module.perf_counter()
+        if not dry_run and not self._acquire_lease():
+            return {'skipped': 'another sweep holds the lease'}
+        try:
+            checkpoint = None
+            if resume and not dry_run:
+                data = self.storage.get_text(self.checkpoint_name)
+                checkpoint = json.loads(data) if data is not None else None
+            # A resumed sweep keeps the cutoffs it started with
+            now = checkpoint['now'] if checkpoint else time_module.time()
+            cursor = checkpoint['cursor'] if checkpoint else None
+            report = checkpoint['report'] if checkpoint else _empty_report()
+            users = checkpoint['users'] if checkpoint else 0
+            lost_lease = False
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='retention') as executor:
+                user_prefixes = self.storage.list_prefixes(self.prefix, start_after=cursor)
+                while not self._stop.is_set():
+                    chunk = [user_prefix for _, user_prefix in zip(range(self.users_per_checkpoint), user_prefixes)]
+                    if not chunk:
+                        break
+                    for user_report in executor.map(lambda user_prefix: self.sweep_user(user_prefix, now, dry_run), chunk):
+                        _merge(report, user_report)
+                    users += len(chunk)
+                    if not dry_run:
+                        self.storage.put(self.checkpoint_name, json.dumps({'now': now, 'cursor': chunk[-1], 'users': users, 'report': report}),
+                                         content_type='application/json')
+                        if not self._renew_lease():
+                            logger.warning("Retention lease was taken over by another instance; stopping this sweep")
+                            lost_lease = True
+                            break
+            completed = not self._stop.is_set() and not lost_lease
+            if completed and texts and self.documents is not None:
+                _merge(report, self.sweep_texts(now, dry_run))
+            if completed and not dry_run:
+                self.storage.delete(self.checkpoint_name)
+        finally:
+            if not dry_run:
+                self._release_lease()
+
+        result = {
+            'dry_run': dry_run,
+            'completed': completed,
+            'resumed_from': cursor,
+            'users': users,
+            'elapsed_s': round(time_module.perf_counter() - started, 3),
+            'phases': {phase: {key: round(value, 3) if key == 'seconds' else value for key, value in values.items()} for phase, values in report.items()},
+        }
+        with self._lock:
+            self.runs += 1
+            self.last_report = result
+        logger.info("Retention sweep: %s", json.dumps(result))
+        return result
+
+    def start(self, interval: float, texts: bool = False):
+        """Sweep in a background thread every interval seconds."""
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.sweep(texts=texts)
+                except Exception:
+                    logger.exception("Retention sweep failed")
+        self._thread = threading.Thread(target=run, name='retention-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread; a sweep in progress stops after its current checkpoint."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'context_max_age': self.context_max_age,
+                'session_max_age': self.session_max_age,
+                'runs': self.runs,
+                'last_sweep': self.last_report,
+            }
+
+
+def main():
+    from storage_backend import add_storage_arguments, storage_from_args
+    from document_store import DocumentStore
+    from session_index import SessionIndex
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sweep_parser = subparsers.add_parser('sweep', help='delete expired contexts and abandoned sessions')
+    add_storage_arguments(sweep_parser)
+    sweep_parser.add_argument('--context-max-age-days', type=float, default=float(os.getenv('RETENTION_CONTEXT_MAX_AGE_DAYS', 7)))
+    sweep_parser.add_argument('--session-max-age-days', type=float, default=float(os.getenv('RETENTION_SESSION_MAX_AGE_DAYS', 90)))
+    sweep_parser.add_argument('--texts', action='store_true', help='also delete text blobs no document references')
+    sweep_parser.add_argument('--text-grace-hours', type=float, default=24)
+    sweep_parser.add_argument('--workers', type=int, default=8, help='users swept in parallel')
+    sweep_parser.add_argument('--batch-size', type=int, default=100, help='blobs per delete batch')
+    sweep_parser.add_argument('--delete-rate', type=float, default=float(os.getenv('RETENTION_DELETE_RATE', 0)), help='most deletes per second; 0 for no limit')
+    sweep_parser.add_argument('--list-rate', type=float, default=0, help='most listing or read requests per second; 0 for no limit')
+    sweep_parser.add_argument('--restart', action='store_true', help='ignore the checkpoint of an interrupted sweep')
+    sweep_parser.add_argument('--dry-run', action='store_true', help='report what would be deleted without deleting it')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'sweep':
+        storage = storage_from_args(sweep_parser, args)
+        sweeper = RetentionSweeper(
+            storage,
+            DocumentStore(storage),
+            session_index=SessionIndex(storage),
+            context_max_age=args.context_max_age_days * 86400,
+            session_max_age=args.session_max_age_days * 86400,
+            text_grace=args.text_grace_hours * 3600,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            delete_rate=args.delete_rate,
+            list_rate=args.list_rate,
+        )
+        print(json.dumps(sweeper.sweep(dry_run=args.dry_run, resume=not args.restart, texts=args.texts), indent=2))
+
+
+if __name__ == '__main__':
+    main()
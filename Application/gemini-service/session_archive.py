@@ -0,0 +1,233 @@
+"""Bulk export and import of a user's saved sessions and contexts as an NDJSON record stream.
+
+    {"type": "header", "format": "agropredict-sessions", "version": 1, "user_id": "...", "exported_at": "..."}
+    {"type": "session", "session_id": "...", "data": {...}, "entry": {...}}
+    {"type": "context", "session_id": "...", "messages": [...]}
+    {"type": "error", "kind": "session", "session_id": "...", "error": "..."}
+    {"type": "summary", "sessions": 12, "contexts": 9, "errors": 0}
+
+An export lists the user's blobs lazily and loads a bounded window of
+sessions and contexts concurrently, yielding records in listing order. Memory
+therefore stays flat however long the history is. An import writes records
+in parallel with create-only writes, so by default it never replaces
+existing sessions. With overwrite=True the existing blobs are deleted first.
+"""
+import gzip
+import json
+import re
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, IO, Iterable, Iterator, List, Optional
+
+from session_log import SessionLog
+
+ARCHIVE_FORMAT = 'agropredict-sessions'
+ARCHIVE_VERSION = 1
+# Session ids become part of blob names, so they may not contain path separators
+SESSION_ID_PATTERN = re.compile(r'^(?!\.{1,2}$)[\w.\-]{1,200}$')
+
+
+def context_name(user_id: str, session_id: str) -> str:
+    return f"users/{user_id}/contexts/{session_id}.json"
+
+
+def ndjson(records: Iterable[Dict]) -> Iterator[str]:
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def gzip_stream(chunks: Iterable[str], level: int = 6) -> Iterator[bytes]:
+    """Compress a stream of text chunks into one gzip member as it is produced."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 writes the gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def read_records(stream: IO[bytes], compressed: bool = False) -> Iterator[Dict]:
+    """Parse NDJSON records one line at a time from a (possibly gzipped) binary stream."""
+    if compressed:
+        stream = gzip.GzipFile(fileobj=stream)
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+class SessionArchive:
+    """Streams a user's sessions out as records and writes exported records back in.
+
+    Loads and writes run on one executor shared by every export and import,
+    and each stream keeps at most window of them in flight.
+    """
+
+    def __init__(self, storage, documents, session_log: SessionLog, session_index, writer=None, context_cache=None,
+                 max_workers: int = 8, window: int = 16):
+        self.storage = storage
+        self.documents = documents
+        self.session_log = session_log
+        self.session_index = session_index
+        self.writer = writer
+        self.context_cache = context_cache
+        self.window = window
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='session-archive')
+
+    def _bounded(self, fn: Callable, items: Iterable) -> Iterator:
+        """Yield (item, future) in order, with at most window calls of fn submitted but not yet yielded."""
+        pending = deque()
+        try:
+            for item in items:
+                pending.append((item, self._executor.submit(fn, item)))
+                if len(pending) >= self.window:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        finally:
+            # The consumer went away; drop loads that have not started
+            for _, future in pending:
+                future.cancel()
+
+    def _session_ids(self, user_id: str) -> Iterator[str]:
+        prefix = f"users/{user_id}/sessions/"
+        seen = set()
+        for blob in self.storage.list(prefix):
+            parts = blob.name[len(prefix):].split('/')
+            if len(parts) >= 2 and parts[0] not in seen:
+                seen.add(parts[0])
+                yield parts[0]
+
+    def _context_ids(self, user_id: str) -> Iterator[str]:
+        prefix = f"users/{user_id}/contexts/"
+        for blob in self.storage.list(prefix):
+            if blob.name.endswith('.json'):
+                yield blob.name[len(prefix):-len('.json')]
+
+    def export(self, user_id: str) -> Iterator[Dict]:
+        """Yield every saved session and context of the user as records, ending with a summary."""
+        if self.writer is not None:
+            # Queued writes would otherwise be missing from the listing
+            self.writer.flush()
+        yield {'type': 'header', 'format': ARCHIVE_FORMAT, 'version': ARCHIVE_VERSION, 'user_id': user_id,
+               'exported_at': datetime.now(timezone.utc).isoformat()}
+        entries = self.session_index.load(user_id)['sessions'] if self.session_index is not None else {}
+        counts = {'sessions': 0, 'contexts': 0, 'errors': 0}
+
+        for session_id, future in self._bounded(lambda session_id: self.session_log.load(user_id, session_id), self._session_ids(user_id)):
+            try:
+                data = future.result()
+            except Exception as e:
+                counts['errors'] += 1
+                yield {'type': 'error', 'kind': 'session', 'session_id': session_id, 'error': str(e)}
+                continue
+            if data is not None:
+                counts['sessions'] += 1
+                yield {'type': 'session', 'session_id': session_id, 'data': data, 'entry': entries.get(session_id)}
+
+        for session_id, future in self._bounded(lambda session_id: self.documents.read(context_name(user_id, session_id)), self._context_ids(user_id)):
+            try:
+                messages = future.result()
+            except Exception as e:
+                counts['errors'] += 1
+                yield {'type': 'error', 'kind': 'context', 'session_id': session_id, 'error': str(e)}
+                continue
+            if messages is not None:
+                counts['contexts'] += 1
+                yield {'type': 'context', 'session_id': session_id, 'messages': messages}
+
+        yield {'type': 'summary', **counts}
+
+    def _import_session(self, user_id: str, session_id: str, data: Dict, overwrite: bool) -> bool:
+        if overwrite:
+            # Log entries from the old session would otherwise be replayed on top of the imported snapshot
+            self.storage.delete_many([blob.name for blob in self.storage.list(SessionLog.log_prefix(user_id, session_id))])
+            self.storage.delete(SessionLog.snapshot_name(user_id, session_id))
+            self.storage.delete(SessionLog.marker_name(user_id, session_id))
+        written = self.documents.write(SessionLog.snapshot_name(user_id, session_id), data, if_absent=True)
+        if written:
+            self.session_log.forget(user_id, session_id)
+        return written
+
+    def _import_context(self, user_id: str, session_id: str, messages, overwrite: bool) -> bool:
+        name = context_name(user_id, session_id)
+        if overwrite:
+            self.storage.delete(name)
+        written = self.documents.write(name, messages, if_absent=True)
+        if written and self.context_cache is not None:
+            self.context_cache.pop(f"{user_id}_{session_id}")
+        return written
+
+    def _import_record(self, user_id: str, record: Dict, overwrite: bool) -> Optional[bool]:
+        """Write one record; returns whether it was written, or None for records that carry no data."""
+        kind = record.get('type')
+        if kind not in ('session', 'context'):
+            return None
+        session_id = record.get('session_id')
+        if not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+            raise ValueError(f"Invalid session_id {session_id!r}")
+        if kind == 'session':
+            if not isinstance(record.get('data'), dict):
+                raise ValueError(f"Session {session_id} has no data")
+            return self._import_session(user_id, session_id, record['data'], overwrite)
+        if not isinstance(record.get('messages'), list):
+            raise ValueError(f"Context {session_id} has no messages")
+        return self._import_context(user_id, session_id, record['messages'], overwrite)
+
+    def import_records(self, user_id: str, records: Iterable[Dict], overwrite: bool = False) -> Dict:
+        """Write exported records for user_id, which need not be the user they were exported from.
+
+        If the stream turns out to be malformed partway through, the records
+        already in flight are finished and added to the manifest before the
+        error is raised, so nothing written is left unlisted.
+        """
+        if self.writer is not None:
+            # A queued write for the same blob would land after the import and replace it
+            self.writer.flush()
+        counts = {'sessions': 0, 'contexts': 0, 'skipped': 0, 'errors': 0}
+        errors = []
+        entries = {}
+        stream_error = None
+
+        def check_header(records):
+            nonlocal stream_error
+            try:
+                for record in records:
+                    if not isinstance(record, dict):
+                        raise ValueError(f"Expected a JSON object per record, got {type(record).__name__}")
+                    if record.get('type') == 'header' and (record.get('format') != ARCHIVE_FORMAT or record.get('version') != ARCHIVE_VERSION):
+                        raise ValueError(f"Unsupported archive {record.get('format')!r} version {record.get('version')!r}")
+                    yield record
+            except Exception as e:
+                # Stop reading, but let the records already submitted finish
+                stream_error = e
+
+        try:
+            self._import_all(user_id, check_header(records), overwrite, counts, errors, entries)
+        finally:
+            if entries and self.session_index is not None:
+                self.session_index.update_many(user_id, entries)
+        if stream_error is not None:
+            raise stream_error
+        return {**counts, 'error_details': errors}
+
+    def _import_all(self, user_id: str, records: Iterable[Dict], overwrite: bool, counts: Dict, errors: List[Dict], entries: Dict):
+        for record, future in self._bounded(lambda record: self._import_record(user_id, record, overwrite), records):
+            try:
+                written = future.result()
+            except Exception as e:
+                counts['errors'] += 1
+                if len(errors) < 20:
+                    errors.append({'session_id': record.get('session_id'), 'type': record.get('type'), 'error': str(e)})
+                continue
+            if written is None:
+                continue
+            if not written:
+                counts['skipped'] += 1
+            elif record['type'] == 'session':
+                counts['sessions'] += 1
+                entry = record.get('entry') or {}
+                entries[record['session_id']] = {**entry, **self.session_index.saved_fields(record['data'])} if self.session_index is not None else entry
+            else:
+                counts['contexts'] += 1
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import threading
+import time as time_module
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+TITLE_LENGTH = 80
+MAX_WRITE_ATTEMPTS = 10
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _etag(sessions: Dict) -> str:
+    return hashlib.sha1(json.dumps(sessions, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class SessionIndex:
+    """Per-user manifest of saved sessions, kept next to the session blobs.
+
+    Listing a user's sessions reads one small blob instead of scanning every
+    blob under the user's sessions prefix. The manifest is updated
+    incrementally whenever a session is saved, analysed, cleared or deleted.
+    Users without a manifest get one built from a prefix scan on first use.
+    Updates are written only if the manifest is unchanged since it was read,
+    and retried otherwise, so instances updating the same user never drop
+    each other's entries.
+    """
+
+    def __init__(self, storage, cache_ttl: float = 10, max_cached_users: int = 10000):
+        self.storage = storage
+        self.cache_ttl = cache_ttl
+        self.max_cached_users = max_cached_users
+        self._cache = OrderedDict()  # user_id -> (loaded_at, index)
+        self._cache_lock = threading.Lock()
+        self._user_locks = weakref.WeakValueDictionary()
+        self.rebuilds = 0
+        self.conflicts = 0
+
+    @staticmethod
+    def blob_name(user_id: str) -> str:
+        return f"users/{user_id}/sessions/index.json"
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        with self._cache_lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    def _read(self, user_id: str) -> Tuple[Optional[Dict], int]:
+        data, generation = self.storage.get_versioned(self.blob_name(user_id))
+        return (None if data is None else json.loads(data)), generation
+
+    def _rebuild(self, user_id: str) -> Dict:
+        """Build the manifest from the session blobs that already exist."""
+        sessions = {}
+        for blob in self.storage.list(f"users/{user_id}/sessions/"):
+            if blob.name.endswith('/data.json'):
+                session_id = blob.name.split('/')[-2]
+                sessions[session_id] = {
+                    'id': session_id,
+                    'created': blob.created.isoformat(),
+                    'updated': blob.updated.isoformat(),
+                    'saved': True,
+                }
+        self.rebuilds += 1
+        return {'sessions': sessions, 'etag': _etag(sessions)}
+
+    def _write(self, user_id: str, index: Dict, generation: int) -> bool:
+        """Store the manifest unless another instance wrote it since it was read at generation."""
+        index['etag'] = _etag(index['sessions'])
+        if not self.storage.put_if_generation(self.blob_name(user_id), json.dumps(index), generation, content_type='application/json'):
+            self.conflicts += 1
+            return False
+        self._remember(user_id, index)
+        return True
+
+    def _remember(self, user_id: str, index: Dict):
+        with self._cache_lock:
+            self._cache[user_id] = (time_module.monotonic(), index)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_cached_users:
+                self._cache.popitem(last=False)
+
+    def _modify(self, user_id: str, change: Callable[[Dict], Any]) -> Any:
+        """Apply change to a copy of the stored sessions and write them back, starting over if another instance wrote first.
+
+        change edits the dict in place and returns the caller's result;
+        nothing is written when it leaves the sessions as they were.
+        """
+        with self._user_lock(user_id):
+            for _ in range(MAX_WRITE_ATTEMPTS):
+                index, generation = self._read(user_id)
+                if index is None:
+                    index = self._rebuild(user_id)
+                sessions = dict(index['sessions'])
+                result = change(sessions)
+                if sessions == index['sessions'] and generation:
+                    self._remember(user_id, index)
+                    return result
+                if self._write(user_id, {**index, 'sessions': sessions}, generation):
+                    return result
+            raise RuntimeError(f"Could not update the session manifest of {user_id} after {MAX_WRITE_ATTEMPTS} attempts")
+
+    def load(self, user_id: str) -> Dict:
+        with self._cache_lock:
+            cached = self._cache.get(user_id)
+        if cached is not None and time_module.monotonic() - cached[0] <= self.cache_ttl:
+            return cached[1]
+
+        with self._user_lock(user_id):
+            index, _ = self._read(user_id)
+            if index is None:
+                index = self._rebuild(user_id)
+                if not self._write(user_id, index, 0):
+                    # Another instance stored one first; use theirs
+                    index = self._read(user_id)[0] or index
+                    self._remember(user_id, index)
+            else:
+                self._remember(user_id, index)
+            return index
+
+    def update(self, user_id: str, session_id: str, **fields):
+        """Create or update a session's manifest entry."""
+        self.update_many(user_id, {session_id: fields})
+
+    @staticmethod
+    def saved_fields(session_data: Dict) -> Dict:
+        """Manifest fields describing a saved session."""
+        title = (session_data.get('analysis_input') or '').strip()
+        return {'saved': True, 'title': title[:TITLE_LENGTH] or None, 'messages': len(session_data.get('chat_messages') or [])}
+
+    def record_save(self, user_id: str, session_id: str, session_data: Dict):
+        self.update(user_id, session_id, **self.saved_fields(session_data))
+
+    def update_many(self, user_id: str, entries: Dict[str, Dict]):
+        """Create or update several entries with one manifest write, e.g. after an import."""
+        now = _now()
+
+        def change(sessions: Dict):
+            for session_id, fields in entries.items():
+                entry = dict(sessions.get(session_id) or {'id': session_id, 'created': fields.get('created') or now})
+                entry.update({key: value for key, value in fields.items() if value is not None and key != 'id'})
+                entry['updated'] = now
+                sessions[session_id] = entry
+
+        self._modify(user_id, change)
+
+    def mark_saved(self, user_id: str, session_id: str):
+        """Flag a session as saved unless the manifest already does, so chat turns normally write nothing."""
+        entry = self.load(user_id)['sessions'].get(session_id)
+        if not entry or not entry.get('saved'):
+            self.update(user_id, session_id, saved=True)
+
+    def touch(self, user_id: str, session_id: str):
+        """Mark an existing entry as updated without changing anything else."""
+        if session_id in self.load(user_id)['sessions']:
+            self.update(user_id, session_id)
+
+    def remove(self, user_id: str, session_id: str):
+        self.remove_many(user_id, [session_id])
+
+    def remove_many(self, user_id: str, session_ids) -> int:
+        """Drop several entries with one manifest write; returns how many were there."""
+        session_ids = set(session_ids)
+
+        def change(sessions: Dict) -> int:
+            removed = session_ids & sessions.keys()
+            for session_id in removed:
+                del sessions[session_id]
+            return len(removed)
+
+        return self._modify(user_id, change)
+
+    def page(self, user_id: str, limit: Optional[int] = None, page_token: Optional[str] = None) -> Tuple[List[Dict], Optional[str], str]:
+        """Return (entries, next_page_token, etag) for saved sessions, newest first."""
+        index = self.load(user_id)
+        entries = sorted((entry for entry in index['sessions'].values() if entry.get('saved')), key=lambda entry: entry['created'], reverse=True)
+        start = int(page_token) if page_token else 0
+        end = len(entries) if limit is None else start + max(1, limit)
+        next_page_token = str(end) if end < len(entries) else None
+        return entries[start:end], next_page_token, index['etag']
@@ -0,0 +1,217 @@
+import json
+import logging
+import threading
+import time as time_module
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from document_store import DocumentStore
+
+logger = logging.getLogger(__name__)
+
+MAX_APPEND_ATTEMPTS = 5
+
+
+class SessionLog:
+    """Saved sessions stored as a snapshot plus an append-only log of changes.
+
+    Every append is written as its own small, numbered blob and creates a new
+    version. Numbers are claimed with create-only writes, so two instances can
+    never write the same version. Loads replay the log on top of the snapshot.
+    Once COMPACT_EVERY entries pile up, they are folded into a new snapshot in
+    the background.
+
+        users/<user>/sessions/<session>/data.json            snapshot, has "version"
+        users/<user>/sessions/<session>/version.json         {"version": N}, stored before the log up to N is deleted
+        users/<user>/sessions/<session>/log/00000042.json    one append
+
+    Appends check the small version marker rather than the snapshot, so a
+    chat turn never downloads the whole conversation.
+    """
+
+    def __init__(self, storage, writer, compact_every: int = 20, max_tracked: int = 10000, documents: Optional[DocumentStore] = None):
+        self.storage = storage
+        self.writer = writer
+        self.documents = documents or DocumentStore(storage, writer)
+        self.compact_every = compact_every
+        self.max_tracked = max_tracked
+        self._versions = OrderedDict()  # (user_id, session_id) -> (version, snapshot_version)
+        self._lock = threading.Lock()
+        self._session_locks = weakref.WeakValueDictionary()
+        self._compactor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='session-compactor')
+        self.appends = 0
+        self.conflicts = 0
+        self.compactions = 0
+
+    @staticmethod
+    def snapshot_name(user_id: str, session_id: str) -> str:
+        return f"users/{user_id}/sessions/{session_id}/data.json"
+
+    @staticmethod
+    def marker_name(user_id: str, session_id: str) -> str:
+        return f"users/{user_id}/sessions/{session_id}/version.json"
+
+    @staticmethod
+    def log_prefix(user_id: str, session_id: str) -> str:
+        return f"users/{user_id}/sessions/{session_id}/log/"
+
+    def _log_name(self, user_id: str, session_id: str, version: int) -> str:
+        return f"{self.log_prefix(user_id, session_id)}{version:08d}.json"
+
+    def _session_lock(self, user_id: str, session_id: str) -> threading.Lock:
+        with self._lock:
+            lock = self._session_locks.get((user_id, session_id))
+            if lock is None:
+                lock = self._session_locks[(user_id, session_id)] = threading.Lock()
+            return lock
+
+    def _read_snapshot(self, user_id: str, session_id: str) -> Optional[Dict]:
+        return self.documents.read(self.snapshot_name(user_id, session_id))
+
+    def _snapshot_version(self, user_id: str, session_id: str) -> int:
+        snapshot = self._read_snapshot(user_id, session_id)
+        return snapshot.get('version', 0) if snapshot else 0
+
+    def _compacted_version(self, user_id: str, session_id: str) -> int:
+        """The version up to which the log may have been deleted, read from the marker."""
+        data = self.storage.get_text(self.marker_name(user_id, session_id))
+        if data is not None:
+            return json.loads(data)['version']
+        # Sessions compacted before markers existed: derive it from the snapshot once and keep it.
+        # Create-only, so this never replaces a newer marker written by a compaction meanwhile
+        version = self._snapshot_version(user_id, session_id)
+        self.storage.put(self.marker_name(user_id, session_id), json.dumps({'version': version}), content_type='application/json', if_absent=True)
+        return version
+
+    def _log_versions(self, user_id: str, session_id: str) -> List[int]:
+        prefix = self.log_prefix(user_id, session_id)
+        return sorted(int(blob.name[len(prefix):-len('.json')]) for blob in self.storage.list(prefix))
+
+    def _remember(self, user_id: str, session_id: str, version: int, snapshot_version: int):
+        with self._lock:
+            self._versions[(user_id, session_id)] = (version, snapshot_version)
+            self._versions.move_to_end((user_id, session_id))
+            while len(self._versions) > self.max_tracked:
+                self._versions.popitem(last=False)
+
+    def _discover(self, user_id: str, session_id: str) -> Tuple[int, int]:
+        """Find the latest version and snapshot version from storage."""
+        snapshot_version = self._snapshot_version(user_id, session_id)
+        versions = self._log_versions(user_id, session_id)
+        version = max([snapshot_version] + versions)
+        self._remember(user_id, session_id, version, snapshot_version)
+        return version, snapshot_version
+
+    def _state(self, user_id: str, session_id: str) -> Tuple[int, int]:
+        with self._lock:
+            state = self._versions.get((user_id, session_id))
+        return state if state is not None else self._discover(user_id, session_id)
+
+    def append(self, user_id: str, session_id: str, messages: List[Dict], fields: Optional[Dict] = None) -> int:
+        """Append messages (and optional top-level field updates) and return the new version."""
+        with self._session_lock(user_id, session_id):
+            version, snapshot_version = self._state(user_id, session_id)
+            for _ in range(MAX_APPEND_ATTEMPTS):
+                # Another instance may have compacted since the state was cached, deleting the log
+                # up to its snapshot; a version at or below that would be created but never replayed
+                if self._compacted_version(user_id, session_id) > snapshot_version:
+                    version, snapshot_version = self._discover(user_id, session_id)
+                name = self._log_name(user_id, session_id, version + 1)
+                entry = {'version': version + 1, 'timestamp': time_module.time(), 'messages': messages, 'fields': fields or {}}
+                if not self.documents.write(name, entry, if_absent=True):
+                    # Another instance claimed this version first; catch up and try the next one
+                    self.conflicts += 1
+                    version, snapshot_version = self._discover(user_id, session_id)
+                    continue
+                if self._compacted_version(user_id, session_id) < version + 1:
+                    break
+                # A compaction got this far while we wrote. Its log entries were still there when it read them, so
+                # this create could only succeed after they were deleted: the entry is not in the snapshot
+                self.conflicts += 1
+                self.storage.delete(name)
+                version, snapshot_version = self._discover(user_id, session_id)
+            else:
+                raise RuntimeError(f"Could not append to session {session_id} after {MAX_APPEND_ATTEMPTS} attempts")
+
+            version += 1
+            self.appends += 1
+            self._remember(user_id, session_id, version, snapshot_version)
+            if version - snapshot_version >= self.compact_every:
+                self._compactor.submit(self._compact_quietly, user_id, session_id)
+            return version
+
+    def save_snapshot(self, user_id: str, session_id: str, session_data: Dict) -> int:
+        """Replace the whole session; log entries up to the current version are superseded."""
+        with self._session_lock(user_id, session_id):
+            # Read the version from storage so appends made by other instances are not replayed on top
+            version, snapshot_version = self._discover(user_id, session_id)
+            self.documents.write(self.snapshot_name(user_id, session_id), {**session_data, 'version': version})
+            self._remember(user_id, session_id, version, version)
+        if version > snapshot_version:
+            self._compactor.submit(self._compact_quietly, user_id, session_id)
+        return version
+
+    def load(self, user_id: str, session_id: str) -> Optional[Dict]:
+        """Rebuild the session from its snapshot plus any newer log entries."""
+        snapshot = self._read_snapshot(user_id, session_id)
+        session_data = dict(snapshot) if snapshot else None
+        snapshot_version = session_data.get('version', 0) if session_data else 0
+
+        versions = [version for version in self._log_versions(user_id, session_id) if version > snapshot_version]
+        names = [self._log_name(user_id, session_id, version) for version in versions]
+        entries = [self.documents.decode(data, name) for name, data in self.storage.get_many(names).items() if data is not None]
+        if session_data is None and not entries:
+            return None
+
+        session_data = session_data or {'analysis_input': '', 'analysis_result': None, 'chat_messages': []}
+        session_data['chat_messages'] = list(session_data.get('chat_messages') or [])
+        for entry in sorted(entries, key=lambda entry: entry['version']):
+            session_data.update(entry['fields'])
+            session_data['chat_messages'].extend(entry['messages'])
+            session_data['version'] = entry['version']
+        session_data.setdefault('version', snapshot_version)
+        return session_data
+
+    def compact(self, user_id: str, session_id: str):
+        """Fold the log into a new snapshot, then delete the folded entries."""
+        with self._session_lock(user_id, session_id):
+            session_data = self.load(user_id, session_id)
+            if session_data is None:
+                return
+            version = session_data['version']
+            name = self.snapshot_name(user_id, session_id)
+            self.documents.write(name, session_data)
+            self.writer.flush()
+            if self.writer.pending(name)[0]:
+                # The snapshot did not reach storage, so the log is still the source of truth
+                return
+            self._remember(user_id, session_id, version, version)
+            # Appends on other instances must see the new version before any log entry disappears
+            self.storage.put(self.marker_name(user_id, session_id), json.dumps({'version': version}), content_type='application/json')
+
+        self.storage.delete_many([self._log_name(user_id, session_id, v) for v in self._log_versions(user_id, session_id) if v <= version])
+        self.compactions += 1
+
+    def delete(self, user_id: str, session_id: str):
+        with self._session_lock(user_id, session_id):
+            self.writer.delete(self.snapshot_name(user_id, session_id))
+            self.storage.delete(self.marker_name(user_id, session_id))
+            self.storage.delete_many([self._log_name(user_id, session_id, v) for v in self._log_versions(user_id, session_id)])
+            with self._lock:
+                self._versions.pop((user_id, session_id), None)
+
+    def forget(self, user_id: str, session_id: str):
+        """Drop the remembered version of a session whose blobs were deleted elsewhere, e.g. by the retention sweeper."""
+        with self._lock:
+            self._versions.pop((user_id, session_id), None)
+
+    def _compact_quietly(self, user_id: str, session_id: str):
+        try:
+            self.compact(user_id, session_id)
+        except Exception:
+            logger.exception("Compacting session %s/%s failed", user_id, session_id)
+
+    def stats(self) -> Dict:
+        return {'appends': self.appends, 'conflicts': self.conflicts, 'compactions': self.compactions}
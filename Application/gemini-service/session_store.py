@@ -0,0 +1,199 @@
+import sys
+import threading
+import time as time_module
+import weakref
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, Optional
+
+# Rough per-message overhead of the slotted record, its float timestamp and the deque slot
+MESSAGE_OVERHEAD = 96
+
+
+class Message:
+    """Compact context record that still supports message['role'] style access.
+
+    Pinned messages survive expiry and compaction. A summary records in
+    covers how many tokens the turns it replaced would have cost. tokens
+    caches the message's own token count.
+    """
+
+    __slots__ = ('role', 'content', 'timestamp', 'pinned', 'covers', 'tokens')
+
+    def __init__(self, role: str, content: str, timestamp: float, pinned: bool = False, covers: int = 0):
+        self.role = sys.intern(role)
+        self.content = content
+        self.timestamp = timestamp
+        self.pinned = pinned
+        self.covers = covers
+        self.tokens = None
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Message':
+        return cls(data['role'], data['content'], data['timestamp'], data.get('pinned', False), data.get('covers', 0))
+
+    def __getitem__(self, name: str):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.content) + MESSAGE_OVERHEAD
+
+    def to_dict(self) -> Dict:
+        data = {'role': self.role, 'content': self.content, 'timestamp': self.timestamp}
+        if self.pinned:
+            data['pinned'] = True
+        if self.covers:
+            data['covers'] = self.covers
+        return data
+
+
+class SessionContext(deque):
+    """Bounded deque of messages that keeps track of its own approximate size."""
+
+    def __init__(self, messages: Iterable = (), maxlen: Optional[int] = None):
+        super().__init__(maxlen=maxlen)
+        self.nbytes = 0
+        self._on_resize = None
+        for message in messages:
+            self.append(message)
+
+    def _resize(self, delta: int):
+        self.nbytes += delta
+        if self._on_resize is not None:
+            self._on_resize(delta)
+
+    def append(self, message):
+        if not isinstance(message, Message):
+            message = Message.from_dict(message)
+        delta = message.nbytes()
+        if self.maxlen is not None and len(self) == self.maxlen:
+            delta -= self[0].nbytes()
+        super().append(message)
+        self._resize(delta)
+
+    def popleft(self) -> Message:
+        message = super().popleft()
+        self._resize(-message.nbytes())
+        return message
+
+    def clear(self):
+        super().clear()
+        self._resize(-self.nbytes)
+
+    def replace(self, messages: Iterable):
+        """Swap the contents for the given messages, keeping the same deque object."""
+        messages = list(messages)
+        self.clear()
+        for message in messages:
+            self.append(message)
+
+
+class SessionStore:
+    """In-memory session contexts with LRU, idle-TTL and memory-cap eviction.
+
+    Evicted sessions are simply dropped; callers reload them from storage on
+    the next access.
+    """
+
+    def __init__(self, maxlen: Optional[int] = None, max_entries: int = 10000, idle_ttl: float = 3600, max_bytes: int = 256 * 1024 * 1024):
+        self.maxlen = maxlen
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (last_access, SessionContext)
+        self._locks = weakref.WeakValueDictionary()
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def lock(self, key: str) -> threading.RLock:
+        """Per-session lock; it outlives eviction for as long as someone holds it."""
+        with self._lock:
+            session_lock = self._locks.get(key)
+            if session_lock is None:
+                session_lock = self._locks[key] = threading.RLock()
+            return session_lock
+
+    def get(self, key: str) -> Optional[SessionContext]:
+        now = time_module.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now - entry[0] > self.idle_ttl:
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries[key] = (now, entry[1])
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, messages: Iterable = ()) -> SessionContext:
+        context = SessionContext(messages, maxlen=self.maxlen)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            context._on_resize = self._resized
+            self._entries[key] = (time_module.time(), context)
+            self.nbytes += context.nbytes
+            self._evict()
+        return context
+
+    def pop(self, key: str) -> Optional[SessionContext]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            return self._remove(key)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: str) -> SessionContext:
+        _, context = self._entries.pop(key)
+        context._on_resize = None
+        self.nbytes -= context.nbytes
+        return context
+
+    def _resized(self, delta: int):
+        with self._lock:
+            self.nbytes += delta
+            if delta > 0:
+                self._evict()
+
+    def _evict(self):
+        now = time_module.time()
+        while self._entries:
+            key, (last_access, _) = next(iter(self._entries.items()))
+            if now - last_access > self.idle_ttl:
+                self.expirations += 1
+            elif len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self.evictions += 1
+            else:
+                break
+            self._remove(key)
+
+    def sweep(self):
+        """Drop every idle session, not just the least recently used ones."""
+        now = time_module.time()
+        with self._lock:
+            for key in [key for key, (last_access, _) in self._entries.items() if now - last_access > self.idle_ttl]:
+                self._remove(key)
+                self.expirations += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'idle_ttl': self.idle_ttl,
+            }
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share the result of one function call."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if isinstance(call.error, Exception):
+                raise call.error
+            if call.error is not None:
+                # The leader was interrupted (KeyboardInterrupt, SystemExit); that is not this thread's to re-raise
+                raise RuntimeError(f"Shared call for {key!r} was aborted") from call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'in_flight': len(self._calls), 'executed': self.executed, 'coalesced': self.coalesced}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one event loop.
+
+    The shared call runs as its own task and every caller awaits it through
+    a shield, so a caller that is cancelled (say, its client disconnected)
+    stops waiting without cancelling the call for the others. The call
+    finishes even if every caller gives up.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # Mark retrieved so it is not logged when every caller had gone
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda task: self._finished(key, task))
+            self.executed += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict:
+        return {'in_flight': len(self._calls), 'executed': self.executed, 'coalesced': self.coalesced}
@@ -0,0 +1,306 @@
+import argparse
+import datetime
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+
+class BlobInfo(NamedTuple):
+    name: str
+    created: datetime.datetime
+    updated: datetime.datetime
+    size: int
+
+
+class StorageBackend:
+    """Blob storage used for contexts, sessions and caches."""
+
+    def __init__(self, max_workers: int = 16):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='storage')
+
+    def get(self, name: str) -> Optional[bytes]:
+        """Return the blob's contents, or None if it does not exist."""
+        raise NotImplementedError
+
+    def get_text(self, name: str) -> Optional[str]:
+        data = self.get(name)
+        return None if data is None else data.decode('utf-8')
+
+    def put(self, name: str, data: Union[str, bytes], content_type: Optional[str] = None, if_absent: bool = False) -> bool:
+        """Write the blob. With if_absent, only create it and return False if it already exists."""
+        raise NotImplementedError
+
+    def get_versioned(self, name: str) -> Tuple[Optional[bytes], int]:
+        """Return the blob's contents and generation; a missing blob has generation 0."""
+        raise NotImplementedError
+
+    def put_if_generation(self, name: str, data: Union[str, bytes], generation: int, content_type: Optional[str] = None) -> bool:
+        """Write the blob only if it is still at generation (0: does not exist yet); returns False otherwise."""
+        raise NotImplementedError
+
+    def delete(self, name: str) -> bool:
+        """Delete the blob, returning False if it did not exist."""
+        raise NotImplementedError
+
+    def delete_if_generation(self, name: str, generation: int) -> bool:
+        """Delete the blob only if it is still at generation; returns False otherwise."""
+        raise NotImplementedError
+
+    def list(self, prefix: str) -> Iterator[BlobInfo]:
+        raise NotImplementedError
+
+    def list_prefixes(self, prefix: str, start_after: Optional[str] = None) -> Iterator[str]:
+        """Yield the "directories" directly under prefix (each ending in '/') in lexical order, optionally only those after start_after."""
+        raise NotImplementedError
+
+    def map(self, fn: Callable, items: Iterable) -> List:
+        """Call fn on every item concurrently on the backend's worker threads; results keep the items' order."""
+        items = list(items)
+        try:
+            results = self._executor.map(fn, items)
+        except RuntimeError:
+            # The executor stops taking work at interpreter exit, before atexit flushes run
+            return [fn(item) for item in items]
+        return list(results)
+
+    def get_many(self, names: Iterable[str]) -> Dict[str, Optional[bytes]]:
+        """Fetch several blobs concurrently."""
+        names = list(names)
+        return dict(zip(names, self.map(self.get, names)))
+
+    def put_many(self, items: Iterable[Tuple[str, Union[str, bytes], Optional[str]]]):
+        """Write several (name, data, content_type) blobs concurrently."""
+        self.map(lambda item: self.put(*item), items)
+
+    def delete_many(self, names: Iterable[str]) -> List[bool]:
+        return self.map(self.delete, names)
+
+
+class GCSStorage(StorageBackend):
+    """Google Cloud Storage backend that reuses one bucket handle and HTTP connection pool."""
+
+    def __init__(self, bucket, max_workers: int = 16):
+        super().__init__(max_workers=max_workers)
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        self.bucket = bucket
+        self._not_found = NotFound
+        self._precondition_failed = PreconditionFailed
+
+    def get(self, name: str) -> Optional[bytes]:
+        # A single download that treats 404 as missing, instead of exists() followed by a download
+        try:
+            return self.bucket.blob(name).download_as_bytes()
+        except self._not_found:
+            return None
+
+    def put(self, name: str, data: Union[str, bytes], content_type: Optional[str] = None, if_absent: bool = False) -> bool:
+        if not if_absent:
+            self.bucket.blob(name).upload_from_string(data, content_type=content_type)
+            return True
+        # Generation 0 means the upload only succeeds if no live object has this name
+        try:
+            self.bucket.blob(name).upload_from_string(data, content_type=content_type, if_generation_match=0)
+            return True
+        except self._precondition_failed:
+            return False
+
+    def get_versioned(self, name: str) -> Tuple[Optional[bytes], int]:
+        while True:
+            blob = self.bucket.get_blob(name)
+            if blob is None:
+                return None, 0
+            try:
+                return blob.download_as_bytes(if_generation_match=blob.generation), blob.generation
+            except (self._not_found, self._precondition_failed):
+                # Replaced or deleted between reading the metadata and the contents
+                continue
+
+    def put_if_generation(self, name: str, data: Union[str, bytes], generation: int, content_type: Optional[str] = None) -> bool:
+        try:
+            self.bucket.blob(name).upload_from_string(data, content_type=content_type, if_generation_match=generation)
+            return True
+        except self._precondition_failed:
+            return False
+
+    def delete(self, name: str) -> bool:
+        try:
+            self.bucket.blob(name).delete()
+            return True
+        except self._not_found:
+            return False
+
+    def delete_if_generation(self, name: str, generation: int) -> bool:
+        try:
+            self.bucket.blob(name).delete(if_generation_match=generation)
+            return True
+        except (self._not_found, self._precondition_failed):
+            return False
+
+    def list(self, prefix: str) -> Iterator[BlobInfo]:
+        for blob in self.bucket.list_blobs(prefix=prefix):
+            yield BlobInfo(blob.name, blob.time_created, blob.updated, blob.size)
+
+    def list_prefixes(self, prefix: str, start_after: Optional[str] = None, page_size: int = 1000) -> Iterator[str]:
+        # Prefixes arrive a page at a time, so huge listings never have to be held in memory
+        iterator = self.bucket.list_blobs(prefix=prefix, delimiter='/', start_offset=start_after, page_size=page_size)
+        for page in iterator.pages:
+            for name in sorted(page.prefixes):
+                if start_after is None or name > start_after:
+                    yield name
+
+
+class LocalStorage(StorageBackend):
+    """Stores blobs as files under a root directory; used for benchmarks and local development."""
+
+    def __init__(self, root: str, max_workers: int = 16):
+        super().__init__(max_workers=max_workers)
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self._generation_lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Blob name escapes the storage root: {name}")
+        return path
+
+    def get(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self._path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, name: str, data: Union[str, bytes], content_type: Optional[str] = None, if_absent: bool = False) -> bool:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if not if_absent:
+            os.replace(tmp_path, path)
+            return True
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    @staticmethod
+    def _generation(stat: os.stat_result) -> int:
+        # Every put replaces the file, so the inode and modification time change with each write
+        return (stat.st_ino << 64) | stat.st_mtime_ns
+
+    def get_versioned(self, name: str) -> Tuple[Optional[bytes], int]:
+        try:
+            with open(self._path(name), 'rb') as f:
+                return f.read(), self._generation(os.fstat(f.fileno()))
+        except FileNotFoundError:
+            return None, 0
+
+    def put_if_generation(self, name: str, data: Union[str, bytes], generation: int, content_type: Optional[str] = None) -> bool:
+        # Only atomic between threads of one process, which is all local storage is used for
+        with self._generation_lock:
+            try:
+                current = self._generation(os.stat(self._path(name)))
+            except FileNotFoundError:
+                current = 0
+            if current != generation:
+                return False
+            return self.put(name, data, content_type=content_type, if_absent=generation == 0)
+
+    def delete(self, name: str) -> bool:
+        try:
+            os.remove(self._path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete_if_generation(self, name: str, generation: int) -> bool:
+        with self._generation_lock:
+            try:
+                if self._generation(os.stat(self._path(name))) != generation:
+                    return False
+            except FileNotFoundError:
+                return False
+            return self.delete(name)
+
+    def list(self, prefix: str) -> Iterator[BlobInfo]:
+        # Only walk the deepest directory the prefix fully names
+        start = os.path.join(self.root, os.path.dirname(prefix))
+        for directory, _, files in sorted(os.walk(start)):
+            for file_name in sorted(files):
+                if file_name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if not name.startswith(prefix):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                modified = datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc)
+                yield BlobInfo(name, modified, modified, stat.st_size)
+
+    def list_prefixes(self, prefix: str, start_after: Optional[str] = None) -> Iterator[str]:
+        directory = os.path.join(self.root, os.path.dirname(prefix))
+        try:
+            entries = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        base = prefix[:len(prefix) - len(os.path.basename(prefix))]
+        # Sort on the full name, trailing slash included, to match the order GCS lists in
+        for name in sorted(f"{base}{entry}/" for entry in entries if os.path.isdir(os.path.join(directory, entry))):
+            if name.startswith(prefix) and (start_after is None or name > start_after):
+                yield name
+
+
+def create_storage_backend(kind: str, bucket_name: str = None, root: str = None, pool_size: int = 32) -> StorageBackend:
+    """Build the storage backend selected by STORAGE_BACKEND ('gcs' or 'local').
+
+    The gcs bucket defaults to STORAGE_BUCKET, read here rather than at import
+    so a value loaded from .env after the import is still seen.
+    """
+    if kind == 'local':
+        return LocalStorage(root or 'local_storage')
+    if kind != 'gcs':
+        raise ValueError(f"Unknown storage backend: {kind}")
+    bucket_name = bucket_name or os.getenv('STORAGE_BUCKET')
+    if not bucket_name:
+        raise ValueError("The gcs storage backend needs a bucket; set STORAGE_BUCKET")
+
+    import google.auth
+    import requests
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import storage
+
+    # The client's default session has a 10-connection pool, too small for the worker threads that
+    # share it. Build the session ourselves and hand it over through the documented _http argument
+    # rather than reconfiguring the private client._http afterwards.
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    client = storage.Client(project=project, credentials=credentials, _http=session)
+    return GCSStorage(client.bucket(bucket_name), max_workers=pool_size)
+
+
+def add_storage_arguments(parser: argparse.ArgumentParser):
+    """Options for the maintenance CLIs, defaulting to the settings the service reads."""
+    parser.add_argument('--backend', default=os.getenv('STORAGE_BACKEND', 'gcs'), choices=('gcs', 'local'))
+    parser.add_argument('--bucket', help='required for gcs unless STORAGE_BUCKET is set')
+    parser.add_argument('--root', default=os.getenv('LOCAL_STORAGE_ROOT'))
+
+
+def storage_from_args(parser: argparse.ArgumentParser, args) -> StorageBackend:
+    if args.backend == 'gcs' and not (args.bucket or os.getenv('STORAGE_BUCKET')):
+        parser.error("--bucket is required when STORAGE_BUCKET is not set")
+    return create_storage_backend(args.backend, bucket_name=args.bucket, root=args.root)
@@ -0,0 +1,231 @@
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time as time_module
+import uuid
+from bisect import bisect_left
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in milliseconds; the last bucket catches everything slower
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket the q-th observation falls in."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {
+            'count': self.count,
+            'sum_ms': round(self.total, 3),
+            'max_ms': round(self.max, 3),
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class Trace:
+    """The spans recorded while serving one request."""
+
+    __slots__ = ('trace_id', 'name', 'started', 'spans')
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started = time_module.perf_counter()
+        self.spans = []
+
+    def add(self, name: str, started: float, duration_ms: float, error: bool):
+        self.spans.append({'name': name, 'start_ms': round((started - self.started) * 1000, 3), 'duration_ms': round(duration_ms, 3), 'error': error})
+
+
+class _Span:
+    __slots__ = ('telemetry', 'name', 'started')
+
+    def __init__(self, telemetry: 'Telemetry', name: str):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.started = time_module.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.telemetry.record(self.name, self.started, exc_type is not None)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Telemetry:
+    """Latency histograms, in-flight gauges, counters and per-request traces.
+
+    Wrap a stage in span(name) to time it. Within a request started by
+    begin_request(), every span is also added to that request's trace. Traces
+    slower than trace_threshold_ms are logged as one JSON line, and a
+    negative threshold turns trace logging off. With enabled=False, span()
+    returns a shared no-op and nothing is recorded.
+    """
+
+    def __init__(self, enabled: bool = True, trace_threshold_ms: float = 1000):
+        self.enabled = enabled
+        self.trace_threshold_ms = trace_threshold_ms
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._in_flight = {}
+
+    def span(self, name: str):
+        return _Span(self, name) if self.enabled else _NOOP_SPAN
+
+    def traced(self, name: str):
+        """Decorator that wraps every call of the function in a span."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Span(self, name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name: str, duration_ms: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(duration_ms)
+
+    def record(self, name: str, started: float, error: bool = False):
+        """Record a stage that began at perf_counter() time `started` and ends now."""
+        if not self.enabled:
+            return
+        duration_ms = (time_module.perf_counter() - started) * 1000
+        self.observe(name, duration_ms)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, started, duration_ms, error)
+
+    def count(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def begin_request(self, route: str):
+        """Start timing a request; pass the returned token to end_request."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._in_flight[route] = self._in_flight.get(route, 0) + 1
+        trace = Trace(route)
+        return trace, _current_trace.set(trace)
+
+    def end_request(self, token, status: Optional[int] = None):
+        if token is None:
+            return
+        trace, reset_token = token
+        duration_ms = (time_module.perf_counter() - trace.started) * 1000
+        try:
+            _current_trace.reset(reset_token)
+        except ValueError:
+            # Ended from a different context than it began in (e.g. a streamed response)
+            _current_trace.set(None)
+        with self._lock:
+            self._in_flight[trace.name] -= 1
+        self.observe(f"request.{trace.name}", duration_ms)
+        if status is not None and status >= 500:
+            self.count(f"errors.{trace.name}")
+        if 0 <= self.trace_threshold_ms <= duration_ms:
+            logger.info(json.dumps({
+                'trace_id': trace.trace_id,
+                'route': trace.name,
+                'status': status,
+                'duration_ms': round(duration_ms, 3),
+                'spans': trace.spans,
+            }))
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'latency': {name: histogram.to_dict() for name, histogram in sorted(self._histograms.items())},
+                'in_flight': dict(self._in_flight),
+                'counters': dict(self._counters),
+            }
+
+    def prometheus(self, gauges: Dict = None) -> str:
+        """Render histograms, counters and gauges in the Prometheus text format.
+
+        gauges may be nested, like the services' stats() dicts; every numeric
+        leaf becomes a gauge named after its path.
+        """
+        lines: List[str] = []
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                metric = 'agropredict_' + name.replace('.', '_').replace('/', '_') + '_ms'
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum {histogram.total}")
+                lines.append(f"{metric}_count {histogram.count}")
+            for route, count in sorted(self._in_flight.items()):
+                lines.append(f'agropredict_in_flight{{route="{route}"}} {count}')
+            for name, value in sorted(self._counters.items()):
+                lines.append(f"agropredict_{name.replace('.', '_')}_total {value}")
+        for name, value in sorted(_numeric_leaves(gauges or {})):
+            lines.append(f"agropredict_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _numeric_leaves(values: Dict, prefix: str = ''):
+    for key, value in values.items():
+        name = f"{prefix}{key}".replace('.', '_').replace('/', '_').replace('-', '_')
+        if isinstance(value, dict):
+            yield from _numeric_leaves(value, name + '_')
+        elif isinstance(value, (int, float)):
+            yield name, float(value)
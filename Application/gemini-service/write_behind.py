@@ -0,0 +1,141 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_DELETE = object()  # Pending marker for a blob that should be deleted
+
+
+class WriteBehindQueue:
+    """Buffers blob writes and flushes them to storage from a background thread.
+
+    Repeated writes to the same blob before a flush are merged so only the
+    latest data is uploaded. Each flush uploads its batch concurrently on the
+    storage backend's worker threads. Blobs queued with ahead=True are
+    uploaded before the rest of the batch. The rest waits for the next flush
+    if any of them fails. Reads should consult pending() first so they see
+    writes that have not reached storage yet.
+    """
+
+    def __init__(self, storage, flush_interval: float = 2.0, max_pending: int = 100):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # blob name -> (data, content_type, ahead)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._worker = None
+        self.writes = 0
+        self.deletes = 0
+        self.merged = 0
+        self.failures = 0
+
+    def put(self, name: str, data: str, content_type: Optional[str] = None, ahead: bool = False):
+        """Queue a write; pass ahead for blobs that other queued blobs point at."""
+        self._enqueue(name, (data, content_type, ahead))
+
+    def delete(self, name: str):
+        self._enqueue(name, (_DELETE, None, False))
+
+    def _enqueue(self, name: str, item: Tuple):
+        with self._lock:
+            if name in self._pending:
+                del self._pending[name]
+                self.merged += 1
+            self._pending[name] = item
+            full = len(self._pending) >= self.max_pending
+            if self._worker is None and not self._stopped:
+                self._worker = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._worker.start()
+        if self._stopped:
+            self.flush()
+        elif full:
+            self._wakeup.set()
+
+    def pending(self, name: str) -> Tuple[bool, Optional[str]]:
+        """Return (True, data) for a write that has not been flushed yet; data is None for a pending delete."""
+        with self._lock:
+            item = self._pending.get(name) or self._in_flight.get(name)
+        if item is None:
+            return False, None
+        return True, None if item[0] is _DELETE else item[0]
+
+    def pending_names(self, prefix: str) -> List[str]:
+        """Names under prefix that will exist once pending writes are flushed."""
+        with self._lock:
+            items = {**self._in_flight, **self._pending}
+        return [name for name, item in items.items() if name.startswith(prefix) and item[0] is not _DELETE]
+
+    def _requeue(self, name: str, item: Tuple):
+        with self._lock:
+            # Retry on the next flush unless a newer write superseded it
+            if name not in self._pending:
+                self._pending[name] = item
+
+    def _apply(self, entry: Tuple[str, Tuple]) -> bool:
+        name, item = entry
+        data, content_type, _ = item
+        try:
+            if data is _DELETE:
+                self.storage.delete(name)
+            else:
+                self.storage.put(name, data, content_type=content_type)
+        except Exception:
+            logger.exception("Write-behind flush failed for %s", name)
+            with self._lock:
+                self.failures += 1
+            self._requeue(name, item)
+            return False
+        with self._lock:
+            if data is _DELETE:
+                self.deletes += 1
+            else:
+                self.writes += 1
+        return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._in_flight, self._pending = self._pending, OrderedDict()
+                batch = list(self._in_flight.items())
+
+            ahead = [entry for entry in batch if entry[1][2]]
+            rest = [entry for entry in batch if not entry[1][2]]
+            if all(self.storage.map(self._apply, ahead)):
+                self.storage.map(self._apply, rest)
+            else:
+                # Blobs in the rest of the batch may point at the ones that failed
+                for name, item in rest:
+                    self._requeue(name, item)
+
+            with self._lock:
+                self._in_flight = {}
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the background worker and flush everything still pending."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join()
+        self.flush()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'writes': self.writes,
+                'deletes': self.deletes,
+                'merged': self.merged,
+                'failures': self.failures,
+            }
@@ -1,13 +1,17 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import datetime
 import os
+import time
 import firebase_admin
 from firebase_admin import credentials, auth
 import pyrebase
 import re
 from dotenv import load_dotenv
+from chat_view import render_markdown, render_messages, trim_window
 load_dotenv()
 
 # Initialize Firebase Admin SDK
@@ -33,6 +37,23 @@ auth_firebase = firebase.auth()
 # Cloud Run service URL
 GEMINI_SERVICE_URL = os.getenv('APPURL')
 
+# (connect, read) timeouts in seconds; streamed answers may pause between chunks
+REQUEST_TIMEOUT = (5, 60)
+STREAM_TIMEOUT = (5, 120)
+SESSION_LIST_TTL = 60  # Seconds before the sidebar revalidates the saved session list
+SESSION_TTL = SESSION_LIST_TTL  # Seconds a loaded session is reused before it is fetched again
+CHAT_WINDOW = int(os.getenv("CHAT_WINDOW", 20))  # Chat messages loaded and rendered at once; older pages load on demand
+
+@st.cache_resource
+def get_http_session():
+    """Keep-alive HTTP session shared by every script run, with retries for idempotent requests."""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET"}))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 # Set page config
 st.set_page_config(page_title="AgroPredict", layout="wide")
 
@@ -157,18 +178,38 @@ def login():
 def logout():
     st.session_state.user = None
     st.session_state.authenticated = False
+    st.session_state.pop("loaded_sessions", None)
+    invalidate_session_list()
     st.success("Logged out successfully!")
     st.rerun()
 
 # Crop analysis functions
-def analyze_crop_suitability(sentence, session_id, user_id):
-    url = f"{GEMINI_SERVICE_URL}/analyze"
+def stream_text(url, payload):
+    """Yield text chunks from a server-sent event stream of the gemini-service."""
+    with get_http_session().post(url, json=payload, stream=True, timeout=STREAM_TIMEOUT) as response:
+        response.raise_for_status()
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                event = None
+            elif line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[len("data:"):])
+                if event == "error":
+                    raise requests.exceptions.RequestException(data.get("error", "Streaming failed"))
+                if event is None:
+                    yield data["text"]
+
+def analyze_crop_suitability(sentence, session_id, user_id, container=None):
+    url = f"{GEMINI_SERVICE_URL}/analyze_stream"
     payload = {"sentence": sentence, "session_id": session_id, "user_id": user_id}
-    response = requests.post(url, json=payload)
     
     try:
-        response.raise_for_status()
-        return response.json()
+        # Render the analysis as it is generated instead of waiting for the full answer
+        with container if container is not None else st.container():
+            analysis_text = st.write_stream(stream_text(url, payload))
+        return {"crop_analysis": analysis_text}
     except requests.exceptions.HTTPError as http_err:
         st.error(f"HTTP error occurred: {http_err}")
     except requests.exceptions.RequestException as err:
@@ -178,13 +219,12 @@ def analyze_crop_suitability(sentence, session_id, user_id):
     return None
 
 def chat_with_bot(message, session_id, user_id):
-    url = f"{GEMINI_SERVICE_URL}/chat"
+    url = f"{GEMINI_SERVICE_URL}/chat_stream"
     payload = {"message": message, "session_id": session_id, "user_id": user_id}
-    response = requests.post(url, json=payload)
     
     try:
-        response.raise_for_status()
-        return response.json()
+        response_text = st.write_stream(stream_text(url, payload))
+        return {"response": response_text}
     except requests.exceptions.HTTPError as http_err:
         st.error(f"HTTP error occurred: {http_err}")
     except requests.exceptions.RequestException as err:
@@ -209,10 +249,40 @@ def save_session_to_storage(user_id, session_id, analysis_input, analysis_result
         "chat_messages": chat_messages
     }
     payload = {"user_id": user_id, "session_id": session_id, "session_data": session_data}
-    response = requests.post(url, json=payload)
     
     try:
+        response = get_http_session().post(url, json=payload, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        # We already know what the session looks like, and the sidebar list is now out of date
+        window, offset = trim_window(chat_messages, 0, CHAT_WINDOW)
+        st.session_state.setdefault("loaded_sessions", {})[session_id] = {
+            "session": {**session_data, "chat_messages": window, "messages_offset": offset, "messages_total": len(chat_messages)},
+            "fetched_at": time.monotonic(),
+        }
+        invalidate_session_list()
+        return response.json()
+    except requests.exceptions.HTTPError as http_err:
+        st.error(f"HTTP error occurred: {http_err}")
+    except requests.exceptions.RequestException as err:
+        st.error(f"Error occurred: {err}")
+    return None
+
+def append_session_to_storage(user_id, session_id, messages):
+    """Persist only the new chat messages instead of re-uploading the whole session."""
+    url = f"{GEMINI_SERVICE_URL}/append_session"
+    payload = {"user_id": user_id, "session_id": session_id, "messages": messages}
+
+    try:
+        response = get_http_session().post(url, json=payload, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
+        cached = st.session_state.setdefault("loaded_sessions", {}).get(session_id)
+        if cached is not None:
+            loaded = cached["session"]
+            # Keep only the newest window cached, as load_session would return it
+            loaded["chat_messages"], loaded["messages_offset"] = trim_window(
+                list(loaded.get("chat_messages", [])) + messages, loaded.get("messages_offset", 0), CHAT_WINDOW)
+            loaded["messages_total"] = loaded.get("messages_total", 0) + len(messages)
+        invalidate_session_list()
         return response.json()
     except requests.exceptions.HTTPError as http_err:
         st.error(f"HTTP error occurred: {http_err}")
@@ -221,47 +291,95 @@ def save_session_to_storage(user_id, session_id, analysis_input, analysis_result
     return None
 
 # Main application functions
+def invalidate_session_list():
+    st.session_state.pop("session_list_cache", None)
+
 def list_saved_sessions(user_id):
+    cached = st.session_state.get("session_list_cache")
+    if cached and cached["user_id"] == user_id and time.monotonic() - cached["fetched_at"] < SESSION_LIST_TTL:
+        return cached["sessions"]
+
     url = f"{GEMINI_SERVICE_URL}/list_sessions"
     params = {"user_id": user_id}
-    response = requests.get(url, params=params)
+    headers = {"If-None-Match": cached["etag"]} if cached and cached["user_id"] == user_id and cached.get("etag") else {}
     
     try:
+        response = get_http_session().get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            # Unchanged since the last fetch, so keep the cached list
+            cached["fetched_at"] = time.monotonic()
+            return cached["sessions"]
         response.raise_for_status()
         sessions = response.json()
-        return sorted([(session_id, created_time) for session_id, created_time in sessions.items()], 
+        sessions = sorted([(session_id, created_time) for session_id, created_time in sessions.items()], 
                      key=lambda x: x[1], reverse=True)
+        st.session_state.session_list_cache = {
+            "user_id": user_id,
+            "sessions": sessions,
+            "etag": response.headers.get("ETag"),
+            "fetched_at": time.monotonic(),
+        }
+        return sessions
     except Exception as e:
         st.error(f"Error loading sessions: {str(e)}")
         return []
 
 def load_session(user_id, session_id):
+    loaded_sessions = st.session_state.setdefault("loaded_sessions", {})
+    cached = loaded_sessions.get(session_id)
+    # Refetched once stale, so changes made on another device show up
+    if cached and time.monotonic() - cached["fetched_at"] < SESSION_TTL:
+        return cached["session"]
+
     url = f"{GEMINI_SERVICE_URL}/load_session"
-    params = {"user_id": user_id, "session_id": session_id}
-    response = requests.get(url, params=params)
+    # Only the newest chat messages; older ones are fetched by load_earlier_messages
+    params = {"user_id": user_id, "session_id": session_id, "limit": CHAT_WINDOW}
     
     try:
+        response = get_http_session().get(url, params=params, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        return response.json()
+        loaded_sessions[session_id] = {"session": response.json(), "fetched_at": time.monotonic()}
+        return loaded_sessions[session_id]["session"]
     except Exception as e:
         st.error(f"Error loading session: {str(e)}")
         return None
 
+def load_earlier_messages(user_id, session_id, before):
+    """Fetch the page of chat messages that ends just before history index before."""
+    url = f"{GEMINI_SERVICE_URL}/load_session"
+    params = {"user_id": user_id, "session_id": session_id, "limit": CHAT_WINDOW, "before": before}
+
+    try:
+        response = get_http_session().get(url, params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        st.error(f"Error loading earlier messages: {str(e)}")
+        return None
+
+def export_history(user_id):
+    """Download the user's whole history as the gzipped NDJSON export, streamed in chunks."""
+    url = f"{GEMINI_SERVICE_URL}/export_sessions"
+    params = {"user_id": user_id, "format": "gzip"}
+
+    try:
+        with get_http_session().get(url, params=params, stream=True, timeout=STREAM_TIMEOUT) as response:
+            response.raise_for_status()
+            return b"".join(response.iter_content(chunk_size=64 * 1024))
+    except requests.exceptions.RequestException as err:
+        st.error(f"Error exporting history: {err}")
+        return None
+
 def start_new_chat(user_id):
-    if hasattr(st.session_state, 'session_id'):
-        save_session_to_storage(
-            user_id,
-            st.session_state.session_id,
-            st.session_state.analysis_input,
-            st.session_state.analysis_result,
-            st.session_state.chat_messages,
-        )
-    
+    # The current session is already saved: analyses are saved in full and chat turns are appended
+    invalidate_session_list()
     new_session_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     st.session_state.session_id = new_session_id
     st.session_state.analysis_input = ""
     st.session_state.analysis_result = None
     st.session_state.chat_messages = []
+    st.session_state.messages_offset = 0
+    st.session_state.chat_window = CHAT_WINDOW
     st.rerun()
 
 def display_user_profile():
@@ -297,9 +415,29 @@ def main_app():
                     st.session_state.session_id = session_id
                     st.session_state.analysis_input = loaded_session.get("analysis_input", "")
                     st.session_state.analysis_result = loaded_session.get("analysis_result", None)
-                    st.session_state.chat_messages = loaded_session.get("chat_messages", [])
+                    st.session_state.chat_messages = list(loaded_session.get("chat_messages", []))
+                    st.session_state.messages_offset = loaded_session.get("messages_offset", 0)
+                    st.session_state.chat_window = CHAT_WINDOW
                     st.rerun()
 
+        st.subheader("Export")
+        # Only fetch the archive when asked; it is kept until the download button is used
+        if "history_export" not in st.session_state:
+            if st.button("Prepare history export", key="prepare_export"):
+                history_export = export_history(user_id)
+                if history_export is not None:
+                    st.session_state.history_export = history_export
+                    st.rerun()
+        else:
+            st.download_button(
+                "Download history",
+                data=st.session_state.history_export,
+                file_name=f"agropredict-history-{datetime.date.today():%Y%m%d}.ndjson.gz",
+                mime="application/gzip",
+                on_click=lambda: st.session_state.pop("history_export", None),
+                key="download_export",
+            )
+
     # Main content area
     st.title("AgroPredict")
     
@@ -312,21 +450,28 @@ def main_app():
         st.session_state.analysis_result = None
     if "chat_messages" not in st.session_state:
         st.session_state.chat_messages = []
+    # History index of chat_messages[0], and how many messages to keep as the chat grows
+    if "messages_offset" not in st.session_state:
+        st.session_state.messages_offset = 0
+    if "chat_window" not in st.session_state:
+        st.session_state.chat_window = CHAT_WINDOW
 
     # Analysis input
     analysis_input = st.text_area("Enter your crop, region and growing season for tailored agricultural advice:", 
                                  value=st.session_state.analysis_input, height=100)
     
     col1, col2 = st.columns([1, 5])
+    stream_area = st.container()
     with col1:
         if st.button("Analyze"):
             if analysis_input:
-                with st.spinner("Analyzing..."):
-                    result = analyze_crop_suitability(analysis_input, st.session_state.session_id, user_id)
+                result = analyze_crop_suitability(analysis_input, st.session_state.session_id, user_id, container=stream_area)
                 if result:
                     st.session_state.analysis_input = analysis_input
                     st.session_state.analysis_result = result
                     st.session_state.chat_messages = []
+                    st.session_state.messages_offset = 0
+                    st.session_state.chat_window = CHAT_WINDOW
                     save_session_to_storage(
                         user_id,
                         st.session_state.session_id,
@@ -342,31 +487,36 @@ def main_app():
     if st.session_state.analysis_result:
         st.subheader("Analysis Result:")
         analysis_text = st.session_state.analysis_result.get('crop_analysis', '')
-        st.markdown(analysis_text)
+        render_markdown(analysis_text)
 
         st.subheader("Chat about the Analysis")
-        
-        # Display chat messages
-        for message in st.session_state.chat_messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+
+        if st.session_state.messages_offset > 0:
+            if st.button(f"Load earlier messages ({st.session_state.messages_offset} more)", key="load_earlier"):
+                page = load_earlier_messages(user_id, st.session_state.session_id, st.session_state.messages_offset)
+                if page is not None:
+                    st.session_state.chat_messages = page["chat_messages"] + st.session_state.chat_messages
+                    st.session_state.messages_offset = page["messages_offset"]
+                    st.session_state.chat_window = len(st.session_state.chat_messages)
+                    st.rerun()
+
+        # Display only the loaded window of chat messages
+        render_messages(st.session_state.chat_messages)
 
         # Chat input
         if prompt := st.chat_input("Ask a question about the analysis:"):
-            st.session_state.chat_messages.append({"role": "user", "content": prompt})
+            new_messages = [{"role": "user", "content": prompt}]
+            with st.chat_message("user"):
+                st.markdown(prompt)
             
-            with st.spinner("Thinking..."):
+            with st.chat_message("assistant"):
                 response = chat_with_bot(prompt, st.session_state.session_id, user_id)
             if response:
-                st.session_state.chat_messages.append({"role": "assistant", "content": response["response"]})
+                new_messages.append({"role": "assistant", "content": response["response"]})
+            st.session_state.chat_messages, st.session_state.messages_offset = trim_window(
+                st.session_state.chat_messages + new_messages, st.session_state.messages_offset, st.session_state.chat_window)
             
-            save_session_to_storage(
-                user_id,
-                st.session_state.session_id,
-                st.session_state.analysis_input,
-                st.session_state.analysis_result,
-                st.session_state.chat_messages   
-            )
+            append_session_to_storage(user_id, st.session_state.session_id, new_messages)
             
             st.rerun()
 
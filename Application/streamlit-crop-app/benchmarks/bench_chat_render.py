@@ -0,0 +1,112 @@
+"""Compare rerun time and element payload of rendering a long chat in full against the windowed, cached view.
+
+Usage: python benchmarks/bench_chat_render.py [--messages 500] [--window 20] [--reruns 5]
+
+Each layout runs in Streamlit's AppTest harness, which executes the script the
+way a browser rerun would. The payload is the serialized size of the elements
+the script sends to the browser.
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time as time_module
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+# AppTest warns about the missing script context whenever session state is set from outside a run
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").disabled = True
+
+SETUP = f"""
+import sys
+sys.path.insert(0, {APP_DIR!r})
+import streamlit as st
+from chat_view import render_markdown, render_messages
+
+messages = st.session_state.messages
+"""
+
+# The analysis and chat rendering main_app used before
+FULL = SETUP + """
+st.markdown(st.session_state.analysis)
+for message in messages:
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+"""
+
+WINDOWED = SETUP + """
+render_markdown(st.session_state.analysis)
+if st.session_state.offset > 0:
+    st.button(f"Load earlier messages ({st.session_state.offset} more)")
+render_messages(messages[st.session_state.offset:])
+"""
+
+ANALYSIS = "\n\n".join(
+    f"## Section {i}\n\n**Rice** in *Punjab* during kharif needs about {i + 4} irrigations.\n\n"
+    "| Stage | Water (mm) |\n|---|---|\n| Sowing | 50 |\n| Tillering | 80 |\n\n- Apply urea in two splits\n- Watch for stem borer"
+    for i in range(8))
+
+
+def make_messages(count: int):
+    messages = []
+    for i in range(count):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": f"Question {i}: how much water does the crop need in week {i // 2}?"})
+        else:
+            messages.append({"role": "assistant", "content": f"For week {i // 2}, give **{i % 7 + 3} cm** of water.\n\n"
+                                                             "- Irrigate in the morning\n- Check soil moisture first\n\n"
+                                                             "Fertiliser: apply *20 kg/acre* of urea after weeding."})
+    return messages
+
+
+def payload_bytes(at: AppTest) -> int:
+    total = 0
+    stack = [at._tree]
+    while stack:
+        node = stack.pop()
+        proto = getattr(node, "proto", None)
+        if proto is not None and hasattr(proto, "ByteSize"):
+            total += proto.ByteSize()
+        children = getattr(node, "children", None)
+        if children:
+            stack.extend(children.values())
+    return total
+
+
+def measure(script: str, messages, offset: int, reruns: int):
+    at = AppTest.from_string(script, default_timeout=120)
+    at.session_state.messages = messages
+    at.session_state.analysis = ANALYSIS
+    at.session_state.offset = offset
+    times = []
+    # The first run fills the markdown cache; later runs are the reruns a user sees on every interaction
+    for _ in range(reruns + 1):
+        start = time_module.perf_counter()
+        at.run()
+        times.append(time_module.perf_counter() - start)
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+    return times[0], statistics.median(times[1:]), payload_bytes(at)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--window", type=int, default=20)
+    parser.add_argument("--reruns", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    print(f"{'layout':>10} {'messages':>9} {'first ms':>9} {'rerun ms':>9} {'payload KB':>11}")
+    # "cached" renders every message through the cache, to separate its effect from the window's
+    layouts = (("full", FULL, 0), ("cached", WINDOWED, 0), ("windowed", WINDOWED, max(0, args.messages - args.window)))
+    for name, script, offset in layouts:
+        first, rerun, size = measure(script, messages, offset, args.reruns)
+        print(f"{name:>10} {args.messages - offset:>9} {first * 1000:>9.1f} {rerun * 1000:>9.1f} {size / 1024:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Windowed, cached rendering of the analysis and chat history.
+
+Each message is converted from markdown to HTML once and cached by its
+content, so a rerun only converts messages it has not seen before. The
+window is then sent as a single HTML element styled by the app's
+chat-message CSS. Raw HTML inside messages is escaped rather than rendered.
+"""
+import streamlit as st
+from markdown_it import MarkdownIt
+
+_markdown = MarkdownIt('commonmark', {'html': False, 'linkify': False}).enable('table').enable('strikethrough')
+
+ROLE_CLASSES = {"user": "user-message", "assistant": "assistant-message"}
+
+
+@st.cache_data(max_entries=4096, show_spinner=False)
+def markdown_html(text: str) -> str:
+    return _markdown.render(text or "")
+
+
+@st.cache_data(max_entries=4096, show_spinner=False)
+def message_html(role: str, content: str) -> str:
+    role_class = ROLE_CLASSES.get(role, "assistant-message")
+    return f'<div class="chat-message {role_class}"><div class="message-content">{markdown_html(content)}</div></div>'
+
+
+def render_markdown(text: str):
+    st.html(markdown_html(text))
+
+
+def render_messages(messages):
+    """Render the loaded window of chat messages as one element."""
+    if messages:
+        st.html('<div class="chat-container">' + "".join(message_html(m["role"], m["content"]) for m in messages) + "</div>")
+
+
+def trim_window(messages, offset, window):
+    """Keep only the newest window messages; returns them and the history index of the first one kept."""
+    if len(messages) <= window:
+        return list(messages), offset
+    dropped = len(messages) - window
+    return list(messages[dropped:]), offset + dropped